@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+#
+# Stand-in for the ALLSTAR executable: fits every star of the input AP file
+# with the Gaussian PSF written by fake_daophot, and writes the ALS
+# catalog and the star-subtracted image.
+#
+# If FAKE_ALLSTAR_KILL names an existing file, the first ALLSTAR to remove
+# it gets killed before it writes anything (see run_resume.py).
+#
+
+import os, sys
+import signal
+import numpy
+import pyfits
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import *
+
+
+def main():
+
+    options = {'FI': 5., 'IS': 0., 'OS': 20.}
+    while (True):
+        prompt("\n OPT> ")
+        line = answer()
+        if (line == ""):
+            break
+        key, value = parse_option(line)
+        options[key] = value
+
+    prompt("\n Input image name: ")
+    image_fn = answer()
+    prompt("\n File with the PSF (default %s.psf): " % (image_fn[:-5]))
+    psf_fn = answer()
+    prompt("\n Input file (default %s.ap): " % (image_fn[:-5]))
+    ap_fn = answer()
+    prompt("\n File for results (default %s.als): " % (image_fn[:-5]))
+    als_fn = answer()
+    prompt("\n Name for subtracted image (default %ss.fits): " % (image_fn[:-5]))
+    starsub_fn = answer()
+
+    kill_fn = os.environ.get("FAKE_ALLSTAR_KILL")
+    if (kill_fn):
+        try:
+            os.remove(kill_fn)
+        except OSError:
+            pass
+        else:
+            os.kill(os.getpid(), signal.SIGKILL)
+
+    img, header = read_image(image_fn)
+    with open(psf_fn, "r") as pf:
+        fwhm = float(pf.readline().split()[1])
+    stats = read_header(ap_fn)
+    ap = read_ap_positions(ap_fn)
+
+    #
+    # Linear PSF-weighted flux for every star
+    #
+    sigma = fwhm * FWHM_TO_SIGMA
+    r = max(1, int(round(options['FI'])))
+    cube, dx, dy = stamps(img, ap[:, 1], ap[:, 2], r)
+    psf = numpy.exp(-0.5 * (dx ** 2 + dy ** 2) / sigma ** 2) / (2 * numpy.pi * sigma ** 2)
+    good = numpy.isfinite(cube)
+    net = numpy.where(good, cube - ap[:, 4][:, None, None], 0)
+    psf = numpy.where(good, psf, 0)
+    flux = numpy.sum(net * psf, axis=(1, 2)) / numpy.clip(numpy.sum(psf ** 2, axis=(1, 2)), 1e-10, None)
+
+    model = gaussian_model(img.shape, ap[:, 1], ap[:, 2], numpy.clip(flux, 0, None), fwhm)
+    residual = numpy.where(good, net - psf * flux[:, None, None], 0)
+    chi = numpy.sqrt(numpy.sum(residual ** 2, axis=(1, 2)) / numpy.clip(numpy.sum(good, axis=(1, 2)), 1, None))
+    chi /= numpy.clip(numpy.sqrt(numpy.fabs(ap[:, 4])), 1, None)
+
+    with open(als_fn, "w") as als:
+        write_header(als, 1, img.shape[1], img.shape[0], float(stats[5]), float(stats[6]),
+                     float(stats[7]), float(stats[8]), options['FI'])
+        for i in numpy.nonzero(flux > 0)[0]:
+            mag = 25. - 2.5 * numpy.log10(flux[i])
+            err = 1.0857 / numpy.sqrt(max(flux[i], 1.))
+            als.write("%7d %8.3f %8.3f %8.3f %8.4f %8.3f %8.0f %8.3f %8.3f\n" % (
+                ap[i, 0], ap[i, 1], ap[i, 2], mag, err, ap[i, 4], 3., chi[i], 0.))
+
+    pyfits.PrimaryHDU(data=(img - model).astype(numpy.float32), header=header).writeto(
+        starsub_fn, clobber=True)
+
+    prompt("\n        Finished.\n\n Good bye.\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+#
+# Stand-in for the DAOPhot executable: answers ATTACH, OPTION, SKY, FIND,
+# PHOT, PICK, PSF and EXIT with the same prompts as the real program and
+# writes COO, AP, LST, PSF and NEI files.
+#
+
+import os, sys
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import *
+
+
+class FakeDaophot( object ):
+
+    def __init__(self):
+        self.options = {'RE': 0., 'GA': 0., 'TH': 4., 'FW': 2.5, 'PS': 11., 'FI': 5.}
+        self.phot_options = {'IS': 10., 'OS': 20.}
+        self.image = None
+        self.header = None
+        self.image_fn = None
+
+    def default(self, extension):
+        return "%s.%s" % (self.image_fn[:-5], extension)
+
+    def start(self):
+        #
+        # Without a daophot.opt file we have to ask for readnoise and gain
+        #
+        prompt("\n                        READ NOISE (ADU; 1 frame) = ")
+        self.options['RE'] = float(answer() or 0)
+        prompt("\n                        GAIN (e-/ADU; 1 frame) = ")
+        self.options['GA'] = float(answer() or 0)
+        self.show_options()
+
+    def show_options(self):
+        prompt("\n READ NOISE (ADU; 1 frame) = %8.2f    GAIN (e-/ADU; 1 frame) = %8.2f\n"
+               " FWHM OF OBJECT =  %8.2f    THRESHOLD (in sigmas) = %8.2f\n" % (
+                   self.options['RE'], self.options['GA'],
+                   self.options['FW'], self.options['TH']))
+
+    def attach(self, filename):
+        self.image_fn = filename
+        self.image, self.header = read_image(filename)
+        prompt("\n\n          Picture size:  %5d %5d\n" % (self.image.shape[1], self.image.shape[0]))
+
+    def option(self):
+        prompt("\n File with parameters (default KEYBOARD INPUT): ")
+        answer()
+        self.show_options()
+        while (True):
+            prompt("\n OPT> ")
+            line = answer()
+            if (line == ""):
+                break
+            key, value = parse_option(line)
+            self.options[key] = value
+        self.show_options()
+
+    def sky(self):
+        self.sky_level, self.sky_sigma = sky_stats(self.image)
+        prompt("\n      Approximate sky value for this frame = %9.3f\n"
+               "  Standard deviation of sky brightness = %9.3f\n" % (self.sky_level, self.sky_sigma))
+
+    def write_stats(self, f, nl):
+        write_header(f, nl, self.image.shape[1], self.image.shape[0],
+                     self.options['TH'] * self.sky_sigma, self.phot_options.get('A1', 0),
+                     self.options['GA'], self.options['RE'], self.options['FI'])
+
+    def find(self):
+        prompt("\n Number of frames averaged, summed: ")
+        answer()
+        prompt("\n File for positions (default %s): " % (self.default("coo")))
+        coo_fn = answer() or self.default("coo")
+
+        x, y, height, sky = find_stars(self.image, self.options['TH'], self.options['FW'])
+        mag = -2.5 * numpy.log10(numpy.clip(height, 1e-3, None) / (self.options['TH'] * self.sky_sigma))
+        with open(coo_fn, "w") as coo:
+            self.write_stats(coo, 1)
+            for i in range(x.shape[0]):
+                coo.write("%7d %8.3f %8.3f %8.3f %8.3f %8.3f %8.3f\n" % (
+                    i + 1, x[i], y[i], mag[i], 0.6, 0.0, 0.0))
+                # FIND lists every star it finds
+                sys.stdout.write("%7d %8.3f %8.3f %8.3f\n" % (i + 1, x[i], y[i], mag[i]))
+
+        prompt("\n %d stars.\n\n                           Are you happy with this? " % (x.shape[0]))
+        answer()
+
+    def phot(self):
+        prompt("\n      File with aperture radii (default photo.opt): ")
+        answer()
+        prompt("\n Error opening input file photo.opt\n")
+        while (True):
+            prompt("\n PHO> ")
+            line = answer()
+            if (line == ""):
+                break
+            key, value = parse_option(line)
+            self.phot_options[key] = value
+
+        prompt("\n       Input position file (default %s): " % (self.default("coo")))
+        coo_fn = answer() or self.default("coo")
+        prompt("\n                Output file (default %s): " % (self.default("ap")))
+        ap_fn = answer() or self.default("ap")
+
+        coo = read_simple_catalog(coo_fn)
+        radii = [self.phot_options[k] for k in sorted(self.phot_options)
+                 if k.startswith("A") and self.phot_options[k] > 0]
+        if (not radii):
+            radii = [3.]
+        sky, sky_sigma, mags, errs = aperture_photometry(
+            self.image, coo[:, 1], coo[:, 2], radii,
+            self.phot_options['IS'], self.phot_options['OS'], self.options['GA'])
+
+        n_ap = len(radii)
+        with open(ap_fn, "w") as ap:
+            self.write_stats(ap, 2)
+            for i in range(coo.shape[0]):
+                ap.write("\n")
+                ap.write(("%7d %8.3f %8.3f" + " %8.3f" * n_ap + "\n") % (
+                    (coo[i, 0], coo[i, 1], coo[i, 2]) + tuple(mags[i])))
+                ap.write(("%14.3f %5.2f %5.2f %7.4f" + " %8.4f" * (n_ap - 1) + "\n") % (
+                    (sky[i], min(sky_sigma[i], 99.99), 0.0) + tuple(errs[i])))
+
+    def pick(self):
+        prompt("\n            Input file name (default %s): " % (self.default("ap")))
+        ap_fn = answer() or self.default("ap")
+        prompt("\n       Desired number of stars, faintest magnitude: ")
+        nstars, maglimit = [float(v) for v in answer().split(",")]
+        prompt("\n           Output file name (default %s): " % (self.default("lst")))
+        lst_fn = answer() or self.default("lst")
+
+        ap = read_ap_positions(ap_fn)
+        ap = ap[ap[:, 3] < maglimit]
+        ap = ap[numpy.argsort(ap[:, 3])][:int(nstars)]
+        with open(lst_fn, "w") as lst:
+            self.write_stats(lst, 3)
+            for row in ap:
+                lst.write("%7d %8.3f %8.3f %8.3f %8.3f\n" % tuple(row))
+        prompt("\n        %d suitable candidates were found.\n" % (ap.shape[0]))
+
+    def psf(self):
+        prompt("\n  File with aperture results (default %s): " % (self.default("ap")))
+        answer()
+        prompt("\n        File with PSF stars (default %s): " % (self.default("lst")))
+        lst_fn = answer() or self.default("lst")
+        prompt("\n           File for the PSF (default %s): " % (self.default("psf")))
+        psf_fn = answer() or self.default("psf")
+
+        lst = read_simple_catalog(lst_fn)
+        if (lst.shape[0] == 0):
+            prompt("\n Failed to converge.\n")
+            return
+
+        for row in lst:
+            prompt("\n Star %5d   x %8.2f  y %8.2f\n   Use this one? " % (row[0], row[1], row[2]))
+            answer()
+
+        #
+        # The PSF is a Gaussian with the width measured from the PSF stars
+        #
+        cube, dx, dy = stamps(self.image, lst[:, 1], lst[:, 2], int(2 * self.options['FW']) + 1)
+        weight = numpy.clip(cube - lst[:, 4][:, None, None], 0, None)
+        weight[~numpy.isfinite(weight)] = 0
+        r2 = numpy.sum(weight * (dx ** 2 + dy ** 2)) / max(numpy.sum(weight), 1e-10)
+        fwhm = numpy.sqrt(r2 / 2.) / FWHM_TO_SIGMA
+        if (not numpy.isfinite(fwhm) or fwhm <= 0):
+            fwhm = self.options['FW']
+
+        with open(psf_fn, "w") as psf:
+            psf.write("GAUSSIAN %8.3f\n" % (fwhm))
+        nei_fn = psf_fn[:-4] + ".nei"
+        with open(nei_fn, "w") as nei:
+            self.write_stats(nei, 1)
+            for row in lst:
+                nei.write("%7d %8.3f %8.3f %8.3f %8.3f\n" % tuple(row))
+
+        prompt("\n Chi = 0.0100   FWHM = %8.3f\n\n"
+               " File with PSF stars and neighbors = %s\n" % (fwhm, nei_fn))
+
+    def run(self):
+        self.start()
+        commands = {
+            'OP': self.option,
+            'SK': self.sky,
+            'FI': self.find,
+            'PH': self.phot,
+            'PI': self.pick,
+            'PS': self.psf,
+        }
+        while (True):
+            prompt("\n Command: ")
+            line = answer()
+            command = line[:2].upper()
+            if (command == "EX"):
+                break
+            elif (command == "AT"):
+                self.attach(line.split(None, 1)[1])
+            elif (command in commands):
+                commands[command]()
+            else:
+                prompt("\n Unrecognized command.\n")
+
+
+if __name__ == "__main__":
+    FakeDaophot().run()
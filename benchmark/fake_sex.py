@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+#
+# Stand-in for SExtractor, supporting just what pick_midrange asks for:
+# "sex -KEY value ... image.fits" with a PARAMETERS_NAME file and an
+# ASCII_HEAD or FITS_1.0 catalog.
+#
+
+import os, sys
+import numpy
+import pyfits
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import *
+
+
+def measure(img, threshold):
+    x, y, height, sky = find_stars(img, threshold, 2.5)
+    sky, sky_sigma = sky_stats(img)
+
+    cube, dx, dy = stamps(img, x, y, 6)
+    net = cube - sky
+    good = numpy.isfinite(net)
+    weight = numpy.where(good, numpy.clip(net, 0, None), 0)
+    total = numpy.clip(numpy.sum(weight, axis=(1, 2)), 1e-10, None)
+    sxx = numpy.sum(weight * dx ** 2, axis=(1, 2)) / total
+    syy = numpy.sum(weight * dy ** 2, axis=(1, 2)) / total
+    sxy = numpy.sum(weight * dx * dy, axis=(1, 2)) / total
+    root = numpy.sqrt(((sxx - syy) / 2.) ** 2 + sxy ** 2)
+    a = numpy.sqrt(numpy.clip((sxx + syy) / 2. + root, 0, None))
+    b = numpy.sqrt(numpy.clip((sxx + syy) / 2. - root, 0, None))
+    flux = numpy.sum(numpy.where(good, net, 0), axis=(1, 2))
+
+    columns = {
+        'NUMBER': numpy.arange(1, x.shape[0] + 1),
+        'XWIN_IMAGE': x,
+        'YWIN_IMAGE': y,
+        'FWHM_IMAGE': 2.3548 * numpy.sqrt((sxx + syy) / 2.),
+        'BACKGROUND': numpy.ones_like(x) * sky,
+        'FLAGS': numpy.where(numpy.all(good, axis=(1, 2)), 0, 1),
+        'FLUX_MAX': numpy.nanmax(net.reshape((net.shape[0], -1)), axis=1),
+        'MAG_AUTO': 26. - 2.5 * numpy.log10(numpy.clip(flux, 1e-3, None)),
+        'MAGERR_AUTO': 1.0857 * sky_sigma * 13. / numpy.clip(flux, 1e-3, None),
+        'AWIN_IMAGE': a,
+        'BWIN_IMAGE': b,
+        'THETA_IMAGE': numpy.degrees(0.5 * numpy.arctan2(2 * sxy, sxx - syy)),
+        'ELONGATION': a / numpy.clip(b, 1e-3, None),
+        'ELLIPTICITY': 1. - b / numpy.clip(a, 1e-3, None),
+        'EXT_NUMBER': numpy.ones_like(x),
+    }
+    return columns
+
+
+def main(args):
+
+    config = {}
+    i = 0
+    image_fn = None
+    while (i < len(args)):
+        if (args[i].startswith("-")):
+            config[args[i][1:].strip()] = args[i + 1]
+            i += 2
+        else:
+            image_fn = args[i]
+            i += 1
+
+    with open(config.get('PARAMETERS_NAME', 'default.param'), "r") as pf:
+        fields = [l.strip() for l in pf.readlines() if l.strip()]
+
+    img, header = read_image(image_fn)
+    columns = measure(img, float(config.get('DETECT_THRESH', 1.5)) * 3)
+    n = columns['NUMBER'].shape[0]
+    data = [columns.get(f, numpy.zeros(n)) for f in fields]
+
+    catalog_fn = config.get('CATALOG_NAME', 'test.cat')
+    catalog_type = config.get('CATALOG_TYPE', 'ASCII_HEAD')
+    if (catalog_type == "ASCII_HEAD"):
+        with open(catalog_fn, "w") as cat:
+            for i, f in enumerate(fields):
+                cat.write("# %3d %-20s\n" % (i + 1, f))
+            numpy.savetxt(cat, numpy.array(data).T, fmt="%.6g")
+    elif (catalog_type == "FITS_1.0"):
+        cols = [pyfits.Column(name=f, format='J' if f in ['NUMBER', 'FLAGS', 'EXT_NUMBER'] else 'E',
+                              array=d) for f, d in zip(fields, data)]
+        pyfits.HDUList([pyfits.PrimaryHDU(),
+                        pyfits.BinTableHDU.from_columns(pyfits.ColDefs(cols))]).writeto(
+            catalog_fn, clobber=True)
+    else:
+        sys.stderr.write("unsupported CATALOG_TYPE %s\n" % (catalog_type))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,190 @@
+#
+# Shared helpers for the stand-in daophot/allstar/sex executables used by
+# the benchmark. They do not try to be good photometry codes; they just
+# speak the same dialogue as the real programs and write catalogs and images
+# of the right shape and size in a comparable amount of time.
+#
+
+import os, sys
+import numpy
+import pyfits
+import scipy.ndimage
+
+numpy.seterr(all='ignore')
+
+FWHM_TO_SIGMA = 1. / (2. * numpy.sqrt(2. * numpy.log(2.)))
+
+
+def prompt(text):
+    # prompts end without a newline, just like in the Fortran programs
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+
+def answer():
+    line = sys.stdin.readline()
+    if (line == ""):
+        # our caller went away
+        sys.exit(1)
+    return line.strip()
+
+
+def parse_option(line):
+    #
+    # "key = value" as sent by the wrapper; only the first two characters
+    # of the key count, just like in DAOPhot
+    #
+    key, value = line.split("=", 1)
+    return key.strip()[:2].upper(), float(value)
+
+
+def read_image(filename):
+    hdulist = pyfits.open(filename)
+    img = hdulist[0].data.astype(numpy.float64)
+    header = hdulist[0].header
+    hdulist.close()
+    return img, header
+
+
+def sky_stats(img):
+    good = img[numpy.isfinite(img)]
+    median = numpy.median(good)
+    sigma = 1.4826 * numpy.median(numpy.fabs(good - median))
+    return median, sigma
+
+
+def stamps(img, x, y, r):
+    #
+    # (n, 2r+1, 2r+1) cube of pixels around the (1-based) positions, NaN
+    # outside the image, plus the pixel offsets from the stamp centre
+    #
+    cx = numpy.round(x - 1).astype(numpy.int)
+    cy = numpy.round(y - 1).astype(numpy.int)
+    d = numpy.arange(-r, r + 1)
+    iy = cy[:, None] + d[None, :]
+    ix = cx[:, None] + d[None, :]
+    valid = ((iy >= 0) & (iy < img.shape[0]))[:, :, None] & \
+            ((ix >= 0) & (ix < img.shape[1]))[:, None, :]
+    cube = img[numpy.clip(iy, 0, img.shape[0] - 1)[:, :, None],
+               numpy.clip(ix, 0, img.shape[1] - 1)[:, None, :]]
+    cube[~valid] = numpy.NaN
+    dy = (iy - (y - 1)[:, None])[:, :, None] * numpy.ones((1, 1, d.shape[0]))
+    dx = (ix - (x - 1)[:, None])[:, None, :] * numpy.ones((1, d.shape[0], 1))
+    return cube, dx, dy
+
+
+def find_stars(img, threshold, fwhm):
+    #
+    # Peaks in the smoothed image above threshold sigma, with centroids
+    # refined from the first moments
+    #
+    sky, _ = sky_stats(img)
+    filled = numpy.where(numpy.isfinite(img), img, sky)
+    smoothed = scipy.ndimage.gaussian_filter(filled, sigma=fwhm * FWHM_TO_SIGMA)
+    smooth_sky, smooth_sigma = sky_stats(smoothed)
+
+    size = max(3, int(fwhm * 1.5) | 1)
+    peaks = (smoothed == scipy.ndimage.maximum_filter(smoothed, size=size)) & \
+            (smoothed > smooth_sky + threshold * smooth_sigma)
+    y, x = numpy.nonzero(peaks)
+    x = x + 1.
+    y = y + 1.
+
+    r = max(1, int(fwhm))
+    cube, dx, dy = stamps(filled, x, y, r)
+    weight = numpy.clip(cube - sky, 0, None)
+    weight[~numpy.isfinite(weight)] = 0
+    total = numpy.sum(weight, axis=(1, 2))
+    ok = total > 0
+    x[ok] += numpy.sum(weight * dx, axis=(1, 2))[ok] / total[ok]
+    y[ok] += numpy.sum(weight * dy, axis=(1, 2))[ok] / total[ok]
+
+    height = smoothed[peaks] - smooth_sky
+    return x, y, height, sky
+
+
+def aperture_photometry(img, x, y, radii, r_in, r_out, gain):
+    #
+    # Sky from the median in the annulus, magnitudes (zeropoint 25) and
+    # errors in all apertures
+    #
+    r_max = int(numpy.ceil(max(max(radii), r_out)))
+    cube, dx, dy = stamps(img, x, y, r_max)
+    dist = numpy.hypot(dx, dy)
+
+    annulus = (dist >= r_in) & (dist <= r_out) & numpy.isfinite(cube)
+    sky_pixels = numpy.where(annulus, cube, numpy.NaN).reshape((cube.shape[0], -1))
+    sky = numpy.nanmedian(sky_pixels, axis=1)
+    sky_sigma = numpy.nanstd(sky_pixels, axis=1)
+    sky[~numpy.isfinite(sky)] = 0
+    sky_sigma[~numpy.isfinite(sky_sigma)] = 0
+
+    mags = numpy.empty((x.shape[0], len(radii)))
+    errs = numpy.empty((x.shape[0], len(radii)))
+    net = cube - sky[:, None, None]
+    for i, radius in enumerate(radii):
+        inside = (dist <= radius) & numpy.isfinite(cube)
+        flux = numpy.sum(numpy.where(inside, net, 0), axis=(1, 2))
+        area = numpy.sum(inside, axis=(1, 2))
+        variance = numpy.clip(flux, 0, None) / gain + area * sky_sigma ** 2
+        good = flux > 0
+        mags[:, i] = 99.999
+        errs[:, i] = 9.9999
+        mags[good, i] = 25. - 2.5 * numpy.log10(flux[good])
+        errs[good, i] = numpy.clip(1.0857 * numpy.sqrt(variance[good]) / flux[good], 0, 9.9999)
+    return sky, sky_sigma, mags, errs
+
+
+def gaussian_model(shape, x, y, flux, fwhm):
+    #
+    # Image of Gaussian stars with the given total fluxes
+    #
+    sigma = fwhm * FWHM_TO_SIGMA
+    r = int(numpy.ceil(4 * sigma))
+    model = numpy.zeros(shape)
+    d = numpy.arange(-r, r + 1)
+    for _x, _y, _f in zip(x - 1, y - 1, flux):
+        cx, cy = int(round(_x)), int(round(_y))
+        x0, x1 = max(0, cx - r), min(shape[1], cx + r + 1)
+        y0, y1 = max(0, cy - r), min(shape[0], cy + r + 1)
+        if (x1 <= x0 or y1 <= y0):
+            continue
+        gx = numpy.exp(-0.5 * ((numpy.arange(x0, x1) - _x) / sigma) ** 2)
+        gy = numpy.exp(-0.5 * ((numpy.arange(y0, y1) - _y) / sigma) ** 2)
+        model[y0:y1, x0:x1] += _f / (2 * numpy.pi * sigma ** 2) * gy[:, None] * gx[None, :]
+    return model
+
+
+def write_header(f, nl, nx, ny, thresh, ap1, gain, readnoise, fitrad):
+    f.write(" NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD\n")
+    f.write("%3d %5d %5d %7.1f %7.1f %7.3f %7.3f %7.3f %7.3f %7.3f\n" % (
+        nl, nx, ny, -100., 60000., thresh, ap1, gain, readnoise, fitrad))
+    f.write("\n")
+
+
+def read_header(filename):
+    with open(filename, "r") as f:
+        f.readline()
+        stats = f.readline().split()
+    return stats
+
+
+def read_simple_catalog(filename):
+    # COO/LST/ALS: one star per line after the 3 header lines
+    data = numpy.loadtxt(filename, skiprows=3, ndmin=2)
+    return data
+
+
+def read_ap_positions(filename):
+    #
+    # ID, X, Y, first magnitude and sky of every star in an AP file
+    #
+    with open(filename, "r") as f:
+        lines = f.readlines()[3:]
+    rows = []
+    for i in range(0, len(lines) - 2, 3):
+        line1 = lines[i + 1].split()
+        line2 = lines[i + 2].split()
+        rows.append([float(line1[0]), float(line1[1]), float(line1[2]),
+                     float(line1[3]), float(line2[0])])
+    return numpy.array(rows).reshape((-1, 5))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+#
+# Generate a synthetic star field: Gaussian stars with a power-law
+# distribution of fluxes on a flat sky, with Poisson and read noise.
+#
+
+import os, sys
+import numpy
+import pyfits
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import gaussian_model
+
+
+def make_starfield(filename,
+                   nx=1024, ny=1024,
+                   n_stars=500,
+                   fwhm=3.0,
+                   sky=1000.,
+                   gain=2.0,
+                   readnoise=5.0,
+                   min_flux=500.,
+                   max_flux=500000.,
+                   seed=None):
+
+    rng = numpy.random.RandomState(seed)
+
+    #
+    # Stars in the image (keep clear of the very edge), with number counts
+    # rising towards fainter fluxes
+    #
+    x = rng.uniform(3, nx - 2, n_stars)
+    y = rng.uniform(3, ny - 2, n_stars)
+    log_flux = numpy.log10(min_flux) + (numpy.log10(max_flux) - numpy.log10(min_flux)) * \
+        (1. - numpy.sqrt(rng.uniform(0, 1, n_stars)))
+    flux = 10. ** log_flux
+
+    img = gaussian_model((ny, nx), x, y, flux, fwhm) + sky
+
+    # photon noise in electrons, plus read noise
+    img = rng.poisson(numpy.clip(img * gain, 0, None)) / gain + \
+        rng.normal(0, readnoise / gain, img.shape)
+
+    hdu = pyfits.PrimaryHDU(data=img.astype(numpy.float32))
+    hdu.header['GAIN'] = (gain, "e-/ADU")
+    hdu.header['RDNOISE'] = (readnoise, "e-")
+    hdu.header['SKYLEVEL'] = (sky, "ADU")
+    hdu.header['FWHM'] = (fwhm, "pixels")
+    hdu.header['NSTARS'] = (n_stars, "number of stars injected")
+    if (os.path.isfile(filename)):
+        os.remove(filename)
+    hdu.writeto(filename, clobber=True)
+
+    return numpy.array([x, y, flux]).T
+
+
+if __name__ == "__main__":
+
+    parser = OptionParser(usage="%prog [options] output.fits")
+    parser.add_option("", "--size", dest="size", default="1024x1024", type=str,
+                      help="image size, NXxNY")
+    parser.add_option("-n", "--stars", dest="n_stars", default=500, type=int,
+                      help="number of stars")
+    parser.add_option("", "--fwhm", dest="fwhm", default=3.0, type=float,
+                      help="PSF FWHM in pixels")
+    parser.add_option("", "--sky", dest="sky", default=1000., type=float,
+                      help="sky level in ADU")
+    parser.add_option("", "--gain", dest="gain", default=2.0, type=float)
+    parser.add_option("", "--readnoise", dest="readnoise", default=5.0, type=float)
+    parser.add_option("", "--seed", dest="seed", default=None, type=int)
+    (options, cmdline_args) = parser.parse_args()
+
+    nx, ny = [int(s) for s in options.size.lower().split("x")]
+    for fn in cmdline_args:
+        make_starfield(fn, nx=nx, ny=ny,
+                       n_stars=options.n_stars,
+                       fwhm=options.fwhm,
+                       sky=options.sky,
+                       gain=options.gain,
+                       readnoise=options.readnoise,
+                       seed=options.seed)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+#
+# Benchmark the wrapper without the real DAOPhot/ALLSTAR/SExtractor: run
+# Daophot.auto() on synthetic frames of growing size and star count using
+# the stand-in executables in this directory, and time the python
+# post-processing stages (APfile, ALSfile, verify_real_star,
+# write_final_results) on the files of that run.
+#
+# Results can be saved as JSON (--json) and compared against an earlier
+# run (--compare) to catch performance regressions.
+#
+
+import os, sys
+import time
+import json
+import shutil
+import tempfile
+import logging
+
+from optparse import OptionParser
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, benchmark_dir)
+sys.path.insert(1, os.path.dirname(benchmark_dir))
+
+from make_starfield import make_starfield
+
+logger = logging.getLogger("daophot_benchmark")
+
+
+def setup_environment(workdir):
+    #
+    # Put shims for the stand-in executables first on the PATH (sex is
+    # found via the PATH, daophot and allstar via dao_dir), and provide a
+    # sitesetup pointing to them if there is none
+    #
+    bin_dir = os.path.join(workdir, "bin")
+    os.mkdir(bin_dir)
+    for exe, script in [("daophot", "fake_daophot.py"),
+                        ("allstar", "fake_allstar.py"),
+                        ("sex", "fake_sex.py")]:
+        shim_fn = os.path.join(bin_dir, exe)
+        with open(shim_fn, "w") as shim:
+            shim.write("#!/bin/sh\nexec %s -u %s \"$@\"\n" % (
+                sys.executable, os.path.join(benchmark_dir, script)))
+        os.chmod(shim_fn, 0755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', "")
+
+    try:
+        import sitesetup
+    except ImportError:
+        with open(os.path.join(workdir, "sitesetup.py"), "w") as ss:
+            ss.write("dao_dir = %r\nscratch_dir = %r\n" % (bin_dir, workdir))
+        sys.path.insert(0, workdir)
+
+    return bin_dir
+
+
+def best_of(func, repeat):
+    times = []
+    for i in range(repeat):
+        start_time = time.time()
+        func()
+        times.append(time.time() - start_time)
+    return min(times)
+
+
+def benchmark_frame(fn, bin_dir, workdir, repeat=3):
+
+    import daophot_wrapper
+
+    class KeepFilesDaophot( daophot_wrapper.Daophot ):
+        # keep all intermediate files around until we timed the post-processing
+        def cleanup(self, failed=False):
+            pass
+
+    dao = KeepFilesDaophot()
+    dao.dao_dir = bin_dir
+    dao.scratch_dir = workdir
+    dao.gain = 2.0
+    dao.readnoise = 5.0
+    dao.write_timing = False
+    dao.load(fn)
+    dao.set_output(fn[:-5] + ".dao.fits")
+
+    # CPU time spent in this process is the overhead of the wrapper itself
+    start_times = os.times()
+    start_wall = time.time()
+    dao.auto()
+    end_times = os.times()
+
+    result = {
+        'filename': os.path.basename(fn),
+        'auto_wall': time.time() - start_wall,
+        'wrapper_cpu': (end_times[0] - start_times[0]) + (end_times[1] - start_times[1]),
+        'stages': dict([(s['name'], s['wall']) for s in dao.profile.stages]),
+        'stars': dict([(s['name'], s['stars']) for s in dao.profile.stages
+                       if s['stars'] is not None]),
+        'post': {},
+    }
+
+    try:
+        if (dao.allstar is None):
+            logger.warning("%s: no ALLSTAR results, skipping post-processing" % (fn))
+            return result
+
+        ap_fn = dao.dao.files['ap']
+        als_fn = dao.allstar.files['als']
+        out_fn = os.path.join(workdir, "bench_output.fits")
+
+        result['post']['APfile'] = best_of(lambda: daophot_wrapper.APfile(ap_fn), repeat)
+        result['post']['ALSfile'] = best_of(lambda: daophot_wrapper.ALSfile(als_fn), repeat)
+        result['post']['verify_real_star'] = best_of(dao.allstar.verify_real_star, repeat)
+        result['post']['write_final_results'] = best_of(
+            lambda: dao.write_final_results(out_fn=out_fn), repeat)
+        if (os.path.isfile(out_fn)):
+            os.remove(out_fn)
+    finally:
+        daophot_wrapper.Daophot.cleanup(dao)
+
+    return result
+
+
+def compare(results, baseline, tolerance):
+    #
+    # Report all timings that got slower than the baseline by more than the
+    # given fraction; returns the number of regressions
+    #
+    reference = dict([((r['size'], r['n_stars']), r) for r in baseline])
+    n_regressions = 0
+    for r in results:
+        ref = reference.get((r['size'], r['n_stars']))
+        if (ref is None):
+            continue
+        timings = [('auto_wall', r['auto_wall'], ref['auto_wall']),
+                   ('wrapper_cpu', r['wrapper_cpu'], ref['wrapper_cpu'])]
+        for key in r['post']:
+            if (key in ref['post']):
+                timings.append((key, r['post'][key], ref['post'][key]))
+        for name, now, before in timings:
+            if (before > 0 and now > before * (1. + tolerance)):
+                print("REGRESSION %-9s %6d stars %-20s %8.3f s -> %8.3f s (%+.0f%%)" % (
+                    r['size'], r['n_stars'], name, before, now, 100. * (now / before - 1)))
+                n_regressions += 1
+    return n_regressions
+
+
+def print_table(results):
+    post_keys = ['APfile', 'ALSfile', 'verify_real_star', 'write_final_results']
+    print("%-9s %6s %6s %9s %9s %s" % (
+        "size", "stars", "found", "auto[s]", "wrap[s]",
+        " ".join(["%19s" % k for k in post_keys])))
+    for r in results:
+        print("%-9s %6d %6s %9.3f %9.3f %s" % (
+            r['size'], r['n_stars'], r['stars'].get('find', "-"),
+            r['auto_wall'], r['wrapper_cpu'],
+            " ".join(["%19.4f" % r['post'][k] if k in r['post'] else "%19s" % "-"
+                      for k in post_keys])))
+
+
+def main():
+
+    parser = OptionParser()
+    parser.add_option("", "--sizes", dest="sizes", default="512x512,1024x1024,2048x2048",
+                      help="comma-separated list of frame sizes", type=str)
+    parser.add_option("", "--stars", dest="stars", default="200,1000,5000",
+                      help="comma-separated list of star counts", type=str)
+    parser.add_option("", "--fwhm", dest="fwhm", default=3.0, type=float)
+    parser.add_option("", "--sky", dest="sky", default=1000., type=float)
+    parser.add_option("", "--repeat", dest="repeat", default=3, type=int,
+                      help="repetitions of each post-processing timing (best is reported)")
+    parser.add_option("", "--json", dest="json_fn", default=None, type=str,
+                      help="save the results to this file")
+    parser.add_option("", "--compare", dest="baseline_fn", default=None, type=str,
+                      help="compare against results saved earlier with --json")
+    parser.add_option("", "--tolerance", dest="tolerance", default=0.2, type=float,
+                      help="allowed slow-down relative to the baseline")
+    parser.add_option("", "--keep", dest="keep", action="store_true", default=False,
+                      help="keep the working directory")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False)
+    (options, cmdline_args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.WARNING)
+
+    workdir = tempfile.mkdtemp(prefix="daobench_")
+    cwd = os.getcwd()
+    results = []
+    try:
+        bin_dir = setup_environment(workdir)
+        # keep anything written to the current directory out of the way
+        os.chdir(workdir)
+
+        for size in options.sizes.split(","):
+            nx, ny = [int(s) for s in size.lower().split("x")]
+            for n_stars in [int(n) for n in options.stars.split(",")]:
+                fn = os.path.join(workdir, "field_%s_%d.fits" % (size, n_stars))
+                make_starfield(fn, nx=nx, ny=ny, n_stars=n_stars,
+                               fwhm=options.fwhm, sky=options.sky, seed=42)
+                result = benchmark_frame(fn, bin_dir, workdir, repeat=options.repeat)
+                result['size'] = size
+                result['n_stars'] = n_stars
+                results.append(result)
+                os.remove(fn)
+    finally:
+        os.chdir(cwd)
+        if (not options.keep):
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_table(results)
+
+    if (options.json_fn is not None):
+        with open(options.json_fn, "w") as jf:
+            json.dump(results, jf, indent=2)
+
+    if (options.baseline_fn is not None):
+        with open(options.baseline_fn, "r") as bf:
+            baseline = json.load(bf)
+        if (compare(results, baseline, options.tolerance) > 0):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+#
+# Check (and time) resuming a mosaic after a failure: run Daophot.auto()
+# with checkpoints on a synthetic multi-extension frame, kill ALLSTAR in
+# one of the extensions, and run it again. The first run has to fail
+# without writing an output and keep all checkpoints; the second one has
+# to finish, running ALLSTAR again only in the extension that was killed.
+#
+
+import os, sys
+import time
+import shutil
+import tempfile
+import logging
+
+from optparse import OptionParser
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, benchmark_dir)
+sys.path.insert(1, os.path.dirname(benchmark_dir))
+
+import pyfits
+
+from make_starfield import make_starfield
+from run_benchmark import setup_environment
+
+logger = logging.getLogger("daophot_resume")
+
+
+def make_mosaic(fn, workdir, n_extensions, nx, ny, n_stars, fwhm, sky):
+    hdus = [pyfits.PrimaryHDU()]
+    for i in range(n_extensions):
+        ext_fn = os.path.join(workdir, "ext%d.fits" % (i))
+        make_starfield(ext_fn, nx=nx, ny=ny, n_stars=n_stars,
+                       fwhm=fwhm, sky=sky, seed=42 + i)
+        data = pyfits.getdata(ext_fn)
+        header = pyfits.getheader(ext_fn)
+        hdu = pyfits.ImageHDU(data=data, name="OTA%d" % (i))
+        for key in ['GAIN', 'RDNOISE']:
+            hdu.header[key] = header[key]
+        hdus.append(hdu)
+        os.remove(ext_fn)
+    pyfits.HDUList(hdus).writeto(fn, clobber=True)
+
+
+def run(fn, bin_dir, checkpoint_dir):
+
+    import daophot_wrapper
+
+    dao = daophot_wrapper.Daophot()
+    dao.dao_dir = bin_dir
+    dao.checkpoint_dir = checkpoint_dir
+    dao.write_timing = False
+    dao.load(fn)
+    dao.set_output(fn[:-5] + ".dao.fits")
+
+    start_wall = time.time()
+    error = None
+    try:
+        dao.auto()
+    except Exception as e:
+        error = e
+    wall = time.time() - start_wall
+
+    ran_allstar = [ext_dao.filename for ext_dao in dao.extension_daophots
+                   if ("allstar" in [s['name'] for s in ext_dao.profile.stages])]
+    return dao, error, wall, ran_allstar
+
+
+def main():
+
+    parser = OptionParser()
+    parser.add_option("", "--extensions", dest="n_extensions", default=4, type=int)
+    parser.add_option("", "--size", dest="size", default="1024x1024", type=str,
+                      help="size of every extension, NXxNY")
+    parser.add_option("", "--stars", dest="n_stars", default=1000, type=int,
+                      help="number of stars in every extension")
+    parser.add_option("", "--fwhm", dest="fwhm", default=3.0, type=float)
+    parser.add_option("", "--sky", dest="sky", default=1000., type=float)
+    parser.add_option("", "--keep", dest="keep", action="store_true", default=False,
+                      help="keep the working directory")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False)
+    (options, cmdline_args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.ERROR)
+
+    workdir = tempfile.mkdtemp(prefix="daoresume_")
+    cwd = os.getcwd()
+    problems = []
+    try:
+        bin_dir = setup_environment(workdir)
+        os.chdir(workdir)
+
+        nx, ny = [int(s) for s in options.size.lower().split("x")]
+        fn = os.path.join(workdir, "mosaic.fits")
+        make_mosaic(fn, workdir, options.n_extensions, nx, ny,
+                    options.n_stars, options.fwhm, options.sky)
+        checkpoint_dir = os.path.join(workdir, "checkpoints")
+        os.mkdir(checkpoint_dir)
+
+        # the first ALLSTAR to find this file gets killed
+        kill_fn = os.path.join(workdir, "kill_allstar")
+        open(kill_fn, "w").close()
+        os.environ['FAKE_ALLSTAR_KILL'] = kill_fn
+
+        dao, error, wall, ran_allstar = run(fn, bin_dir, checkpoint_dir)
+        print("first run:  %8.3f s, %d ALLSTAR runs, %s" % (
+            wall, len(ran_allstar), "failed: %s" % (error) if error else "succeeded"))
+        if (os.path.isfile(kill_fn)):
+            problems.append("ALLSTAR was never killed")
+        if (error is None):
+            problems.append("the first run did not fail")
+        if (os.path.isfile(dao.output_filename)):
+            problems.append("the first run wrote %s" % (dao.output_filename))
+        checkpoints = []
+        for dirpath, dirnames, filenames in os.walk(checkpoint_dir):
+            checkpoints.extend([f for f in filenames if f == "checkpoint.json"])
+        if (len(checkpoints) < options.n_extensions):
+            problems.append("only %d of %d extension checkpoints were kept" % (
+                len(checkpoints), options.n_extensions))
+
+        dao, error, wall, ran_allstar = run(fn, bin_dir, checkpoint_dir)
+        print("second run: %8.3f s, %d ALLSTAR runs, %s" % (
+            wall, len(ran_allstar), "failed: %s" % (error) if error else "succeeded"))
+        if (error is not None):
+            problems.append("the second run failed")
+        elif (not os.path.isfile(dao.output_filename)):
+            problems.append("the second run wrote no output")
+        else:
+            hdulist = pyfits.open(dao.output_filename)
+            n_als = len([hdu for hdu in hdulist if hdu.name == "ALS"])
+            hdulist.close()
+            if (n_als != options.n_extensions):
+                problems.append("the output has ALS tables for %d of %d extensions" % (
+                    n_als, options.n_extensions))
+        if (len(ran_allstar) != 1):
+            problems.append("the second run ran ALLSTAR in %d extensions instead of 1" % (
+                len(ran_allstar)))
+    finally:
+        os.chdir(cwd)
+        if (not options.keep):
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for problem in problems:
+        print("PROBLEM: %s" % (problem))
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+
+#
+# Run the full DAOPhot/ALLSTAR chain (Daophot.auto) on many frames at once,
+# spread across a pool of worker processes. Every frame runs in its own
+# workspace, frames with existing output are skipped, and a summary of all
+# successes and failures is reported at the end.
+#
+
+import os, sys
+import glob
+import time
+import json
+import traceback
+import logging
+import multiprocessing
+
+from optparse import OptionParser
+
+import pyfits
+import numpy
+
+import daophot_wrapper
+import sitesetup
+
+logger = logging.getLogger("daophot_batch")
+logger.addHandler(logging.NullHandler())
+
+
+def setup_sdss(dao, filename, hdulist):
+    #
+    # SDSS frames are calibrated in nanomaggies and sky-subtracted; undo both
+    # so DAOPhot sees counts including the sky background
+    #
+    dao.prescale = 1. / hdulist[0].header['NMGY']
+    dao.add_sky = numpy.mean(hdulist[2].data.field('ALLSKY'))
+    dao.gain = 3
+    dao.readnoise = 10
+    dao.phot_params['IS'] = 20
+    dao.phot_params['OS'] = 25
+    dao.fitting_radius = 5
+    dao.psf_width = 25
+
+presets = {
+    'sdss': setup_sdss,
+}
+
+
+def output_filename(filename, suffix=".dao.fits"):
+    return filename[:-5] + suffix
+
+
+def expand_frames(args):
+    #
+    # Accept plain filenames, glob patterns, and @file lists (one frame per
+    # line); keep the order but drop duplicates
+    #
+    frames = []
+    for arg in args:
+        if (arg.startswith("@")):
+            with open(arg[1:], "r") as lf:
+                candidates = [l.strip() for l in lf.readlines()]
+            candidates = [c for c in candidates if c and not c.startswith("#")]
+        elif (glob.has_magic(arg)):
+            candidates = sorted(glob.glob(arg))
+        else:
+            candidates = [arg]
+
+        for fn in candidates:
+            fn = os.path.abspath(fn)
+            if (fn not in frames):
+                frames.append(fn)
+    return frames
+
+
+def apply_params(dao, params):
+    #
+    # Set Daophot attributes by name; keys like phot_params.IS address
+    # entries in one of the parameter dictionaries
+    #
+    for key, value in params.iteritems():
+        if ("." in key):
+            dict_name, dict_key = key.split(".", 1)
+            getattr(dao, dict_name)[dict_key] = value
+        else:
+            if (not hasattr(dao, key)):
+                raise ValueError("Unknown Daophot parameter: %s" % (key))
+            setattr(dao, key, value)
+
+
+#
+# Each worker process keeps its DAOPhot session alive between frames
+#
+_dao_pool = None
+
+def get_dao_pool(workdir):
+    global _dao_pool
+    if (_dao_pool is None):
+        _dao_pool = daophot_wrapper.DAOPHOTPool(size=1, workdir=workdir)
+    return _dao_pool
+
+
+def process_frame(job):
+    #
+    # Worker function: run one frame (in a workspace of its own, see
+    # daophot_wrapper.Workspace) and return a small result record; never
+    # raises
+    #
+    result = {
+        'filename': job['filename'],
+        'output': job['output'],
+        'status': 'failed',
+        'error': None,
+        'elapsed': 0.,
+    }
+
+    start_time = time.time()
+    dao = None
+    try:
+        dao = daophot_wrapper.Daophot()
+        dao.scratch_dir = job['scratch_dir']
+        dao.keep_failed = job['keep_failed']
+        dao.transcript_dir = job['transcript_dir']
+        dao.checkpoint_dir = job['checkpoint_dir']
+        if (job['warm']):
+            dao.dao_pool = get_dao_pool(job['scratch_dir'])
+        if (job['psf_cache'] is not None):
+            dao.psf_cache = daophot_wrapper.PSFCache(job['psf_cache'])
+            if (job['psf_cache_keys'] is not None):
+                dao.psf_cache.detector_keys = job['psf_cache_keys']
+
+        if (job['preset'] is not None):
+            hdulist = pyfits.open(job['filename'])
+            presets[job['preset']](dao, job['filename'], hdulist)
+            hdulist.close()
+        apply_params(dao, job['params'])
+
+        dao.load(job['filename'])
+        dao.set_output(job['output'])
+        dao.auto(remove_nonstars=job['remove_nonstars'],
+                 dao_intermediate_fn=job['intermediate'])
+
+        if (os.path.isfile(job['output'])):
+            result['status'] = 'done'
+        else:
+            result['error'] = "no output written (PSF fit did not converge?)"
+    except Exception:
+        result['error'] = traceback.format_exc()
+        if (dao is not None and dao.transcript is not None):
+            result['error'] += "\nLast DAOPhot/ALLSTAR output:\n" + dao.transcript.tail(4096)
+        if (dao is not None):
+            try:
+                dao.cleanup(failed=True)
+                if (dao.workspace is not None):
+                    result['workspace'] = dao.workspace.path
+                # a session that failed mid-dialogue must not go back to the pool
+                if (dao.dao is not None):
+                    dao.dao.exit()
+            except Exception:
+                pass
+
+    result['elapsed'] = time.time() - start_time
+    return result
+
+
+def run_batch(frames,
+              workers=1,
+              preset=None,
+              params=None,
+              overrides=None,
+              redo=False,
+              remove_nonstars=True,
+              intermediate=False,
+              keep_failed=False,
+              scratch_dir=None,
+              summary_fn=None,
+              warm=True,
+              transcript_dir=None,
+              psf_cache=None,
+              psf_cache_keys=None,
+              checkpoint_dir=None,
+              ):
+
+    if (params is None):
+        params = {}
+    if (overrides is None):
+        overrides = {}
+    if (scratch_dir is None):
+        scratch_dir = sitesetup.scratch_dir
+
+    #
+    # Assemble the list of jobs, skipping all frames that are already done
+    #
+    results = []
+    jobs = []
+    for fn in frames:
+        out_fn = output_filename(fn)
+        if (os.path.isfile(out_fn) and not redo):
+            logger.info("already done with frame %s --> %s" % (fn, out_fn))
+            results.append({'filename': fn, 'output': out_fn,
+                            'status': 'skipped', 'error': None, 'elapsed': 0.})
+            continue
+
+        frame_params = dict(params)
+        frame_params.update(overrides.get(os.path.basename(fn), {}))
+        frame_params.update(overrides.get(fn, {}))
+
+        jobs.append({
+            'filename': fn,
+            'output': out_fn,
+            'preset': preset,
+            'params': frame_params,
+            'remove_nonstars': remove_nonstars,
+            'intermediate': output_filename(fn, ".daoraw.fits") if intermediate else None,
+            'keep_failed': keep_failed,
+            'scratch_dir': scratch_dir,
+            'warm': warm,
+            'transcript_dir': transcript_dir,
+            'psf_cache': psf_cache,
+            'psf_cache_keys': psf_cache_keys,
+            'checkpoint_dir': checkpoint_dir,
+        })
+
+    logger.info("Processing %d frames (%d already done) with %d workers" % (
+        len(jobs), len(results), workers))
+
+    if (workers <= 1 or len(jobs) <= 1):
+        results_iter = (process_frame(job) for job in jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes=workers)
+        results_iter = pool.imap_unordered(process_frame, jobs)
+
+    for result in results_iter:
+        results.append(result)
+        logger.info("%s: %s (%.1f s)" % (result['status'].upper(), result['filename'], result['elapsed']))
+
+    if (pool is not None):
+        pool.close()
+        pool.join()
+
+    #
+    # Report what went wrong
+    #
+    failed = [r for r in results if r['status'] == 'failed']
+    logger.info("Batch complete: %d done, %d skipped, %d failed" % (
+        len([r for r in results if r['status'] == 'done']),
+        len([r for r in results if r['status'] == 'skipped']),
+        len(failed)))
+    for r in failed:
+        logger.error("FAILED: %s\n%s" % (r['filename'], r['error']))
+
+    if (summary_fn is not None):
+        with open(summary_fn, "w") as sf:
+            json.dump(results, sf, indent=2)
+
+    return results
+
+
+def parse_value(value):
+    for _type in [int, float]:
+        try:
+            return _type(value)
+        except ValueError:
+            pass
+    return value
+
+
+def main(args=None):
+
+    parser = OptionParser(usage="%prog [options] frame.fits|'*.fits'|@list ...")
+    parser.add_option("-j", "--workers", dest="workers",
+                      help="number of frames to process in parallel",
+                      default=multiprocessing.cpu_count(), type=int)
+    parser.add_option("", "--preset", dest="preset",
+                      help="per-frame setup derived from the header (%s)" % (", ".join(presets)),
+                      default=None, type=str)
+    parser.add_option("-p", "--param", dest="params", action="append",
+                      help="Daophot parameter for all frames, e.g. gain=3 or phot_params.IS=20",
+                      default=[])
+    parser.add_option("", "--overrides", dest="overrides",
+                      help="JSON file with per-frame parameters: {\"frame.fits\": {\"gain\": 2}}",
+                      default=None, type=str)
+    parser.add_option("", "--redo", dest="redo", action="store_true",
+                      help="re-process frames that already have output",
+                      default=False)
+    parser.add_option("", "--keep-nonstars", dest="remove_nonstars", action="store_false",
+                      help="do not re-run ALLSTAR without the sources failing verification",
+                      default=True)
+    parser.add_option("", "--intermediate", dest="intermediate", action="store_true",
+                      help="also write the first-pass ALLSTAR results (.daoraw.fits)",
+                      default=False)
+    parser.add_option("", "--keep-failed", dest="keep_failed", action="store_true",
+                      help="keep the workspace of failed frames",
+                      default=False)
+    parser.add_option("", "--scratch", dest="scratch_dir",
+                      help="directory for per-frame workspaces (if /dev/shm is too small)",
+                      default=sitesetup.scratch_dir, type=str)
+    parser.add_option("", "--cold", dest="warm", action="store_false",
+                      help="start a new DAOPhot process for every frame",
+                      default=True)
+    parser.add_option("", "--transcripts", dest="transcript_dir",
+                      help="save the full DAOPhot/ALLSTAR dialogue of each frame in this directory",
+                      default=None, type=str)
+    parser.add_option("", "--psf-cache", dest="psf_cache",
+                      help="re-use PSF models of similar frames (same detector, filter, night) kept in this directory",
+                      default=None, type=str)
+    parser.add_option("", "--psf-cache-keys", dest="psf_cache_keys",
+                      help="header keywords (comma-separated) telling apart the detectors of one instrument in the PSF cache (default: EXTNAME,CAMCOL,CCDNUM)",
+                      default=None, type=str)
+    parser.add_option("", "--checkpoints", dest="checkpoint_dir",
+                      help="keep per-frame workspaces with a stage manifest here, so re-runs resume after failures",
+                      default=None, type=str)
+    parser.add_option("-v", "--verbose", dest="verbose", action="count",
+                      help="report progress (-v) and all details (-vv)",
+                      default=0)
+    parser.add_option("", "--summary", dest="summary_fn",
+                      help="write per-frame results to this JSON file",
+                      default=None, type=str)
+    (options, cmdline_args) = parser.parse_args(args)
+
+    # quiet unless something goes wrong
+    logging.basicConfig(
+        level=[logging.WARNING, logging.INFO, logging.DEBUG][min(options.verbose, 2)],
+        format="%(asctime)s %(processName)s %(levelname)s: %(message)s")
+
+    if (options.preset is not None and options.preset not in presets):
+        parser.error("unknown preset %s" % (options.preset))
+
+    params = {}
+    for p in options.params:
+        key, value = p.split("=", 1)
+        params[key.strip()] = parse_value(value.strip())
+
+    overrides = {}
+    if (options.overrides is not None):
+        with open(options.overrides, "r") as of:
+            overrides = json.load(of)
+
+    results = run_batch(
+        frames=expand_frames(cmdline_args),
+        workers=options.workers,
+        preset=options.preset,
+        params=params,
+        overrides=overrides,
+        redo=options.redo,
+        remove_nonstars=options.remove_nonstars,
+        intermediate=options.intermediate,
+        keep_failed=options.keep_failed,
+        scratch_dir=options.scratch_dir,
+        summary_fn=options.summary_fn,
+        warm=options.warm,
+        transcript_dir=None if options.transcript_dir is None else os.path.abspath(options.transcript_dir),
+        psf_cache=None if options.psf_cache is None else os.path.abspath(options.psf_cache),
+        psf_cache_keys=None if options.psf_cache_keys is None else [
+            k.strip().upper() for k in options.psf_cache_keys.split(",") if k.strip()],
+        checkpoint_dir=None if options.checkpoint_dir is None else os.path.abspath(options.checkpoint_dir),
+    )
+
+    n_failed = len([r for r in results if r['status'] == 'failed'])
+    return 1 if n_failed > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,79 +5,243 @@ import subprocess
 import select
 import time
 import shutil
+import contextlib
 import pyfits
 import tempfile
+import types
+import logging
+import collections
+import json
+import multiprocessing
+import hashlib
+import itertools
+import datetime
+import fcntl
 
 sys.path.append("/work/podi_prep56")
 from podi_definitions import *
 
 from optparse import OptionParser
 import scipy.stats
+import scipy.ndimage
+import scipy.spatial
 import sitesetup
 
 numpy.seterr(all='ignore')
 
+#
+# All status messages go through this logger; nothing is printed unless the
+# calling program configures logging (or asks for verbose transcripts)
+#
+logger = logging.getLogger("daophot_wrapper")
+logger.addHandler(logging.NullHandler())
+
+
+class Transcript( object ):
+    #
+    # Records everything sent to and received from DAOPhot/ALLSTAR. The last
+    # ring_size bytes are always kept in memory for error reports; with a
+    # filename the complete transcript is also written to disk, in blocks of
+    # flush_size bytes.
+    #
+
+    def __init__(self, filename=None, ring_size=65536, flush_size=1048576):
+        self.filename = filename
+        self.ring_size = ring_size
+        self.flush_size = flush_size
+
+        self.ring = collections.deque()
+        self.ring_bytes = 0
+        self.file_buffer = []
+        self.file_bytes = 0
+
+        if (self.filename is not None):
+            # start a new file for every run
+            open(self.filename, "w").close()
+
+    def add(self, text):
+        self.ring.append(text)
+        self.ring_bytes += len(text)
+        while (self.ring_bytes - len(self.ring[0]) >= self.ring_size):
+            self.ring_bytes -= len(self.ring.popleft())
+
+        if (self.filename is not None):
+            self.file_buffer.append(text)
+            self.file_bytes += len(text)
+            if (self.file_bytes >= self.flush_size):
+                self.flush()
+
+    def tail(self, n_bytes=None):
+        if (n_bytes is None):
+            n_bytes = self.ring_size
+        return "".join(self.ring)[-n_bytes:]
+
+    def flush(self):
+        if (self.filename is not None and self.file_buffer):
+            with open(self.filename, "a") as tf:
+                tf.write("".join(self.file_buffer))
+            self.file_buffer = []
+            self.file_bytes = 0
+
+    def close(self):
+        self.flush()
+
+
 class ProcessHandler( object ):
 
-    def __init__(self, args, read_timeout=0.1, verbose=True, send_delay=0.0):
+    def __init__(self, args, read_timeout=0.1, verbose=False, send_delay=0.0,
+                 chunk_size=4096, cwd=None, transcript=None):
 
         self.proc = subprocess.Popen(
             args,
             shell=True,
+            cwd=cwd,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
         )
 
+        self.stdout_fd = self.proc.stdout.fileno()
         self.stdout_poll = select.poll()
-        self.stdout_poll.register(self.proc.stdout, select.POLLIN)
+        self.stdout_poll.register(self.stdout_fd, select.POLLIN | select.POLLHUP)
 
         self.read_timeout = read_timeout
         self.verbose = verbose
         self.send_delay = send_delay
+        self.chunk_size = chunk_size
+        self.transcript = Transcript() if transcript is None else transcript
+
+        #
+        # Output is collected in chunks as it arrives; chunks up to
+        # n_scanned have already been searched for prompts, and tail holds
+        # the end of the scanned text to catch prompts split across chunks
+        #
+        self.chunks = []
+        self.n_buffered = 0
+        self.n_scanned = 0
+        self.tail = ""
+        self.tail_size = 256
+        self.eof = False
+
+        # (prompt or None on timeout, seconds waited) for the most recent
+        # read_until calls
+        self.prompt_timings = collections.deque(maxlen=1000)
+
+        #
+        # In scripted mode answers are collected instead of sent, and the
+        # prompts they answer are only checked once all of them went out
+        # in one go (see script_steps)
+        #
+        self.scripted = False
+        self.script = []
+        self.pending = []
+
+    def fill(self, timeout):
+        #
+        # Wait up to timeout seconds (forever if negative) for new output
+        # and add whatever is available in one chunk to the buffer
+        #
+        if (self.eof):
+            return 0
+
+        poll_result = self.stdout_poll.poll(None if timeout < 0 else timeout * 1000.)
+        if (not poll_result):
+            return 0
+
+        chunk = os.read(self.stdout_fd, self.chunk_size)
+        if (chunk == ""):
+            # process closed its output
+            self.eof = True
+            self.stdout_poll.unregister(self.stdout_fd)
+            return 0
+
+        self.transcript.add(chunk)
+        if (self.verbose):
+            sys.stdout.write(chunk)
+        self.chunks.append(chunk)
+        self.n_buffered += len(chunk)
+        return len(chunk)
+
+    def match(self, until_text):
+        #
+        # Search all not yet scanned output for any of the prompts. Returns
+        # the index of the earliest prompt found and the buffer position
+        # right after it, or (-1, None)
+        #
+        new_text = "".join(self.chunks[self.n_scanned:])
+        if (new_text == ""):
+            return -1, None
+
+        window = self.tail + new_text
+        found, end = -1, None
+        for match_id, ut in enumerate(until_text):
+            pos = window.find(ut)
+            if (pos >= 0 and (end is None or pos + len(ut) < end)):
+                found, end = match_id, pos + len(ut)
+
+        if (found >= 0):
+            return found, self.n_buffered - len(window) + end
+
+        self.n_scanned = len(self.chunks)
+        self.tail = window[-self.tail_size:]
+        return -1, None
+
+    def consume(self, end=None):
+        #
+        # Return the buffered output up to end (all if None) and keep the
+        # rest for the next read
+        #
+        text = "".join(self.chunks)
+        if (end is None):
+            end = len(text)
+        remainder = text[end:]
+        self.chunks = [remainder] if remainder else []
+        self.n_buffered = len(remainder)
+        self.n_scanned = 0
+        self.tail = ""
+        return text[:end]
 
     def read(self, timeout=None):
 
         retcode = self.proc.poll()
         if (not retcode == None):
-            raise Error("Process dead!")
+            raise ProcessError("Process dead!")
             
         if (timeout == None): timeout=self.read_timeout
 
-        output = []
-        start_time = time.time()
-        while ((time.time() - start_time) < timeout):
-            poll_result = self.stdout_poll.poll(0)
-
-            if (poll_result):
-                filedesc, mask = poll_result[0]
-                if (mask & select.POLLIN):
-                    line = self.proc.stdout.read(1)
-                    output.append(line)
-            else:
-                time.sleep(0.001)
+        # keep reading until the process stays quiet for timeout seconds
+        while (self.fill(timeout) > 0):
+            pass
 
-        if (self.verbose):
-            sys.stdout.write("".join(output))
-        return "".join(output)
+        return self.consume()
 
     def read_until(self, until_text, timeout=1):
         if (type(until_text) == str):
             until_text = [until_text]
         start_time = time.time()
-        full_return = ""
-        found = -1
-        while(((time.time() - start_time) < timeout or timeout<0) and found<0):
-            new_text = self.read()
-            full_return += new_text
-            for match_id, ut in enumerate(until_text):
-                #print ut, "\n", full_return
-                if (full_return.find(ut) > 0):
-                    found = match_id
+
+        found, end = self.match(until_text)
+        while (found < 0 and not self.eof):
+            remaining = -1
+            if (timeout >= 0):
+                remaining = timeout - (time.time() - start_time)
+                if (remaining <= 0):
                     break
+            if (self.fill(remaining) > 0):
+                found, end = self.match(until_text)
+
+        full_return = self.consume(end)
+        self.prompt_timings.append(
+            (until_text[found] if found >= 0 else None, time.time() - start_time))
         return full_return, found
 
     def write(self, text, retry=3):
+        if (self.scripted):
+            self.script.append(text)
+            return
+        self.send(text, retry=retry)
+
+    def send(self, text, retry=3):
         retries = 0
         while(retries < retry):
             try:
@@ -87,46 +251,399 @@ class ProcessHandler( object ):
                 retries += 1
                 time.sleep(0.05)
                 continue
-            except:
-                pass
-                #print e
+            except ValueError:
+                # stdin is closed, no retry will help
+                raise ProcessError("Can't send to a closed process: %s" % (text.strip()))
+        self.transcript.add(text)
         if (self.verbose):
             sys.stdout.write(text)
         time.sleep(self.send_delay)
         return
 
+    def close(self):
+        #
+        # Close stdin and read all remaining output (stdout and stderr), so
+        # the process can end without blocking on a full pipe; returns its
+        # exit code
+        #
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            # the process is gone already
+            pass
+        while (not self.eof):
+            self.fill(-1)
+        self.proc.stderr.read()
+        return self.proc.wait()
+
     def write_and_read(self, text):
         self.write(text)
         return self.read()
 
+    def expect(self, until_text, timeout=1, decision=False):
+        return Expect(self, until_text, timeout, decision=decision)
+
+    def send_script(self):
+        if (self.script):
+            text = "".join(self.script)
+            self.script = []
+            self.send(text)
+
+    def script_steps(self, then=None):
+        #
+        # Send all answers collected in scripted mode at once, then check
+        # that every prompt they were meant for showed up, in order. If then
+        # is given, wait for that prompt afterwards and hand back its result.
+        #
+        self.send_script()
+        pending, self.pending = self.pending, []
+
+        #
+        # Stages may take as long as they need, so wait for every prompt
+        # without a timeout; the dialogue is only out of step if another
+        # prompt of the script (or the command prompt) shows up first, or
+        # the program ends
+        #
+        known = ["Command:"]
+        for item in pending:
+            known.extend([ut for ut in item.until_text if ut not in known])
+
+        for item in pending:
+            others = [ut for ut in known if ut not in item.until_text]
+            text, found = yield Expect(self, item.until_text + others, timeout=-1, decision=True)
+            if (found < 0 or found >= len(item.until_text)):
+                raise ScriptError("Scripted dialogue out of step: expected %s, got\n%s" % (
+                    " or ".join(['"%s"' % ut for ut in item.until_text]), text))
+
+        if (then is not None):
+            result = yield then
+            raise StepResult(result)
+
+
+def kill_process(handler):
+    # kill the process of a ProcessHandler and reap it
+    try:
+        handler.proc.kill()
+    except OSError:
+        # already gone
+        pass
+    handler.close()
+
+
+class ScriptError( Exception ):
+    pass
+
+
+class ProcessError( Exception ):
+    pass
+
+
+class StepResult( Exception ):
+    #
+    # Raised by a *_steps generator to finish and hand a value back to the
+    # generator that yielded it
+    #
+    def __init__(self, value):
+        Exception.__init__(self)
+        self.value = value
+
+
+class Expect( object ):
+    #
+    # Yielded by the *_steps generators whenever a dialogue has to wait for
+    # one of several prompts; whoever drives the generator sends back the
+    # (text, found) tuple read_until would have returned.
+    #
+    # In scripted mode only prompts marked as decision (the answer depends
+    # on the output) are waited for right away.
+    #
+    def __init__(self, handler, until_text, timeout=1, decision=False):
+        if (type(until_text) == str):
+            until_text = [until_text]
+        self.handler = handler
+        self.until_text = until_text
+        self.timeout = timeout
+        self.decision = decision
+
+
+class WaitExit( object ):
+    #
+    # Yielded when a dialogue needs an external program (e.g. SExtractor) to
+    # finish; the driver sends back its return code.
+    #
+    def __init__(self, proc):
+        self.proc = proc
+
+
+def _schedule(item, stack, handlers):
+    #
+    # Bookkeeping shared by run_steps and SessionLoop for one yielded item.
+    # Returns (True, value) if the item can be answered right away, or
+    # (False, item) if the driver has to wait for it.
+    #
+    if (isinstance(item, types.GeneratorType)):
+        stack.append(item)
+        return True, None
+
+    elif (isinstance(item, Expect)):
+        handler = item.handler
+        if (handler.scripted):
+            handlers.add(handler)
+            if (not item.decision):
+                handler.pending.append(item)
+                return True, ("", 0)
+        if (handler.pending):
+            # all answers scripted so far need to go out (and be checked)
+            # before we can wait for this prompt
+            stack.append(handler.script_steps(then=item))
+            return True, None
+        return False, item
+
+    elif (isinstance(item, WaitExit)):
+        # let scripted sessions work through their answers in the meantime
+        for handler in handlers:
+            handler.send_script()
+        return False, item
+
+    return True, None
+
+
+def _next_script_check(stack, handlers):
+    #
+    # Once all steps are done, make sure the remaining scripted answers are
+    # sent and checked; returns False if there is nothing left to do
+    #
+    for handler in handlers:
+        if (handler.pending or handler.script):
+            stack.append(handler.script_steps())
+            return True
+    return False
+
+
+def run_steps(steps):
+    #
+    # Drive a *_steps generator to completion, blocking on every prompt.
+    # Generators yielded from within are run in place, so stages can be
+    # nested just like regular function calls.
+    #
+    stack = [steps]
+    handlers = set()
+    value = None
+    try:
+        while (stack or _next_script_check(stack, handlers)):
+            try:
+                item = stack[-1].send(value)
+            except StopIteration:
+                stack.pop()
+                value = None
+                continue
+            except StepResult as result:
+                stack.pop()
+                value = result.value
+                continue
+
+            ready, value = _schedule(item, stack, handlers)
+            if (ready):
+                continue
+
+            if (isinstance(value, Expect)):
+                value = value.handler.read_until(value.until_text, timeout=value.timeout)
+            elif (isinstance(value, WaitExit)):
+                value = value.proc.wait()
+    except:
+        # let all unfinished steps clean up after themselves, innermost first
+        for steps in reversed(stack):
+            steps.close()
+        raise
+    return
+
+
+class SessionLoop( object ):
+    #
+    # Runs any number of *_steps generators (typically Daophot.auto_steps())
+    # side by side from a single thread. All sessions waiting for a prompt
+    # are polled together, and whichever session got its prompt is resumed
+    # until it has to wait again.
+    #
+    # Pure-python stages (e.g. verify_real_star) still run inline and hold
+    # up the other sessions while they run.
+    #
+    # With max_active, only that many sessions run at any time; the others
+    # are started, in order, as running ones finish.
+    #
+
+    def __init__(self, poll_interval=0.05, max_active=None):
+        self.poll_interval = poll_interval
+        self.max_active = max_active
+        self.sessions = []
+
+    def add(self, steps, name=None):
+        session = {
+            'name': name,
+            'stack': [steps],
+            'value': None,
+            'wait': None,
+            'wait_start': None,
+            'done': False,
+            'error': None,
+            'handlers': set(),
+        }
+        self.sessions.append(session)
+        return session
+
+    def _check(self, session):
+        #
+        # See if whatever the session is waiting for has happened; if so,
+        # prepare the value to be sent back and return True
+        #
+        item = session['wait']
+        if (isinstance(item, Expect)):
+            handler = item.handler
+            found, end = handler.match(item.until_text)
+            elapsed = time.time() - session['wait_start']
+            if (found < 0 and not handler.eof and
+                    (item.timeout < 0 or elapsed < item.timeout)):
+                return False
+            session['value'] = (handler.consume(end), found)
+            handler.prompt_timings.append(
+                (item.until_text[found] if found >= 0 else None, elapsed))
+            return True
+        elif (isinstance(item, WaitExit)):
+            returncode = item.proc.poll()
+            if (returncode is None):
+                return False
+            session['value'] = returncode
+            return True
+        return True
+
+    def _advance(self, session):
+        #
+        # Resume the session until it needs to wait or is done
+        #
+        stack = session['stack']
+        try:
+            while (stack or _next_script_check(stack, session['handlers'])):
+                try:
+                    item = stack[-1].send(session['value'])
+                except StopIteration:
+                    stack.pop()
+                    session['value'] = None
+                    continue
+                except StepResult as result:
+                    stack.pop()
+                    session['value'] = result.value
+                    continue
+
+                ready, result = _schedule(item, stack, session['handlers'])
+                session['value'] = result if ready else None
+                if (ready):
+                    continue
+
+                session['wait'] = result
+                session['wait_start'] = time.time()
+                if (not self._check(session)):
+                    return
+                session['wait'] = None
+        except Exception as e:
+            session['error'] = e
+            # let all unfinished steps clean up after themselves, innermost first
+            for steps in reversed(stack):
+                steps.close()
+            del stack[:]
+
+        session['done'] = True
+        session['wait'] = None
+
+    def run(self):
+
+        queued = [s for s in self.sessions if not s['done']]
+        running = []
+        while (True):
+            running = [s for s in running if not s['done']]
+            if (queued and (self.max_active is None or len(running) < self.max_active)):
+                session = queued.pop(0)
+                running.append(session)
+                self._advance(session)
+                continue
+
+            waiting = running
+            if (not waiting):
+                break
+
+            #
+            # Wait for output from any of the processes we are waiting for,
+            # but wake up in time for timeouts and external programs
+            #
+            poller = select.poll()
+            handlers = {}
+            timeout = None
+            for session in waiting:
+                item = session['wait']
+                if (isinstance(item, Expect)):
+                    if (not item.handler.eof):
+                        handlers[item.handler.stdout_fd] = item.handler
+                        poller.register(item.handler.stdout_fd,
+                                        select.POLLIN | select.POLLHUP)
+                    if (item.timeout >= 0):
+                        left = item.timeout - (time.time() - session['wait_start'])
+                        timeout = left if timeout is None else min(timeout, left)
+                else:
+                    timeout = self.poll_interval if timeout is None \
+                        else min(timeout, self.poll_interval)
+
+            if (handlers):
+                events = poller.poll(None if timeout is None else max(0, timeout) * 1000.)
+                for fd, mask in events:
+                    handlers[fd].fill(0)
+            elif (timeout is not None):
+                time.sleep(max(0, timeout))
+
+            for session in waiting:
+                if (self._check(session)):
+                    session['wait'] = None
+                    self._advance(session)
+
+        return self.sessions
+
 
 
 class DAOPHOT ( object ):
 
-    def __init__(self, options, fitsfile, threshold, dao_dir=None):
+    def __init__(self, options, fitsfile, threshold, dao_dir=None, start=True,
+                 workdir=None, verbose=False, transcript=None):
 
         self.cmd_options = options
         self.detection_threshold = threshold
-        self.fitsfile = fitsfile
+        self.fitsfile = None
+        self.gain = 1.5
+        self.readnoise = 6.5
 
         self.dao_dir = options.dao_dir if dao_dir is None else dao_dir
+        self.workdir = workdir
+        self.verbose = verbose
+        self.transcript = transcript
 
         self.daophot_exe = "%s/daophot" % (self.dao_dir)
         self.allstar_exe = "%s/allstar" % (self.dao_dir)
         
+        self.files = {}
+        self.extra_cleanup_files = []
+        self.sextractor_catalog = None
+        self.valid_psf_model = False
+        # typical FWHM of the PSF star candidates, see pick_midrange
+        self.candidate_fwhm = numpy.NaN
+
+        # where pick_midrange gets its candidates from: "sextractor", or
+        # "internal" for find_psf_candidates()
+        self.psf_candidates = "sextractor"
 
         #
-        # open FITS file and read some important parameters
+        # open FITS file and read some important parameters; without a file
+        # (e.g. for sessions kept in a DAOPHOTPool) DAOPhot starts with the
+        # default gain and readnoise
         #
-        self.hdulist =  pyfits.open(self.fitsfile)
-
-        self.gain = self.hdulist[0].header['GAIN'] if 'GAIN' in self.hdulist[0].header \
-                    else 1.5
-        self.readnoise = self.hdulist[0].header['RDNOISE'] if 'RDNOISE' in self.hdulist[0].header \
-                         else 6.5
-
-        self.files = {}
-        self.extra_cleanup_files = []
+        if (fitsfile is not None):
+            self.reset(fitsfile)
 
         self.sextractor_fields = [
                 "ALPHAWIN_J2000", "DELTAWIN_J2000",
@@ -143,33 +660,80 @@ class DAOPHOT ( object ):
                 #"MAG_PSF", "MAGERR_PSF",
                 ]
 
+        #
+        # With start=False the caller is responsible for running
+        # start_steps(), e.g. from a SessionLoop
+        #
         self.running = False
-        if (not self.running):
+        if (start):
             self.start_daophot()
 
 
+    def reset(self, fitsfile, threshold=None):
+        #
+        # Switch to a new frame: read its gain and readnoise and forget all
+        # files from the previous one
+        #
+        self.fitsfile = fitsfile
+        if (threshold is not None):
+            self.detection_threshold = threshold
+
+        # only the header; sessions in a pool must not keep files open
+        header = pyfits.getheader(self.fitsfile)
+        self.gain = header.get('GAIN', 1.5)
+        self.readnoise = header.get('RDNOISE', 6.5)
+
+        self.files = {}
+        self.extra_cleanup_files = []
+        self.sextractor_catalog = None
+        self.valid_psf_model = False
+        self.candidate_fwhm = numpy.NaN
+
+    def is_alive(self):
+        return (self.running and
+                self.daophot.proc.poll() is None and
+                not self.daophot.eof)
+
+    def setup_steps(self):
+        #
+        # Start DAOPhot if necessary; a session that is already running
+        # only needs the gain and readnoise of the current frame
+        #
+        if (not self.running):
+            yield self.start_steps()
+        else:
+            yield self.options_steps(re=self.readnoise, ga=self.gain)
+
     def start_daophot(self):
+        run_steps(self.start_steps())
+
+    def start_steps(self):
         #
         # Start up DAOPhot
         #
-        self.daophot = ProcessHandler([self.daophot_exe], verbose=True)
+        self.daophot = ProcessHandler([self.daophot_exe], verbose=self.verbose,
+                                      cwd=self.workdir, transcript=self.transcript)
+        self.running = True
 
-        self.daophot.read()
         # first question in READNOISE
         # Value unacceptable --- please re-enter
         #
         #                        READ NOISE (ADU; 1 frame) = 1.4
         #
-        self.daophot.write("%.2f\n" % (self.readnoise))
+        # (unless a daophot.opt file provides it, in which case we go
+        # straight to the command prompt)
+        _, found = yield self.daophot.expect(["READ NOISE", "Command:"], decision=True)
+        if (found == 0):
+            self.daophot.write("%.2f\n" % (self.readnoise))
 
-
-        self.daophot.read()
-        # Value unacceptable --- please re-enter
-        #
-        #                        GAIN (e-/ADU; 1 frame) = 1.4
-        #
-        self.daophot.write("%.2f\n" % (self.gain))
-        self.daophot.read()
+            # Value unacceptable --- please re-enter
+            #
+            #                        GAIN (e-/ADU; 1 frame) = 1.4
+            #
+            _, found = yield self.daophot.expect(["GAIN", "Command:"], decision=True)
+            if (found == 0):
+                self.daophot.write("%.2f\n" % (self.gain))
+                yield self.prompt()
 
         #
         # Now we are ready for action
@@ -185,8 +749,22 @@ class DAOPHOT ( object ):
     def wait_for_prompt(self):
         self.daophot.read_until("Command:")
 
+    def prompt(self):
+        return self.daophot.expect("Command:")
+
+    def command_done(self):
+        #
+        # The command prompt after SKY, FIND, PHOT or PICK, however long they
+        # take; in scripted mode all answers so far go out and get checked
+        # first, so the output files are complete once we get it
+        #
+        return self.daophot.expect("Command:", timeout=-1, decision=True)
+
 
     def attach(self, filename=None):
+        run_steps(self.attach_steps(filename))
+
+    def attach_steps(self, filename=None):
         
         if (not filename == None):
             self.fitsfile = filename
@@ -195,19 +773,22 @@ class DAOPHOT ( object ):
 #        self.daophot.read_until("Input image name:")
 
 #        self.daophot.write("%s\n" % (self.fitsfile))
-        self.wait_for_prompt()
+        yield self.prompt()
 
 
     def options(self, **kwargs):
+        run_steps(self.options_steps(**kwargs))
+
+    def options_steps(self, **kwargs):
 
         if (kwargs == None):
             return
 
         self.daophot.write("OPTION\n")
-        self.daophot.read_until("File with parameters (default KEYBOARD INPUT):")
+        yield self.daophot.expect("File with parameters (default KEYBOARD INPUT):")
 
         self.daophot.write("\n")
-        self.daophot.read_until("OPT>")
+        yield self.daophot.expect("OPT>")
 
         for key, value in kwargs.iteritems():
 
@@ -220,18 +801,24 @@ class DAOPHOT ( object ):
                 # psf_radius=None,
 
             # and wait for new prompt
-            self.daophot.read_until("OPT>")
+            yield self.daophot.expect("OPT>")
 
         # empty string takes us back to command prompt
         self.daophot.write("\n")
-        self.wait_for_prompt()
+        yield self.prompt()
 
     def sky(self):
+        run_steps(self.sky_steps())
+
+    def sky_steps(self):
         self.daophot.write("SKY\n")
-        self.wait_for_prompt()
+        yield self.command_done()
 
 
     def find(self, avg=1, sum=1, coo_file=None):
+        run_steps(self.find_steps(avg=avg, sum=sum, coo_file=coo_file))
+
+    def find_steps(self, avg=1, sum=1, coo_file=None):
 
         self.daophot.write("FIND\n")
         #      Sky mode and standard deviation =   -0.036   28.680
@@ -241,13 +828,13 @@ class DAOPHOT ( object ):
         #                       Relative error = 1.14
         #
         #                 Number of frames averaged, summed:    
-        self.daophot.read_until("Number of frames averaged, summed:")
+        yield self.daophot.expect("Number of frames averaged, summed:")
 
         self.daophot.write("%d,%d\n" % (avg, sum))
         #         File for positions (default leo1_nans.coo):
 
         
-        self.daophot.read_until("File for positions")
+        yield self.daophot.expect("File for positions")
         if (not coo_file == None):
             # XXXXX
             self.files['coo'] = coo_file
@@ -263,17 +850,20 @@ class DAOPHOT ( object ):
         #
         #                           Are you happy with this? yes
         #
-        catdump, found = self.daophot.read_until(["Are you happy with this?"], timeout=-1)
+        catdump, found = yield self.daophot.expect(["Are you happy with this?"], timeout=-1)
         self.daophot.write("yes\n")
 
-        self.wait_for_prompt()
+        yield self.command_done()
 
     def phot(self, ap_file=None, coo_file=None, **kwargs):
+        run_steps(self.phot_steps(ap_file=ap_file, coo_file=coo_file, **kwargs))
+
+    def phot_steps(self, ap_file=None, coo_file=None, **kwargs):
 
         self.daophot.write("PHOT\n")
         #
         #      File with aperture radii (default photo.opt):
-        self.daophot.read_until("File with aperture radii (default photo.opt):")
+        yield self.daophot.expect("File with aperture radii (default photo.opt):")
 
 
         self.daophot.write("\n")
@@ -290,7 +880,7 @@ class DAOPHOT ( object ):
         #  IS       INNER SKY RADIUS =     0.00     OS       OUTER SKY RADIUS =     0.00
         #
         # PHO> 
-        self.daophot.read_until("PHO>")
+        yield self.daophot.expect("PHO>")
 
         #
         # Now parse all options requested by the user
@@ -301,7 +891,7 @@ class DAOPHOT ( object ):
             self.daophot.write("%s = %.2f\n" % (key, value))
 
             # and wait for new prompt
-            self.daophot.read_until("PHO>")
+            yield self.daophot.expect("PHO>")
 
         #
         # empty string takes us back to command prompt
@@ -319,13 +909,13 @@ class DAOPHOT ( object ):
         #  IS       INNER SKY RADIUS =    10.00     OS       OUTER SKY RADIUS =    20.00
         #
         #       Input position file (default leo1_nans.coo):
-        self.daophot.read_until("Input position file")
+        yield self.daophot.expect("Input position file")
 
         _coo = self.files['coo'] if coo_file == None else coo_file
         self.daophot.write("%s\n" % (_coo))
         #                Output file (default leo1_nans.ap):
 
-        self.daophot.read_until("Output file")
+        yield self.daophot.expect("Output file")
         
         if (not ap_file == None):
             self.files['ap'] = ap_file
@@ -334,7 +924,7 @@ class DAOPHOT ( object ):
         clobberfile(self.files['ap'])
         self.daophot.write("%s\n" % (self.files['ap']))
 
-        self.wait_for_prompt()
+        yield self.command_done()
         
 
         # daophot.write_and_read("%s\n" % (coo_file))
@@ -348,63 +938,43 @@ class DAOPHOT ( object ):
         # phot, found = daophot.read_until(["Command:"], timeout=-1)
 
     def pick_midrange(self):
+        run_steps(self.pick_midrange_steps())
 
-        _, self.sextractor_catalog_fn = tempfile.mkstemp(suffix=".cat", dir=sitesetup.scratch_dir)
-
-        with open("default.param", "w") as param:
-            print >>param, "\n".join(self.sextractor_fields)
-        sexconf = {
-            "CATALOG_NAME":      self.sextractor_catalog_fn,
-            "CATALOG_TYPE":      "ASCII_HEAD",
-            "PARAMETERS_NAME":   "default.param",
-            "DETECT_MINAREA":    "5",
-            "DETECT_MAXAREA":    "0",
-            "THRESH_TYPE":       "RELATIVE",
-            "DETECT_THRESH":     "1.5",
-            "ANALYSIS_THRESH":   "1.5",
-            "FILTER":            "N",
-            "WEIGHT_TYPE":       "NONE",
-            "RESCALE_WEIGHTS":   "Y",
-            "WEIGHT_IMAGE":      "weight.fits",
-            "WEIGHT_GAIN ":      "Y",
-            "MAG_ZEROPOINT":     "26.0",
-            "GAIN":              "0.0",
-            "GAIN_KEY":          "GAIN",
-            "CHECKIMAGE_TYPE":   "NONE",
-            "VERBOSE_TYPE":      "QUIET",
-        }
-        options = ""
-        for key, value in sexconf.iteritems():
-            # print key, value
-            options += "-%s %s " % (key, value)
+    def pick_midrange_steps(self):
 
-        cmd = "sex %s %s" % (options, self.fitsfile)
-        print cmd
-        os.system(cmd)
-        catalog = numpy.loadtxt(self.sextractor_catalog_fn)
-        self.sextractor_catalog = numpy.array(catalog)
-        self.extra_cleanup_files.append(self.sextractor_catalog_fn)
+        if (self.psf_candidates == "internal"):
+            hdulist = pyfits.open(self.fitsfile, memmap=True)
+            catalog = find_psf_candidates(
+                hdulist[0].data, self.sextractor_fields,
+                gain=self.gain,
+                saturation=hdulist[0].header.get('SATURATE', None))
+            hdulist.close()
+        else:
+            catalog = yield self.sextractor_steps()
+        self.sextractor_catalog = catalog
 
-        print catalog.shape
+        logger.debug("PSF star candidates: %d sources" % (catalog.shape[0]))
 
         # now select a bunch of stars with the right amount of peak flux, 
         # no flags, and a median fwhm
-        no_flags = (catalog[:, 7] == 0)
-        peak_flux = numpy.max(catalog[:, 11]) # 450
-        good_flux = (catalog[:,11] > 0.2 * peak_flux) & (catalog[:,11] < 0.5*peak_flux)
+        no_flags = (catalog['FLAGS'] == 0)
+        peak_flux = numpy.max(catalog['FLUX_MAX']) # 450
+        good_flux = (catalog['FLUX_MAX'] > 0.2 * peak_flux) & (catalog['FLUX_MAX'] < 0.5*peak_flux)
         catalog = catalog[no_flags & good_flux]
-        numpy.savetxt("test2.cat", catalog)
+        logger.debug("%d sources without flags and with 20-50%% of the peak flux" % (catalog.shape[0]))
 
-        good_fwhm = numpy.isfinite(catalog[:,4])
+        fwhm = catalog['FWHM_IMAGE']
+        good_fwhm = numpy.isfinite(fwhm)
         for i in range(3):
-            _sigm = scipy.stats.scoreatpercentile(catalog[:,4][good_fwhm], [16,50,84])
+            _sigm = scipy.stats.scoreatpercentile(fwhm[good_fwhm], [16,50,84])
             med = _sigm[1]
             sigma = 0.5*(_sigm[2]-_sigm[0])
-            print med, sigma, _sigm
-            good_fwhm = (catalog[:,4] > (med-3*sigma)) & (catalog[:,4] < (med+3*sigma))
+            logger.debug("FWHM median %.2f, sigma %.2f" % (med, sigma))
+            good_fwhm = (fwhm > (med-3*sigma)) & (fwhm < (med+3*sigma))
 
         catalog = catalog[good_fwhm]
-        numpy.savetxt("test3.cat", catalog)
+        logger.debug("%d PSF star candidates with typical FWHM" % (catalog.shape[0]))
+        self.candidate_fwhm = med
 
         #
         # Now save the source list as daophot-compatible LST file
@@ -417,17 +987,70 @@ class DAOPHOT ( object ):
 """
             catalog = catalog[:25]
             catalog_lst = numpy.empty((catalog.shape[0], 6))
-            catalog_lst[:,0] = catalog[:,17]
-            catalog_lst[:,1:3] = catalog[:,2:4]
-            catalog_lst[:,3:5] = catalog[:, 9:11]
-            catalog_lst[:,5] = catalog[:, 16]
+            catalog_lst[:,0] = catalog['NUMBER']
+            catalog_lst[:,1] = catalog['XWIN_IMAGE']
+            catalog_lst[:,2] = catalog['YWIN_IMAGE']
+            catalog_lst[:,3] = catalog['MAG_AUTO']
+            catalog_lst[:,4] = catalog['MAGERR_AUTO']
+            catalog_lst[:,5] = catalog['ELLIPTICITY']
             numpy.savetxt(lst,
                           catalog_lst,
                           "%d %.3f %.3f %3f %4f %3f")
-
-        print "\n"*10
         
+
+    def sextractor_steps(self):
+
+        #
+        # keep all SExtractor files next to the image, not in the current
+        # directory
+        #
+        self.sextractor_catalog_fn = self.get_file("sexcat.fits")
+        param_fn = self.get_file("sex.param")
+        self.extra_cleanup_files.extend([self.sextractor_catalog_fn, param_fn])
+
+        with open(param_fn, "w") as param:
+            print >>param, "\n".join(self.sextractor_fields)
+        sexconf = {
+            "CATALOG_NAME":      self.sextractor_catalog_fn,
+            "CATALOG_TYPE":      "FITS_1.0",
+            "PARAMETERS_NAME":   param_fn,
+            "DETECT_MINAREA":    "5",
+            "DETECT_MAXAREA":    "0",
+            "THRESH_TYPE":       "RELATIVE",
+            "DETECT_THRESH":     "1.5",
+            "ANALYSIS_THRESH":   "1.5",
+            "FILTER":            "N",
+            "WEIGHT_TYPE":       "NONE",
+            "RESCALE_WEIGHTS":   "Y",
+            "WEIGHT_IMAGE":      "weight.fits",
+            "WEIGHT_GAIN ":      "Y",
+            "MAG_ZEROPOINT":     "26.0",
+            "GAIN":              "0.0",
+            "GAIN_KEY":          "GAIN",
+            "CHECKIMAGE_TYPE":   "NONE",
+            "VERBOSE_TYPE":      "QUIET",
+        }
+        options = ""
+        for key, value in sexconf.iteritems():
+            # print key, value
+            options += "-%s %s " % (key, value)
+
+        cmd = "sex %s %s" % (options, self.fitsfile)
+        logger.debug(cmd)
+        sex = subprocess.Popen(cmd, shell=True, cwd=os.path.dirname(os.path.abspath(self.fitsfile)))
+        yield WaitExit(sex)
+
+        # binary table, columns named just like in sextractor_fields
+        cat_hdulist = pyfits.open(self.sextractor_catalog_fn, memmap=False)
+        catalog = cat_hdulist[1].data
+        cat_hdulist.close()
+        raise StepResult(catalog)
+
     def pick(self, nstars=15, maglimit=14, lst_file=None, ap_file=None):
+        run_steps(self.pick_steps(nstars=nstars, maglimit=maglimit,
+                                  lst_file=lst_file, ap_file=ap_file))
+
+    def pick_steps(self, nstars=15, maglimit=14, lst_file=None, ap_file=None):
 
         #
         # Now do some PSF modeling
@@ -435,17 +1058,17 @@ class DAOPHOT ( object ):
         self.daophot.write("PICK\n")
         #
         #            Input file name (default leo1_nans.ap):
-        self.daophot.read_until("Input file name")
+        yield self.daophot.expect("Input file name")
 
         _ap = self.files['ap'] if (ap_file == None) else ap_file
         self.daophot.write("%s\n" % (_ap))
         #       Desired number of stars, faintest magnitude: 
 
-        self.daophot.read_until("Desired number of stars, faintest magnitude:")
+        yield self.daophot.expect("Desired number of stars, faintest magnitude:")
         self.daophot.write("%d,%d\n" % (nstars, maglimit))
 
         #           Output file name (default leo1_nans.lst):
-        self.daophot.read_until("Output file name")
+        yield self.daophot.expect("Output file name")
 
         if (not lst_file == None):
             self.files['lst'] = lst_file
@@ -455,7 +1078,7 @@ class DAOPHOT ( object ):
 
         self.daophot.write("%s\n" % (self.files['lst']))
 
-        self.wait_for_prompt()
+        yield self.command_done()
 
         #retstr, found = daophot.read_until(["candidates were found."], timeout=-1)
         #retstr, found = daophot.read_until(["Command:"], timeout=-1)
@@ -466,23 +1089,28 @@ class DAOPHOT ( object ):
 
 
     def psf(self, interactive=False, ap_file=None, lst_file=None, psf_file=None):
+        run_steps(self.psf_steps(interactive=interactive, ap_file=ap_file,
+                                 lst_file=lst_file, psf_file=psf_file))
+        return self.valid_psf_model
+
+    def psf_steps(self, interactive=False, ap_file=None, lst_file=None, psf_file=None):
 
         
         self.daophot.write("PSF\n")
         #  File with aperture results (default leo1_nans.ap):
-        self.daophot.read_until("File with aperture results")
+        yield self.daophot.expect("File with aperture results")
 
         _ap = self.files['ap'] if (ap_file == None) else ap_file
         self.daophot.write("%s\n" % (_ap))
 
-        self.daophot.read_until("File with PSF stars")
+        yield self.daophot.expect("File with PSF stars")
         #        File with PSF stars (default leo1_nans.lst): 
 
         _lst = self.files['lst'] if (lst_file == None) else lst_file
         self.daophot.write("%s\n" % (_lst))
 
         #           File for the PSF (default leo1_nans.psf):
-        self.daophot.read_until("File for the PSF")
+        yield self.daophot.expect("File for the PSF")
         
         if (not psf_file == None):
             self.files['psf'] = psf_file
@@ -498,14 +1126,19 @@ class DAOPHOT ( object ):
         done = False
         valid_psf_model = True
         while (not done):
-            retstr, found = self.daophot.read_until(["Use this one?",
+            retstr, found = yield self.daophot.expect(["Use this one?",
                                                      "Try this one anyway?",
                                                      "Failed to converge",
                                                      "File with PSF stars and neighbors",
                                                      "Parameters...",
-                                                     "Please change something"])
+                                                     "Please change something"],
+                                                    decision=True)
 
             if (found < 0):
+                if (self.daophot.eof):
+                    # DAOPhot died on us, there is no PSF to be had
+                    valid_psf_model = False
+                    done = True
                 continue
             elif (found == 0):
                 #  Use this one? y
@@ -541,7 +1174,7 @@ class DAOPHOT ( object ):
                 valid_psf_model = True
 
 
-        return valid_psf_model
+        self.valid_psf_model = valid_psf_model
 
         # user_done = False
         # candidates_checked = 0
@@ -572,7 +1205,27 @@ class DAOPHOT ( object ):
 
 
     def exit(self):
-        self.daophot.write("EXIT\n")
+        run_steps(self.exit_steps())
+
+    def exit_steps(self):
+        #
+        # In scripted mode, all answers collected so far go out (and get
+        # checked) first. Then wait for DAOPhot to go away, so it is reaped
+        # now and not by some later subprocess call in the middle of
+        # another stage.
+        #
+        if (not self.running):
+            return
+        if (self.daophot.pending or self.daophot.script):
+            yield self.daophot.script_steps()
+        self.daophot.send("EXIT\n")
+        self.daophot.close()
+        self.running = False
+
+    def kill(self):
+        # end DAOPhot right away, whatever it is doing
+        if (self.running):
+            kill_process(self.daophot)
         self.running = False
 
     def save_files(self, out_directory):
@@ -592,24 +1245,14 @@ class DAOPHOT ( object ):
 
     def cleanup(self):
         for x in self.files:
-            fn = self.files[x]
-            if (os.path.isfile(fn)):
-                os.remove(fn)
+            remove_file(self.files[x])
         for fn in self.extra_cleanup_files:
-            if (os.path.isfile(fn)):
-                os.remove(fn)
+            remove_file(fn)
 
     def sextractor_catalog_to_FITS_table(self, name=None):
 
-        columns = []
-        for f_id, field_name in enumerate(self.sextractor_fields):
-            columns.append(
-                pyfits.Column(name=field_name,
-                                format='E', unit="",
-                                array=self.sextractor_catalog[:,f_id])
-            )
-        coldefs = pyfits.ColDefs(columns)
-        tbhdu = pyfits.BinTableHDU.from_columns(coldefs)
+        # the SExtractor catalog already is a FITS table
+        tbhdu = pyfits.BinTableHDU(data=self.sextractor_catalog)
 
         if (name is not None):
             tbhdu.name = name
@@ -617,40 +1260,322 @@ class DAOPHOT ( object ):
         return tbhdu
 
 
-class APfile (object):
+class DAOPHOTPool( object ):
+    #
+    # Keeps a number of DAOPhot sessions running between frames, so the next
+    # frame only needs to re-attach instead of starting a new executable and
+    # going through the start-up dialogue.
+    #
 
-    def __init__(self, filename):
+    def __init__(self, size=1, dao_dir=None, workdir=None, max_uses=None):
+        self.size = size
+        self.dao_dir = sitesetup.dao_dir if dao_dir is None else dao_dir
+        self.workdir = workdir
+        self.max_uses = max_uses
 
-        self.nl = 0
-        self.nx = -1
-        self.ny = -1
-        self.lowbad = numpy.NaN
-        self.highbad = numpy.NaN
-        self.thresh = numpy.NaN
-        self.ap1 = numpy.NaN
-        self.gain = numpy.NaN
-        self.readnoise = numpy.NaN
+        self.idle = []
+        self.uses = {}
 
-        self.src_stats = None
-        self.src_phot = None
+    def _new_session(self, start):
+        dao = DAOPHOT(
+            options=None,
+            fitsfile=None,
+            threshold=None,
+            dao_dir=self.dao_dir,
+            start=start,
+            workdir=self.workdir,
+        )
+        self.uses[id(dao)] = 0
+        return dao
 
-        self.column_description = [
-            "Star ID number",
-            "X coordinate of stellar centroid",
-            "Y coordinate of stellar centroid",
-            "Estimated modal sky value for the star",
-            "Standard deviation of the sky values about the mean",
-            "Skewness of the sky values about the mean",
-            "magnitude / error in apertures...",
-        ]
+    def start(self, n=None):
+        #
+        # Pre-start sessions until n (default: the pool size) are idle
+        #
+        if (n is None):
+            n = self.size
+        while (len(self.idle) < n):
+            self.idle.append(self._new_session(start=True))
 
-        self.n_apertures = 1
+    def checkout(self, fitsfile, threshold=None):
+        #
+        # Hand out a healthy session (or a new, not yet started one) set up
+        # for fitsfile; the caller has to run its setup_steps() next
+        #
+        dao = None
+        while (self.idle and dao is None):
+            candidate = self.idle.pop()
+            if (candidate.is_alive()):
+                dao = candidate
+            else:
+                # recycle dead sessions
+                self.uses.pop(id(candidate), None)
+                candidate.exit()
 
-        self.filename = filename
-        ap_return = self.read(self.filename)
-        if (ap_return is not None):
-            stats, src_stats, src_phot = ap_return
-            self.nl = int(stats[0])
+        if (dao is None):
+            dao = self._new_session(start=False)
+
+        dao.reset(fitsfile, threshold=threshold)
+        self.uses[id(dao)] = self.uses.get(id(dao), 0) + 1
+        return dao
+
+    def checkin(self, dao):
+        #
+        # Return a session once the caller is done with its files
+        #
+        if (dao.is_alive() and len(self.idle) < self.size and
+                not dao.daophot.pending and not dao.daophot.script and
+                (self.max_uses is None or self.uses.get(id(dao), 0) < self.max_uses)):
+            dao.files = {}
+            dao.extra_cleanup_files = []
+            dao.daophot.scripted = False
+            dao.daophot.prompt_timings.clear()
+            self.idle.append(dao)
+        else:
+            self.uses.pop(id(dao), None)
+            dao.exit()
+
+    def close(self):
+        for dao in self.idle:
+            self.uses.pop(id(dao), None)
+            dao.exit()
+        self.idle = []
+
+
+#
+# Parsed COO/AP/ALS catalogs can be kept in a binary sidecar next to the
+# text file (<catalog>.npz). A sidecar is only used if the size,
+# modification time and MD5 of the text file still match what they were
+# when the sidecar was written.
+#
+CATALOG_CACHE_SUFFIX = ".npz"
+CATALOG_CACHE_VERSION = 2
+
+def file_md5(filename):
+    md5 = hashlib.md5()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def load_catalog_cache(filename):
+    cache_fn = filename + CATALOG_CACHE_SUFFIX
+    if (not os.path.isfile(cache_fn) or not os.path.isfile(filename)):
+        return None
+    try:
+        with contextlib.closing(numpy.load(cache_fn)) as npz:
+            arrays = dict(npz.items())
+    except Exception:
+        logger.debug("unreadable catalog cache %s" % (cache_fn))
+        return None
+
+    st = os.stat(filename)
+    if (int(arrays.get('version', 0)) != CATALOG_CACHE_VERSION or
+            arrays['size'] != st.st_size or arrays['mtime'] != st.st_mtime or
+            str(arrays['md5']) != file_md5(filename)):
+        logger.debug("outdated catalog cache %s" % (cache_fn))
+        return None
+    return [arrays['item%d' % (i)] for i in range(int(arrays['n_items']))]
+
+
+def save_catalog_cache(filename, items):
+    cache_fn = filename + CATALOG_CACHE_SUFFIX
+    st = os.stat(filename)
+    arrays = dict([('item%d' % (i), numpy.asarray(item)) for i, item in enumerate(items)])
+
+    # write to a temporary file first so readers never see half a sidecar
+    tmp_fn = cache_fn + ".tmp%d" % (os.getpid())
+    with open(tmp_fn, "wb") as cf:
+        numpy.savez(cf, version=CATALOG_CACHE_VERSION, size=st.st_size, mtime=st.st_mtime, md5=file_md5(filename),
+                    n_items=len(items), **arrays)
+    os.rename(tmp_fn, cache_fn)
+
+
+def cached_read(read, filename, cache=False):
+    #
+    # read(filename) returns a tuple of arrays (or None); with cache, use
+    # and maintain the binary sidecar of the catalog
+    #
+    if (not cache):
+        return read(filename)
+
+    items = load_catalog_cache(filename)
+    if (items is not None):
+        logger.debug("loaded %s from its catalog cache" % (filename))
+        return items
+
+    items = read(filename)
+    if (items is not None):
+        try:
+            save_catalog_cache(filename, items)
+        except (IOError, OSError):
+            logger.warning("could not write catalog cache for %s" % (filename))
+    return items
+
+
+def remove_file(filename):
+    # remove a file and its catalog cache, if any
+    for fn in [filename, filename + CATALOG_CACHE_SUFFIX]:
+        if (os.path.isfile(fn)):
+            os.remove(fn)
+
+
+#
+# Columns of the DAOPhot catalogs: name, type and unit. Positions and sky
+# levels stay in double precision since they are written back for ALLSTAR
+# and used to locate the stars in the image; all other photometry is
+# single precision.
+#
+COO_COLUMNS = [
+    ('STAR_ID', numpy.int32, ""),
+    ('X', numpy.float64, "pixels"),
+    ('Y', numpy.float64, "pixels"),
+    ('INSTMAG', numpy.float32, "magnitude"),
+    ('SHARPNESS', numpy.float32, ""),
+    ('ROUNDNESS', numpy.float32, ""),
+    ('MARGROUND', numpy.float32, ""),
+]
+
+ALS_COLUMNS = [
+    ('STAR_ID', numpy.int32, ""),
+    ('X', numpy.float64, "pixels"),
+    ('Y', numpy.float64, "pixels"),
+    ('PSFMAG', numpy.float32, "magnitude"),
+    ('PSFMAG_ERR', numpy.float32, "magnitude"),
+    ('SKY', numpy.float64, "counts"),
+    ('N_ITERATIONS', numpy.int16, ""),
+    ('CHI2', numpy.float32, ""),
+    ('SHARPNESS', numpy.float32, "counts"),
+]
+
+def ap_columns(n_apertures):
+    columns = [
+        ('STAR_ID', numpy.int32, ""),
+        ('X', numpy.float64, "pixels"),
+        ('Y', numpy.float64, "pixels"),
+        ('SKY', numpy.float64, "magnitude"),
+        ('SKYNOISE', numpy.float32, "magnitude"),
+        ('SKYSKEW', numpy.float32, "magnitude"),
+    ]
+    for iap in range(n_apertures):
+        columns.append(('MAG_%02d' % (iap+1), numpy.float32, "magnitude"))
+        columns.append(('MAGERR_%02d' % (iap+1), numpy.float32, "magnitude"))
+    return columns
+
+def catalog_dtype(columns):
+    return numpy.dtype([(name, _type) for name, _type, unit in columns])
+
+
+def catalog_table_hdu(catalog, columns, name=None):
+    #
+    # FITS table straight from the record array of a catalog, with the
+    # catalog's header information
+    #
+    tbhdu = pyfits.BinTableHDU(data=catalog.data)
+    for col_name, _type, unit in columns:
+        if (unit != ""):
+            tbhdu.columns[col_name].unit = unit
+
+    if (name is not None):
+        tbhdu.name = name
+
+    tbhdu.header['NL'] = (catalog.nl, "")
+    tbhdu.header['NX'] = (catalog.nx, "img size X")
+    tbhdu.header['NY'] = (catalog.ny, "img size Y")
+    tbhdu.header['LOWBAD'] = (catalog.lowbad, "lower good data limit")
+    tbhdu.header['HIGHBAD'] = (catalog.highbad, "upper good data limit")
+    tbhdu.header['THRESH'] = (catalog.thresh, "rel. detection threshold")
+    tbhdu.header['AP1'] = (-1 if numpy.isnan(catalog.ap1) else catalog.ap1, "radius of first apertures in pixels")
+    tbhdu.header['GAIN'] = (-1 if numpy.isnan(catalog.gain) else catalog.gain, "photons/ADU")
+    tbhdu.header['RDNOISE'] = (-1 if numpy.isnan(catalog.readnoise) else catalog.readnoise, "readnoise")
+    tbhdu.header['FITRAD'] = (-1 if numpy.isnan(catalog.fitting_radius) else catalog.fitting_radius, "user-defined fitting radius [px]")
+
+    return tbhdu
+
+
+class MergedCatalog( object ):
+    #
+    # Catalog assembled from the tables of several tiles (see
+    # merge_tile_catalogs), with the header information of the first one;
+    # all that catalog_table_hdu needs
+    #
+    def __init__(self, data, header, nx, ny):
+        self.data = data
+        self.nl = header['NL']
+        self.nx = nx
+        self.ny = ny
+        self.lowbad = header['LOWBAD']
+        self.highbad = header['HIGHBAD']
+        self.thresh = header['THRESH']
+        self.ap1 = header['AP1']
+        self.gain = header['GAIN']
+        self.readnoise = header['RDNOISE']
+        self.fitting_radius = header['FITRAD']
+
+
+def fixed_width_values(lines, widths, filename):
+    #
+    # Numbers from lines of fixed-width fields, as (n_lines, n_fields)
+    # float64 array; cut out by position, so fields that fill their width
+    # and run into their neighbours come out right. Lines of another length
+    # and fields that are no number (e.g. Fortran's *** overflow) are an
+    # error.
+    #
+    width = sum(widths)
+    lengths = numpy.array([len(line.rstrip()) for line in lines])
+    bad = numpy.nonzero(lengths != width)[0]
+    if (bad.shape[0] > 0):
+        raise ValueError("%s: line of %d instead of %d characters: %s" % (
+            filename, lengths[bad[0]], width, lines[bad[0]].rstrip()))
+
+    chars = numpy.array(lines, dtype="S%d" % (width)).view(numpy.uint8).reshape((len(lines), width))
+    values = numpy.empty((len(lines), len(widths)))
+    start = 0
+    for i, field_width in enumerate(widths):
+        field = numpy.ascontiguousarray(chars[:, start:start+field_width])
+        try:
+            values[:, i] = field.view("S%d" % (field_width)).ravel().astype(numpy.float64)
+        except ValueError:
+            raise ValueError("%s: value %d is not a number in every line" % (filename, i+1))
+        start += field_width
+    return values
+
+
+class APfile (object):
+
+    def __init__(self, filename, cache=False):
+
+        self.nl = 0
+        self.nx = -1
+        self.ny = -1
+        self.lowbad = numpy.NaN
+        self.highbad = numpy.NaN
+        self.thresh = numpy.NaN
+        self.ap1 = numpy.NaN
+        self.gain = numpy.NaN
+        self.readnoise = numpy.NaN
+
+        # one record per star, see ap_columns()
+        self.data = None
+
+        self.column_description = [
+            "Star ID number",
+            "X coordinate of stellar centroid",
+            "Y coordinate of stellar centroid",
+            "Estimated modal sky value for the star",
+            "Standard deviation of the sky values about the mean",
+            "Skewness of the sky values about the mean",
+            "magnitude / error in apertures...",
+        ]
+
+        self.n_apertures = 1
+
+        self.filename = filename
+        ap_return = cached_read(self.read, self.filename, cache)
+        if (ap_return is not None):
+            stats, data = ap_return
+            self.nl = int(stats[0])
             self.nx = int(stats[1])
             self.ny = int(stats[2])
             self.lowbad = stats[3]
@@ -661,12 +1586,15 @@ class APfile (object):
             self.readnoise = stats[8]
             self.fitting_radius = stats[9]
 
-            self.src_stats = src_stats
-            self.src_phot = src_phot
-            self.n_apertures = numpy.sum(numpy.isfinite(self.src_phot[0,:,0]))
+            self.data = data
+            self.n_apertures = (len(self.data.dtype.names) - 6) / 2
 
         return
 
+    @property
+    def columns(self):
+        return ap_columns(self.n_apertures)
+
     def read(self, filename):
 
         with open(filename, "r") as apf:
@@ -674,157 +1602,123 @@ class APfile (object):
             stats_line = apf.readline().strip()
             _ = apf.readline()
 
-            # Read all data and prepare to insert it into the data buffer
-            datablock_text = apf.readlines()
-            n_blocks = len(datablock_text) / 3
-
-
-            src_stats = numpy.empty((n_blocks, 6))
-            src_phot = numpy.empty((n_blocks, 12, 2))
-            src_phot[:,:,:] = numpy.NaN
-
-            stats = numpy.fromstring(stats_line, count=10, sep=' ')
-            #print "read a total of %d lines for %d blocks" % (len(datablock_text), len(datablock_text)/3)
-
-            for star_id in range(n_blocks): #len(datablock_text), step=3):
-                # print datablock_text[3*star_id+1]
-                line1 = numpy.fromstring(datablock_text[3*star_id+1], sep=' ')
-                line2 = numpy.fromstring(datablock_text[3 * star_id + 2], sep=' ')
-                src_stats[star_id, :3] = line1[:3]
-                src_stats[star_id, 3:] = line2[:3]
-
-                n_phot = line1.shape[0]-3
-                src_phot[star_id, :n_phot, 0] = line1[3:]
-                src_phot[star_id, :n_phot, 1] = line2[3:]
-
-            #print src_stats.shape, src_phot.shape
-
-            return stats, src_stats, src_phot
-
-        return None
-
-    def write(self, filename):
+            # Read all data at once; every star is a blank line followed by
+            # one line of magnitudes and one line of sky values and errors
+            lines = apf.read().splitlines()
+
+        stats = numpy.fromstring(stats_line, count=10, sep=' ')
+
+        while (lines and not lines[-1].strip()):
+            lines.pop()
+        n_blocks = len(lines) / 3
+        if (n_blocks == 0):
+            return stats, numpy.empty(0, dtype=catalog_dtype(ap_columns(0)))
+        if (len(lines) != 3 * n_blocks or any([l.strip() for l in lines[0::3]])):
+            raise ValueError("%s: stars are not blocks of a blank line and two lines of values" % (
+                filename))
+        line1 = lines[1::3]
+        line2 = lines[2::3]
+
+        #
+        # The values are in fixed-width Fortran fields, which may run into
+        # each other, so they have to be cut out by position:
+        #   (1X, I6, 2F9.3, n*F9.3)   ID, X, Y and the magnitudes
+        #   (F?.3, 2F6.2, F8.4, (n-1)*F9.4)   sky, its noise and skew, errors
+        # The aperture count and the width of the sky field (13 from DAOPhot,
+        # 14 from APfile.write) come from the first star.
+        #
+        n_apertures = (len(line1[0].rstrip()) - 7) / 9 - 2
+        widths1 = [7, 9, 9] + [9] * n_apertures
+        widths2 = [6, 6, 8] + [9] * (n_apertures - 1)
+        widths2.insert(0, len(line2[0].rstrip()) - sum(widths2))
+        if (n_apertures < 1 or sum(widths1) != len(line1[0].rstrip()) or widths2[0] < 9):
+            raise ValueError("%s: unexpected layout of the first star" % (filename))
+        values1 = fixed_width_values(line1, widths1, filename)
+        values2 = fixed_width_values(line2, widths2, filename)
+
+        data = numpy.empty(n_blocks, dtype=catalog_dtype(ap_columns(n_apertures)))
+        for i, name in enumerate(['STAR_ID', 'X', 'Y']):
+            data[name] = values1[:, i]
+        for i, name in enumerate(['SKY', 'SKYNOISE', 'SKYSKEW']):
+            data[name] = values2[:, i]
+        for iap in range(n_apertures):
+            data['MAG_%02d' % (iap+1)] = values1[:, 3+iap]
+            data['MAGERR_%02d' % (iap+1)] = values2[:, 3+iap]
+
+        return stats, data
+
+    def write(self, filename, chunk_size=50000):
+
+        logger.debug("writing AP file to %s" % (filename))
+        mags = ['MAG_%02d' % (iap+1) for iap in range(self.n_apertures)]
+        errs = ['MAGERR_%02d' % (iap+1) for iap in range(self.n_apertures)]
+        columns = ['STAR_ID', 'X', 'Y'] + mags + ['SKY', 'SKYNOISE', 'SKYSKEW'] + errs
+
+        #
+        # Every star is a blank line, the magnitudes and the sky values and
+        # errors, in exactly the format DAOPhot writes (and we used to write
+        # with numpy.savetxt); format whole chunks of stars at once
+        #
+        star_format = "\n" + \
+            "%7d %8.3f %8.3f"+" %8.3f"*self.n_apertures + "\n" + \
+            "%14.3f %5.2f %5.2f %7.4f"+" %8.4f"*(self.n_apertures-1) + "\n"
 
-        print "writing AP file to %s" % (filename)
         with open(filename, "w") as ap:
-            print >>ap, " NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD"
-            print >>ap, "%3d %5d %5d %7.1f %7.1f %7.3f %7.3f %7.3f %7.3f %7.3f" % (
+            ap.write(" NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD\n")
+            ap.write("%3d %5d %5d %7.1f %7.1f %7.3f %7.3f %7.3f %7.3f %7.3f\n" % (
                 self.nl, self.nx, self.ny,
                 self.lowbad, self.highbad,
                 self.thresh, self.ap1, self.gain, self.readnoise, self.fitting_radius,
-            )
-            print >>ap
-
-            for src in range(self.src_stats.shape[0]):
-                print >>ap
-                line1 = numpy.append(self.src_stats[src,0:3], self.src_phot[src,:self.n_apertures,0]).reshape((1,-1))
-                line2 = numpy.append(self.src_stats[src,3:6], self.src_phot[src,:self.n_apertures,1]).reshape((1,-1))
-                numpy.savetxt(ap, line1, fmt="%7d %8.3f %8.3f"+" %8.3f"*self.n_apertures)
-                numpy.savetxt(ap, line2, fmt="%14.3f %5.2f %5.2f %7.4f"+" %8.4f"*(self.n_apertures-1))
+            ))
+            ap.write("\n")
 
+            for first in range(0, self.data.shape[0], chunk_size):
+                chunk = self.data[first:first+chunk_size]
+                values = numpy.empty((chunk.shape[0], len(columns)))
+                for i, name in enumerate(columns):
+                    values[:, i] = chunk[name]
+                ap.write((star_format * chunk.shape[0]) % tuple(values.ravel().tolist()))
 
         return
 
     def dump(self):
 
-        # reformat the photometry
-        phot = self.src_phot[:, :self.n_apertures, :]
-        phot_1d = phot.reshape((-1,self.n_apertures*2))
-        #print n_apertures, phot.shape, phot_1d.shape, self.src_stats.shape
-        combined = numpy.append(self.src_stats, phot_1d, axis=1)
-        #print combined.shape
+        # all columns, with magnitude and error alternating for each aperture
+        combined = numpy.array([self.data[n] for n in self.data.dtype.names], dtype=numpy.float64).T
         print "\n".join(["Column % 2d: %s" % (i+1,s) for i,s in enumerate(self.column_description)])
         numpy.savetxt(sys.stdout, combined)
 
-    def remove_stars(self, star_ids):
-
-        # sort all stars to be removed
-        star_ids_sorted = numpy.sort(star_ids)
-
-        # also sort the stars we have in the current catalog
-        si = numpy.argsort(self.src_stats[:,0])
-        src_stats_sorted = self.src_stats[si]
-        src_phot_sorted = self.src_phot[si]
-
+    def remove_stars(self, stars):
         #
-        # Now we have both a sorted list of stars and a list of stars to be removed
+        # Remove stars given either by their STAR_IDs or as a boolean mask
+        # with one entry per star (True = remove); all other stars keep
+        # their order. Returns the records of the removed stars.
         #
-        keep_star = numpy.isfinite(src_stats_sorted[:,0])
-
-        i_search = 0
-        for remove_id in star_ids_sorted:
-            for i in range(i_search, src_stats_sorted.shape[0]):
-                if (src_stats_sorted[i,0] == remove_id):
-                    keep_star[i] = False
-                    i_search = i+1
-                    break
-
-        numpy.savetxt("input", src_stats_sorted)
-        numpy.savetxt("output", src_stats_sorted[keep_star])
+        stars = numpy.asarray(stars)
+        if (stars.dtype == numpy.bool):
+            if (stars.shape != (self.data.shape[0],)):
+                raise ValueError("mask has %d entries for %d stars" % (
+                    stars.shape[0], self.data.shape[0]))
+            remove = stars
+        else:
+            remove = numpy.in1d(self.data['STAR_ID'], stars)
 
-        self.src_stats = src_stats_sorted[keep_star]
-        self.src_phot = src_phot_sorted[keep_star]
+        removed = self.data[remove]
+        self.data = self.data[~remove]
 
-        return
+        return removed
 
     def to_FITS_table(self, name=None):
-        print "converting ALS file to FITS table"
-
-        columns = [
-            pyfits.Column(name="STAR_ID",
-                          format='I', unit="",
-                          array=self.src_stats[:,0].astype(numpy.int)),
-            pyfits.Column(name="X",
-                          format='E', unit="pixels",
-                          array=self.src_stats[:,1]),
-            pyfits.Column(name="Y",
-                          format='E', unit="pixels",
-                          array=self.src_stats[:, 2]),
-
-            pyfits.Column(name="SKY",
-                          format='E', unit="magnitude",
-                          array=self.src_stats[:, 3]),
-            pyfits.Column(name="SKYNOISE",
-                          format='E', unit="magnitude",
-                          array=self.src_stats[:, 4]),
-            pyfits.Column(name="SKYSKEW",
-                          format='E', unit="magnitude",
-                          array=self.src_stats[:, 5]),
-        ]
-        for iap in range(self.n_apertures):
-            columns.extend(
-                [
-                    pyfits.Column(name="MAG_%02d" % (iap+1),
-                          format='E', unit="magnitude",
-                          array=self.src_phot[:, iap, 0]),
-                    pyfits.Column(name="MAGERR_%02d" % (iap+1),
-                          format='E', unit="magnitude",
-                          array=self.src_phot[:, iap, 1]),
-                ]
-            )
-        coldefs = pyfits.ColDefs(columns)
-        tbhdu = pyfits.BinTableHDU.from_columns(coldefs)
-
-        if (name is not None):
-            tbhdu.name = name
-
-        tbhdu.header['NL'] = (self.nl, "")
-        tbhdu.header['NX'] = (self.nx, "img size X")
-        tbhdu.header['NY'] = (self.ny, "img size Y")
-        tbhdu.header['LOWBAD'] = (self.lowbad, "lower good data limit")
-        tbhdu.header['HIGHBAD'] = (self.highbad, "upper good data limit")
-        tbhdu.header['THRESH'] = (self.thresh, "rel. detection threshold")
-        tbhdu.header['AP1'] = (-1 if numpy.isnan(self.ap1) else self.ap1, "radius of first apertures in pixels")
-        tbhdu.header['GAIN'] = (-1 if numpy.isnan(self.gain) else self.gain, "photons/ADU")
-        tbhdu.header['RDNOISE'] = (-1 if numpy.isnan(self.readnoise) else self.readnoise, "readnoise")
-        tbhdu.header['FITRAD'] = (-1 if numpy.isnan(self.fitting_radius) else self.fitting_radius, "user-defined fitting radius [px]")
-
-        return tbhdu
+        logger.debug("converting AP file to FITS table")
+        return catalog_table_hdu(self, self.columns, name=name)
 
 
 class ALSfile(object):
 
-    def __init__(self, fn):
+    # one record per star
+    columns = ALS_COLUMNS
+
+    def __init__(self, fn, cache=False):
         self.filename = fn
 
         self.nl = 0
@@ -839,13 +1733,13 @@ class ALSfile(object):
         self.fiting_radius = numpy.NaN
         self.data = None
 
-        als_return = self.read(self.filename)
+        als_return = cached_read(self.read, self.filename, cache)
         if (als_return is not None):
             stats, data = als_return
 
-            self.nl = stats[0]
-            self.nx = stats[1]
-            self.ny = stats[2]
+            self.nl = int(stats[0])
+            self.nx = int(stats[1])
+            self.ny = int(stats[2])
             self.lowbad = stats[3]
             self.highbad = stats[4]
             self.thresh = stats[5]
@@ -861,11 +1755,11 @@ class ALSfile(object):
             header = f_als.readline()
             stats_line = f_als.readline()
             _ = f_als.readline()
-            data = numpy.loadtxt(f_als)
-
-            # print header.strip()
-            # print stats_line.strip()
-            # print data.shape
+            chunks = list(self._read_chunks(f_als))
+            if (chunks):
+                data = numpy.concatenate(chunks)
+            else:
+                data = numpy.empty(0, dtype=catalog_dtype(self.columns))
 
             #
             # convert stats from string to numbers
@@ -880,111 +1774,89 @@ class ALSfile(object):
 
         return None
 
+    @classmethod
+    def _parse_rows(cls, lines):
+        #
+        # Records from a list of catalog lines. All values of all lines are
+        # converted in one go; lines with missing or extra values need the
+        # slower, line by line loadtxt.
+        #
+        dtype = catalog_dtype(cls.columns)
+        values = numpy.fromstring(" ".join(lines), sep=' ')
+        n_columns = len(dtype.names)
+        n_rows = values.shape[0] / n_columns
+        if (values.shape[0] != n_rows * n_columns or
+                n_rows != len([l for l in lines if l.strip()])):
+            return numpy.loadtxt(lines, dtype=dtype, ndmin=1)
+
+        values = values.reshape((n_rows, n_columns))
+        records = numpy.empty(n_rows, dtype=dtype)
+        for i, name in enumerate(dtype.names):
+            records[name] = values[:, i]
+        return records
+
+    @classmethod
+    def _read_chunks(cls, f, chunk_size=100000):
+        while (True):
+            lines = list(itertools.islice(f, chunk_size))
+            if (not lines):
+                break
+            yield cls._parse_rows(lines)
+
+    @classmethod
+    def select(cls, records, max_chi=None, sharpness=None, mag=None, bbox=None):
+        #
+        # Mask of all records with chi below max_chi, sharpness and
+        # magnitude within the given (min, max) ranges, and positions within
+        # the (x_min, x_max, y_min, y_max) box
+        #
+        good = numpy.ones(records.shape[0], dtype=numpy.bool)
+        if (max_chi is not None):
+            if ('CHI2' not in records.dtype.names):
+                raise ValueError("%s has no chi values" % (cls.__name__))
+            good &= (records['CHI2'] <= max_chi)
+        if (sharpness is not None):
+            good &= (records['SHARPNESS'] >= sharpness[0]) & (records['SHARPNESS'] <= sharpness[1])
+        if (mag is not None):
+            mags = records[cls.columns[3][0]]
+            good &= (mags >= mag[0]) & (mags <= mag[1])
+        if (bbox is not None):
+            good &= (records['X'] >= bbox[0]) & (records['X'] <= bbox[1]) & \
+                    (records['Y'] >= bbox[2]) & (records['Y'] <= bbox[3])
+        return good
+
+    @classmethod
+    def iter_chunks(cls, filename, chunk_size=100000, **selection):
+        #
+        # Read a catalog in chunks of (at most) chunk_size stars without
+        # loading all of it, e.g.
+        #   for stars in ALSfile.iter_chunks(fn, max_chi=2, mag=(14, 20)): ...
+        # keeping only the stars that pass select(); chunks may come out
+        # smaller or even empty with a selection.
+        #
+        with open(filename, "r") as f_cat:
+            for i in range(3):
+                f_cat.readline()
+            for records in cls._read_chunks(f_cat, chunk_size):
+                if (selection):
+                    records = records[cls.select(records, **selection)]
+                yield records
+
     def write(self, filename):
         pass
 
     def to_FITS_table(self, name=None):
-        print "converting ALS file to FITS table"
-
-        columns = [
-            pyfits.Column(name="STAR_ID",
-                          format='I', unit="",
-                          array=self.data[:,0].astype(numpy.int)),
-            pyfits.Column(name="X",
-                          format='E', unit="pixels",
-                          array=self.data[:,1]),
-            pyfits.Column(name="Y",
-                          format='E', unit="pixels",
-                          array=self.data[:, 2]),
-
-            pyfits.Column(name="PSFMAG",
-                          format='E', unit="magnitude",
-                          array=self.data[:, 3]),
-            pyfits.Column(name="PSFMAG_ERR",
-                          format='E', unit="magnitude",
-                          array=self.data[:, 4]),
-
-            pyfits.Column(name="SKY",
-                          format='E', unit="counts",
-                          array=self.data[:, 5]),
-
-            pyfits.Column(name="N_ITERATIONS",
-                          format='I', unit="",
-                          array=self.data[:, 6].astype(numpy.int)),
-            pyfits.Column(name="CHI2",
-                          format='E', unit="",
-                          array=self.data[:, 7]),
-            pyfits.Column(name="SHARPNESS",
-                          format='E', unit="counts",
-                          array=self.data[:, 8]),
-        ]
-        coldefs = pyfits.ColDefs(columns)
-        tbhdu = pyfits.BinTableHDU.from_columns(coldefs)
-
-        if (name is not None):
-            tbhdu.name = name
-
-        tbhdu.header['NL'] = (self.nl, "")
-        tbhdu.header['NX'] = (self.nx, "img size X")
-        tbhdu.header['NY'] = (self.ny, "img size Y")
-        tbhdu.header['LOWBAD'] = (self.lowbad, "lower good data limit")
-        tbhdu.header['HIGHBAD'] = (self.highbad, "upper good data limit")
-        tbhdu.header['THRESH'] = (self.thresh, "rel. detection threshold")
-        tbhdu.header['AP1'] = (-1 if numpy.isnan(self.ap1) else self.ap1, "radius of first apertures in pixels")
-        tbhdu.header['GAIN'] = (-1 if numpy.isnan(self.gain) else self.gain, "photons/ADU")
-        tbhdu.header['RDNOISE'] = (-1 if numpy.isnan(self.readnoise) else self.readnoise, "readnoise")
-        tbhdu.header['FITRAD'] = (-1 if numpy.isnan(self.fitting_radius) else self.fitting_radius, "user-defined fitting radius [px]")
-
-        return tbhdu
+        logger.debug("converting ALS file to FITS table")
+        return catalog_table_hdu(self, self.columns, name=name)
 
 
 class COOfile( ALSfile ):
 
-    def to_FITS_table(self, name=None):
-        print "converting COO file to FITS table"
-
-        columns = [
-            pyfits.Column(name="STAR_ID",
-                          format='I', unit="",
-                          array=self.data[:, 0].astype(numpy.int)),
-            pyfits.Column(name="X",
-                          format='E', unit="pixels",
-                          array=self.data[:, 1]),
-            pyfits.Column(name="Y",
-                          format='E', unit="pixels",
-                          array=self.data[:, 2]),
-
-            pyfits.Column(name="INSTMAG",
-                          format='E', unit="magnitude",
-                          array=self.data[:, 3]),
-
-            pyfits.Column(name="SHARPNESS",
-                          format='E', unit="",
-                          array=self.data[:, 4]),
-            pyfits.Column(name="ROUNDNESS",
-                          format='E', unit="",
-                          array=self.data[:, 5]),
-            pyfits.Column(name="MARGROUND",
-                          format='E', unit="",
-                          array=self.data[:, 6]),
-        ]
-        coldefs = pyfits.ColDefs(columns)
-        tbhdu = pyfits.BinTableHDU.from_columns(coldefs)
-
-        if (name is not None):
-            tbhdu.name = name
+    columns = COO_COLUMNS
 
-        tbhdu.header['NL'] = (self.nl, "")
-        tbhdu.header['NX'] = (self.nx, "img size X")
-        tbhdu.header['NY'] = (self.ny, "img size Y")
-        tbhdu.header['LOWBAD'] = (self.lowbad, "lower good data limit")
-        tbhdu.header['HIGHBAD'] = (self.highbad, "upper good data limit")
-        tbhdu.header['THRESH'] = (self.thresh, "rel. detection threshold")
-        tbhdu.header['AP1'] = (-1 if numpy.isnan(self.ap1) else self.ap1, "radius of first apertures in pixels")
-        tbhdu.header['GAIN'] = (-1 if numpy.isnan(self.gain) else self.gain, "photons/ADU")
-        tbhdu.header['RDNOISE'] = (-1 if numpy.isnan(self.readnoise) else self.readnoise, "readnoise")
-        tbhdu.header['FITRAD'] = (-1 if numpy.isnan(self.fitting_radius) else self.fitting_radius, "user-defined fitting radius [px]")
-        return tbhdu
+    def to_FITS_table(self, name=None):
+        logger.debug("converting COO file to FITS table")
+        return catalog_table_hdu(self, self.columns, name=name)
 
 class ALLSTAR ( object ):
 
@@ -995,9 +1867,13 @@ class ALLSTAR ( object ):
                  als_file=None, 
                  starsub_file=None,
                  dao_dir=None,
+                 start=True,
+                 scripted=False,
+                 verbose=False,
+                 transcript=None,
                  **kwargs):
 
-        print "This all ALLSTAR"
+        logger.debug("Starting ALLSTAR on %s" % (fitsfile))
 
         self.cmd_options = options
         self.fitsfile = fitsfile
@@ -1011,10 +1887,18 @@ class ALLSTAR ( object ):
         self.files['als'] = self.get_file('als') if als_file == None else als_file
         self.files['starsub'] = self.get_file('starsub.fits') if starsub_file == None else starsub_file
 
-        print kwargs
+        logger.debug("ALLSTAR options: %s" % (str(kwargs)))
+        self.allstar_options = kwargs
+        self.scripted = scripted
+        self.verbose = verbose
+        self.transcript = transcript
 
+        #
+        # With start=False the caller has to run start_steps() itself,
+        # e.g. from a SessionLoop
+        #
         self.running = False
-        if (not self.running):
+        if (start):
             self.start_allstar(kwargs)
 
     def get_file(self, extension):
@@ -1022,34 +1906,54 @@ class ALLSTAR ( object ):
 
 
     def start_allstar(self, kwargs):
+        run_steps(self.start_steps(kwargs))
+
+    def start_steps(self, kwargs=None):
+
+        if (kwargs is None):
+            kwargs = self.allstar_options
 
-        self.allstar = ProcessHandler([self.allstar_exe], verbose=True)
-        self.allstar.read_until("OPT>")
+        self.allstar = ProcessHandler([self.allstar_exe], verbose=self.verbose,
+                                      transcript=self.transcript)
+        self.allstar.scripted = self.scripted
+        self.running = True
+        yield self.allstar.expect("OPT>")
 
         for key, value in kwargs.iteritems():
             self.allstar.write("%s = %.2f\n" % (key, value))
-            self.allstar.read_until("OPT>")
+            yield self.allstar.expect("OPT>")
 
         self.allstar.write("\n")
 
-        self.allstar.read_until("Input image name:")
+        yield self.allstar.expect("Input image name:")
         self.allstar.write("%s\n" % (self.fitsfile))
 
-        self.allstar.read_until("File with the PSF")
+        yield self.allstar.expect("File with the PSF")
         self.allstar.write("%s\n" % (self.files['psf']))
 
-        self.allstar.read_until("Input file")
+        yield self.allstar.expect("Input file")
         self.allstar.write("%s\n" % (self.files['ap']))
 
-        self.allstar.read_until("File for results")
+        yield self.allstar.expect("File for results")
         clobberfile(self.files['als'])
         self.allstar.write("%s\n" % (self.files['als']))
 
-        self.allstar.read_until("Name for subtracted image")
+        yield self.allstar.expect("Name for subtracted image")
         clobberfile(self.files['starsub'])
         self.allstar.write("%s\n" % (self.files['starsub']))
 
-        self.allstar.read_until(["Finished", "Good bye"], timeout=-1)
+        # ALLSTAR has to be done before anybody can use its output; wait for
+        # it to exit so its CPU time shows up in os.times() right away
+        _, found = yield self.allstar.expect(["Finished", "Good bye"], timeout=-1, decision=True)
+        returncode = yield WaitExit(self.allstar.proc)
+        self.running = False
+        if (found < 0):
+            raise RuntimeError("ALLSTAR on %s died (exit code %s)" % (self.fitsfile, returncode))
+
+    def kill(self):
+        if (self.running):
+            kill_process(self.allstar)
+        self.running = False
 
     def save_files(self, out_directory):
         if (not os.path.isdir(out_directory)):
@@ -1065,110 +1969,879 @@ class ALLSTAR ( object ):
                 pass
 
 
-    def verify_real_star(self, noise_cutoff=-2, n_max_bad_pixels=2):
-        # open the star-subtracted file
-        print("Opening star-subtracted file: %s" % (self.files['als']))
-        starsub_hdu = pyfits.open(self.files['starsub'])
-        starsub = starsub_hdu[0].data
-        input_hdu = pyfits.open(self.fitsfile)
-        input = input_hdu[0].data
-
+    def verify_real_star(self, noise_cutoff=-2, n_max_bad_pixels=2, batch_size=10000,
+                         memmap=False, workers=1, cache=False):
+        #
+        # With memmap, the star-subtracted and input images are only mapped,
+        # and just the boxes around the sources are ever read from them.
+        # With more than one worker, the sources are split into strips in y
+        # that are checked in parallel; every worker maps the images itself.
+        #
         # load the catalog of all sources computed by allstar
-        als = ALSfile(self.files['als'])
+        als = ALSfile(self.files['als'], cache=cache)
         data = als.data
 
-        noise = numpy.sqrt( numpy.fabs(input)*als.gain + als.readnoise**2)
-        avg_sky = numpy.median(data[:,5])
-
-        # add some padding to the input image to avoid problems for
-        # sources close to any of the edges
         fitting_radius = int(numpy.round(als.fitting_radius,0))
-        img_padded = numpy.pad(
-            starsub,
-            pad_width=int(fitting_radius),
-            mode='constant',
-            constant_values=numpy.NaN
-        )
-        noise_padded = numpy.pad(
-            noise,
-            pad_width=int(fitting_radius),
-            mode='constant',
-            constant_values=numpy.NaN
-        )
-        is_star = numpy.isfinite(data[:,0])
+        kwargs = {
+            'gain': als.gain,
+            'readnoise': als.readnoise,
+            'fitting_radius': fitting_radius,
+            'n_max_bad_pixels': n_max_bad_pixels,
+            'batch_size': batch_size,
+        }
+
+        # processes of a multiprocessing.Pool (e.g. daophot_batch) can't have their own
+        if (workers > 1 and multiprocessing.current_process().daemon):
+            logger.debug("running in a daemon process, checking residuals in a single process")
+            workers = 1
+
+        is_star = numpy.ones(data.shape[0], dtype=numpy.bool)
+        if (workers > 1 and data.shape[0] > 1):
+            order = numpy.argsort(data['Y'], kind='mergesort')
+            chunks = numpy.array_split(order, min(data.shape[0], 4*workers))
+            pool = multiprocessing.Pool(processes=workers)
+            try:
+                results = pool.map(
+                    _verify_sources_chunk,
+                    [(self.files['starsub'], self.fitsfile, data[chunk], kwargs) for chunk in chunks])
+            finally:
+                pool.close()
+                pool.join()
+            for chunk, chunk_is_star in zip(chunks, results):
+                is_star[chunk] &= chunk_is_star
+        else:
+            logger.debug("Opening star-subtracted file: %s" % (self.files['starsub']))
+            starsub_hdu = pyfits.open(self.files['starsub'], memmap=memmap)
+            input_hdu = pyfits.open(self.fitsfile, memmap=memmap)
+            is_star &= verify_sources(starsub_hdu[0].data, input_hdu[0].data, data, **kwargs)
+            starsub_hdu.close()
+            input_hdu.close()
+
+        bad_stars = data[~is_star]
+        self.files['bad_stars'] = self.get_file("bad_stars")
+        numpy.savetxt(self.files['bad_stars'], bad_stars)
+
+        bad_star_ids = data[~is_star]['STAR_ID']
+        return bad_star_ids
+
+    def cleanup(self):
+        for x in self.files:
+            remove_file(self.files[x])
 
-        # phdu = pyfits.PrimaryHDU(
-        #     data=((img_padded-avg_sky)/noise_padded)[fitting_radius:-fitting_radius, fitting_radius:-fitting_radius])
-        # phdu.writeto("s2n.fits", clobber=True)
+def verify_sources(starsub, input, sources, gain, readnoise, fitting_radius,
+                   n_max_bad_pixels=2, batch_size=10000):
+    #
+    # Check the ALLSTAR residuals around all sources (rows of an ALS
+    # catalog), a batch at a time to limit the size of the stamp cubes.
+    # Each stamp is the (2*fitting_radius)^2 box whose lower left corner is
+    # fitting_radius pixels below/left of the rounded source position;
+    # pixels off the frame are NaN and simply do not count. Only the
+    # stamps are read from the images, and the noise is only computed
+    # within them. Returns True for all sources that look like real stars.
+    #
+    is_star = numpy.ones(sources.shape[0], dtype=numpy.bool)
+
+    box = numpy.arange(2*fitting_radius) - fitting_radius
+    for first in range(0, sources.shape[0], batch_size):
+        src = sources[first:first+batch_size]
+        # same rounding (half to even) as for the box positions before
+        x0 = numpy.round(src['X'], 0).astype(numpy.int)
+        y0 = numpy.round(src['Y'], 0).astype(numpy.int)
+        iy = y0[:, None] + box[None, :]
+        ix = x0[:, None] + box[None, :]
 
-        for isrc, src in enumerate(als.data):
-            center_x = src[1]
-            center_y = src[2]
-            local_sky = src[5]
-            # print center_x, center_y, src
+        residual = stamp_cube(starsub, iy, ix)
+        noise = stamp_cube(input, iy, ix)
+        noise = numpy.sqrt(numpy.fabs(noise)*gain + readnoise**2)
 
-            cx = int(numpy.round(center_x,0)) + fitting_radius
-            cy = int(numpy.round(center_y, 0)) + fitting_radius
+        # subtract the sky at image precision, just like a scalar would
+        local_sky = src['SKY'].astype(residual.dtype).reshape((-1, 1, 1))
+        s2n = (residual - local_sky) / noise
+        good_stamps = verify_stamps(s2n.reshape((src.shape[0], -1)), n_max_bad_pixels)
 
-            box = img_padded[cy-fitting_radius:cy+fitting_radius, cx-fitting_radius:cx+fitting_radius]
-            good = box[numpy.isfinite(box)]
-            if (good.size <= 0):
-                is_star[isrc] = False
+        # boxes starting left of/below the frame plus padding came out
+        # empty (or wrapped around to the opposite edge) before; reject those
+        good_stamps[(x0 < 0) | (y0 < 0)] = False
 
-            noise_box = noise_padded[cy-fitting_radius:cy+fitting_radius, cx-fitting_radius:cx+fitting_radius]
-            s2n = (box - local_sky) / noise_box
+        is_star[first:first+batch_size] = good_stamps
 
-            bad_pixels = s2n < noise_cutoff
+    return is_star
 
-            # calculate local noise from the std.deviation of the s/n residuals
-            good_s2n = s2n[numpy.isfinite(s2n)]
 
-            if (good_s2n.size <= 0):
-                # all pixels invalid, mark this source as bad and move on
-                is_star[isrc] = False
+def _verify_sources_chunk(args):
+    #
+    # verify_sources() for one chunk of sources, as run in a worker process;
+    # only the filenames travel to the worker, the images are memory-mapped
+    #
+    starsub_fn, input_fn, sources, kwargs = args
+    starsub_hdu = pyfits.open(starsub_fn, memmap=True)
+    input_hdu = pyfits.open(input_fn, memmap=True)
+    try:
+        return verify_sources(starsub_hdu[0].data, input_hdu[0].data, sources, **kwargs)
+    finally:
+        starsub_hdu.close()
+        input_hdu.close()
+
+
+def stamp_cube(img, iy, ix):
+    #
+    # Gather the stamps img[iy[i], :][:, ix[i]] for all sources i into one
+    # (n, len(iy[i]), len(ix[i])) cube; pixels outside img are NaN
+    #
+    valid = ((iy >= 0) & (iy < img.shape[0]))[:, :, None] & \
+            ((ix >= 0) & (ix < img.shape[1]))[:, None, :]
+    cube = img[numpy.clip(iy, 0, img.shape[0]-1)[:, :, None],
+               numpy.clip(ix, 0, img.shape[1]-1)[:, None, :]]
+    cube[~valid] = numpy.NaN
+    return cube
+
+
+def verify_stamps(s2n, n_max_bad_pixels):
+    #
+    # s2n holds the S/N residuals of one source per row. Find the noise
+    # level of each row from three rounds of 3-sigma clipping, then count
+    # pixels that are over- and under-subtracted beyond 3 sigma. Returns
+    # True for all rows that look like real stars.
+    #
+    is_star = numpy.zeros(s2n.shape[0], dtype=numpy.bool)
+
+    # rows without any valid pixel are not stars
+    valid = numpy.any(numpy.isfinite(s2n), axis=1)
+    s2n = s2n[valid]
+    if (s2n.shape[0] <= 0):
+        return is_star
+
+    #
+    # Sort every row once, with undefined pixels at the end. Clipping around
+    # the median only ever drops values from both ends, so the pixels left
+    # in each row are always the sorted ones from first to last-1, and the
+    # percentiles can be picked from there for all rows at once
+    #
+    sorted_s2n = s2n.copy()
+    sorted_s2n[~numpy.isfinite(s2n)] = numpy.inf
+    sorted_s2n.sort(axis=1)
+    rows = numpy.arange(s2n.shape[0])
+    first = numpy.zeros(s2n.shape[0], dtype=numpy.int)
+    last = numpy.sum(numpy.isfinite(s2n), axis=1)
+
+    def percentile(q):
+        # linear interpolation, like numpy.percentile
+        position = first + (last - first - 1) * (q / 100.)
+        lower = numpy.floor(position).astype(numpy.int)
+        upper = numpy.minimum(lower + 1, last - 1)
+        value = sorted_s2n[rows, lower]
+        return value + (sorted_s2n[rows, upper] - value) * (position - lower)
+
+    for iter in range(3):
+        _median = percentile(50).reshape((-1, 1))
+        _sigma = ((percentile(84) - percentile(16)) / 2.).reshape((-1, 1))
+        first = numpy.maximum(first, numpy.sum(sorted_s2n < (_median - 3*_sigma), axis=1))
+        last = numpy.minimum(last, numpy.sum(sorted_s2n <= (_median + 3*_sigma), axis=1))
+
+    # now count how many outliers we have that lie outside the 3-sigma noise range
+    over_subtracted = numpy.sum(s2n < (_median - 3*_sigma), axis=1)
+    under_subtracted = numpy.sum(s2n > (_median + 3*_sigma), axis=1)
+    excess = over_subtracted - under_subtracted
+    is_star[valid] = (excess <= n_max_bad_pixels)
+
+    return is_star
+
+
+def find_psf_candidates(img, fields, gain=1.0, threshold=5., box_radius=5,
+                        isolation=None, saturation=None, zeropoint=26.0,
+                        batch_size=10000):
+    #
+    # Stand-in for the SExtractor run of pick_midrange: find all peaks more
+    # than threshold sigma above the sky in the smoothed image and measure
+    # them from the first and second moments within box_radius. The result has the columns
+    # named in fields, with the same meaning as in SExtractor (those we do
+    # not measure are NaN). FLAGS mark sources with a neighbour closer than
+    # isolation pixels (1), near saturation (4), or touching the edge or
+    # undefined pixels (8).
+    #
+    if (isolation is None):
+        isolation = 2 * box_radius
+
+    # sky level and noise from a subsample of the frame
+    sample = numpy.asarray(img[::4, ::4], dtype=numpy.float32)
+    sample = sample[numpy.isfinite(sample)]
+    sky = numpy.median(sample)
+    sky_sigma = 1.4826 * numpy.median(numpy.fabs(sample - sky))
+
+    #
+    # peaks in the slightly smoothed image
+    #
+    filled = numpy.array(img, dtype=numpy.float32)
+    undefined = ~numpy.isfinite(filled)
+    filled[undefined] = sky
+    smoothed = scipy.ndimage.gaussian_filter(filled, sigma=1.0)
+    sample = smoothed[::4, ::4]
+    smoothed_sigma = 1.4826 * numpy.median(numpy.fabs(sample - numpy.median(sample)))
+    peaks = (smoothed == scipy.ndimage.maximum_filter(smoothed, size=5)) & \
+            (smoothed > sky + threshold * smoothed_sigma)
+    del smoothed
+    cy, cx = numpy.nonzero(peaks)
+    del peaks
+
+    #
+    # moments of the sky-subtracted, positive pixels around each peak;
+    # positions are 1-based like in SExtractor and DAOPhot
+    #
+    box = numpy.arange(-box_radius, box_radius+1)
+    n_pixels = box.shape[0]**2
+    dy = box[None, :, None].astype(numpy.float64)
+    dx = box[None, None, :].astype(numpy.float64)
+    n_peaks = cx.shape[0]
+    incomplete = numpy.zeros(n_peaks, dtype=numpy.bool)
+    flux, mx, my, sxx, syy, sxy = [numpy.zeros(n_peaks) for i in range(6)]
+
+    # stamp the peaks in batches to keep the temporary arrays small
+    for first in range(0, n_peaks, batch_size):
+        last = min(first + batch_size, n_peaks)
+        iy = cy[first:last, None] + box[None, :]
+        ix = cx[first:last, None] + box[None, :]
+        stamps = stamp_cube(img, iy, ix) - sky
+        incomplete[first:last] = numpy.any(
+            ~numpy.isfinite(stamps.reshape((last - first, n_pixels))), axis=1)
+        stamps[~numpy.isfinite(stamps)] = 0.
+        flux[first:last] = numpy.sum(stamps, axis=(1, 2))
+        weight = numpy.clip(stamps, 0, None)
+        total = numpy.sum(weight, axis=(1, 2))
+        total[total <= 0] = numpy.NaN
+
+        mx[first:last] = numpy.sum(weight * dx, axis=(1, 2)) / total
+        my[first:last] = numpy.sum(weight * dy, axis=(1, 2)) / total
+        sxx[first:last] = numpy.sum(weight * dx**2, axis=(1, 2)) / total - mx[first:last]**2
+        syy[first:last] = numpy.sum(weight * dy**2, axis=(1, 2)) / total - my[first:last]**2
+        sxy[first:last] = numpy.sum(weight * dx * dy, axis=(1, 2)) / total - \
+                          mx[first:last] * my[first:last]
+
+    root = numpy.sqrt(((sxx - syy) / 2.)**2 + sxy**2)
+    a = numpy.sqrt(numpy.clip((sxx + syy) / 2. + root, 0, None))
+    b = numpy.sqrt(numpy.clip((sxx + syy) / 2. - root, 0, None))
+
+    mag = zeropoint - 2.5 * numpy.log10(flux)
+    magerr = 1.0857 * numpy.sqrt(numpy.clip(flux, 0, None) / gain + n_pixels * sky_sigma**2) / flux
+
+    #
+    # flags: crowding, saturation and incomplete stamps
+    #
+    flags = numpy.zeros(cx.shape[0], dtype=numpy.int32)
+    if (cx.shape[0] > 1):
+        tree = scipy.spatial.cKDTree(numpy.array([cx, cy]).T)
+        distance, _ = tree.query(numpy.array([cx, cy]).T, k=2)
+        flags[distance[:, 1] < isolation] |= 1
+    peak = filled[cy, cx]
+    if (saturation is not None):
+        flags[peak >= 0.9 * saturation] |= 4
+    flags[incomplete] |= 8
+
+    columns = {
+        'NUMBER': numpy.arange(1, cx.shape[0]+1),
+        'XWIN_IMAGE': cx + mx + 1,
+        'YWIN_IMAGE': cy + my + 1,
+        'FWHM_IMAGE': 2.3548 * numpy.sqrt(numpy.clip((sxx + syy) / 2., 0, None)),
+        'BACKGROUND': numpy.ones(cx.shape[0]) * sky,
+        'FLAGS': flags,
+        'EXT_NUMBER': numpy.ones(cx.shape[0]),
+        'MAG_AUTO': mag,
+        'MAGERR_AUTO': magerr,
+        'FLUX_MAX': peak - sky,
+        'AWIN_IMAGE': a,
+        'BWIN_IMAGE': b,
+        'THETA_IMAGE': numpy.degrees(0.5 * numpy.arctan2(2 * sxy, sxx - syy)),
+        'ELONGATION': a / b,
+        'ELLIPTICITY': 1. - b / a,
+    }
+    int_fields = ['NUMBER', 'FLAGS', 'EXT_NUMBER']
+    catalog = numpy.empty(cx.shape[0], dtype=[
+        (f, numpy.int32 if f in int_fields else numpy.float32) for f in fields])
+    for f in fields:
+        catalog[f] = columns[f] if f in columns else numpy.NaN
+
+    return catalog
+
+
+def process_cpu_time(pid):
+    #
+    # CPU seconds (user+system, including waited-for children) used so far
+    # by a process that has not been reaped yet; Linux only, None otherwise
+    #
+    try:
+        with open("/proc/%d/stat" % (pid), "r") as sf:
+            fields = sf.read().rsplit(")", 1)[1].split()
+    except (IOError, OSError, IndexError):
+        return None
+    ticks = sum([int(f) for f in fields[11:15]])
+    return ticks / float(os.sysconf('SC_CLK_TCK'))
+
+
+def count_catalog_stars(filename, lines_per_star=1):
+    #
+    # Number of sources in a DAOPhot catalog (COO/AP/LST/ALS), without
+    # parsing it
+    #
+    if (not os.path.isfile(filename)):
+        return 0
+    with open(filename, "r") as cf:
+        n_lines = sum(1 for line in cf if line.strip())
+    return max(0, n_lines - 2) / lines_per_star
+
+
+def prepare_image(filename, out_fn, prescale=1.0, add_sky=0.0, weightfile=None,
+                  chunk_size=16*2**20, extension=0):
+    #
+    # Write the image DAOPhot works on: undefined pixels (weight <= 0) set
+    # to NaN, then pre-scaled and with the background re-added, as 32-bit
+    # floats. Input and weights are memory-mapped and unscaled, and the
+    # image is converted in blocks of rows of about chunk_size bytes, so
+    # the full frame is never in memory.
+    #
+    # The image (and weights) come from the given extension, and always
+    # end up in the primary HDU of out_fn.
+    #
+    hdulist = pyfits.open(filename, memmap=True, do_not_scale_image_data=True)
+    img = hdulist[extension].data
+    bscale = hdulist[extension].header.get('BSCALE', 1.)
+    bzero = hdulist[extension].header.get('BZERO', 0.)
+    # integer frames mark undefined pixels with BLANK, which is only turned
+    # into NaN when pyfits scales the data itself
+    blank = hdulist[extension].header.get('BLANK') if img.dtype.kind in 'iu' else None
+
+    weights = None
+    if (weightfile is not None):
+        weights_hdu = pyfits.open(weightfile, memmap=True, do_not_scale_image_data=True)
+        weights = weights_hdu[extension].data
+        w_bscale = weights_hdu[extension].header.get('BSCALE', 1.)
+        w_bzero = weights_hdu[extension].header.get('BZERO', 0.)
+        w_blank = weights_hdu[extension].header.get('BLANK') if weights.dtype.kind in 'iu' else None
+
+    header = hdulist[extension].header.copy()
+    if ('XTENSION' in header):
+        #
+        # turn the extension header into a primary one; GAIN, RDNOISE and
+        # SATURATE fall back to the values in the primary header
+        #
+        for key in ['XTENSION', 'PCOUNT', 'GCOUNT']:
+            if (key in header):
+                del header[key]
+        header.insert(0, ('SIMPLE', True))
+        for key in ['GAIN', 'RDNOISE', 'SATURATE']:
+            if (key not in header and key in hdulist[0].header):
+                header[key] = hdulist[0].header[key]
+    # the saturation level has to be in the units of the written pixels
+    if ('SATURATE' in header):
+        header['SATURATE'] = header['SATURATE'] * prescale + add_sky
+    header['BITPIX'] = -32
+    for key in ['BSCALE', 'BZERO', 'BLANK']:
+        if (key in header):
+            del header[key]
+
+    if (os.path.isfile(out_fn) and os.path.getsize(out_fn) > 0):
+        os.remove(out_fn)
+    out_hdu = pyfits.StreamingHDU(out_fn, header)
+
+    n_rows = max(1, chunk_size / (4 * img.shape[-1]))
+    for first in range(0, img.shape[0], n_rows):
+        raw = img[first:first+n_rows]
+        block = raw.astype(numpy.float32)
+        if (blank is not None):
+            block[raw == blank] = numpy.NaN
+        if (bscale != 1 or bzero != 0):
+            block *= bscale
+            block += bzero
+        if (weights is not None):
+            raw_w = weights[first:first+n_rows]
+            w = raw_w
+            if (w_bscale != 1 or w_bzero != 0):
+                w = w * w_bscale + w_bzero
+            block[w <= 0] = numpy.NaN
+            if (w_blank is not None):
+                block[raw_w == w_blank] = numpy.NaN
+        block *= prescale
+        block += add_sky
+        out_hdu.write(block)
+
+    out_hdu.close()
+    hdulist.close()
+    if (weights is not None):
+        weights_hdu.close()
+
+
+def image_extensions(filename):
+    #
+    # All HDUs of a FITS file that hold a 2-d image, e.g. the OTAs of an
+    # ODI frame; just [0] for a plain image
+    #
+    hdulist = pyfits.open(filename, memmap=True)
+    extensions = [i for i, hdu in enumerate(hdulist)
+                  if (hdu.header.get('NAXIS', 0) == 2 and
+                      hdu.header.get('XTENSION', 'IMAGE') == 'IMAGE')]
+    hdulist.close()
+    return extensions
+
+
+def free_space(path):
+    try:
+        st = os.statvfs(path)
+    except OSError:
+        return 0
+    return st.f_bavail * st.f_frsize
+
+
+class Workspace( object ):
+    #
+    # Private directory for all intermediate files of one Daophot run. It
+    # is created on fast_dir (a tmpfs like /dev/shm) if that has room for
+    # the given number of bytes, otherwise in scratch_dir. cleanup() first
+    # renames the directory, so it disappears in one step, and then
+    # removes it with all its content; with keep=True it stays for
+    # inspection.
+    #
+    # With a name, the workspace is the directory of that name, and keeps
+    # whatever an earlier run left there.
+    #
+
+    def __init__(self, scratch_dir, fast_dir=None, needed=0, prefix="dao_", name=None):
+        base_dir = scratch_dir
+        if (fast_dir is not None and os.path.isdir(fast_dir) and
+                free_space(fast_dir) > needed):
+            base_dir = fast_dir
+        if (name is not None):
+            self.path = os.path.join(base_dir, name)
+            if (not os.path.isdir(self.path)):
+                os.makedirs(self.path)
+        else:
+            self.path = tempfile.mkdtemp(prefix=prefix, dir=base_dir)
+        logger.debug("workspace: %s" % (self.path))
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def cleanup(self, keep=False):
+        if (self.path is None):
+            return
+        if (keep):
+            logger.warning("keeping workspace %s" % (self.path))
+            return
+
+        trash = self.path + ".deleted"
+        try:
+            os.rename(self.path, trash)
+        except OSError:
+            trash = self.path
+        shutil.rmtree(trash, ignore_errors=True)
+        self.path = None
+
+
+def tile_regions(nx, ny, tile_size, overlap):
+    #
+    # Split an nx x ny frame into tiles of at most tile_size pixels. The
+    # tile cores ('core': x0, x1, y0, y1, 0-based with exclusive ends) cover
+    # the frame without gaps or overlaps; every tile ('box') extends overlap
+    # pixels beyond its core.
+    #
+    def edges(n):
+        n_tiles = max(1, int(numpy.ceil(float(n) / tile_size)))
+        return [int(e) for e in numpy.linspace(0, n, n_tiles + 1).round()]
+
+    x_edges = edges(nx)
+    y_edges = edges(ny)
+    regions = []
+    for cy0, cy1 in zip(y_edges[:-1], y_edges[1:]):
+        for cx0, cx1 in zip(x_edges[:-1], x_edges[1:]):
+            regions.append({
+                'core': (cx0, cx1, cy0, cy1),
+                'box': (max(0, cx0 - overlap), min(nx, cx1 + overlap),
+                        max(0, cy0 - overlap), min(ny, cy1 + overlap)),
+            })
+    return regions
+
+
+def merge_tile_catalogs(tables, regions, x_field='X', y_field='Y', match_radius=1.0,
+                        ids=None, id_field='STAR_ID'):
+    #
+    # Combine the catalogs of several tiles (record arrays with 1-based
+    # positions in tile coordinates) into one in frame coordinates. Every
+    # tile contributes the stars within match_radius of its core; of
+    # stars from different tiles closer than match_radius to each other,
+    # only the one furthest from the edge of its tile is kept.
+    #
+    # With ids, that choice has already been made (e.g. on the merged COO
+    # catalog), and only the stars with one of these id_field values are
+    # kept, so the merged catalogs of a frame all have the same stars.
+    #
+    # Empty catalogs are skipped: an AP file without stars does not tell
+    # the number of apertures, so its records do not fit the others.
+    #
+    parts = []
+    tile_index = []
+    margins = []
+    for i, (table, region) in enumerate(zip(tables, regions)):
+        if (table.shape[0] == 0):
+            continue
+        x0, x1, y0, y1 = region['box']
+        cx0, cx1, cy0, cy1 = region['core']
+        table = table.copy()
+        table[x_field] += x0
+        table[y_field] += y0
+        if (ids is not None):
+            parts.append(table[numpy.in1d(table[id_field], ids)])
+            continue
+        x = table[x_field]
+        y = table[y_field]
+        owned = (x > cx0 + 0.5 - match_radius) & (x <= cx1 + 0.5 + match_radius) & \
+                (y > cy0 + 0.5 - match_radius) & (y <= cy1 + 0.5 + match_radius)
+        table = table[owned]
+        x = x[owned]
+        y = y[owned]
+        parts.append(table)
+        tile_index.append(numpy.ones(table.shape[0], dtype=numpy.int32) * i)
+        margins.append(numpy.min([x - (x0 + 0.5), (x1 + 0.5) - x,
+                                  y - (y0 + 0.5), (y1 + 0.5) - y], axis=0))
+
+    if (not parts):
+        return tables[0][:0].copy()
+    merged = numpy.concatenate(parts)
+    if (ids is not None):
+        return merged
+    tile_index = numpy.concatenate(tile_index)
+    margins = numpy.concatenate(margins)
+
+    keep = numpy.ones(merged.shape[0], dtype=numpy.bool)
+    if (merged.shape[0] > 1):
+        tree = scipy.spatial.cKDTree(
+            numpy.array([merged[x_field], merged[y_field]], dtype=numpy.float64).T)
+        pairs = numpy.array(sorted(tree.query_pairs(match_radius)), dtype=numpy.int64).reshape((-1, 2))
+        pairs = pairs[tile_index[pairs[:, 0]] != tile_index[pairs[:, 1]]]
+        worse = numpy.where(margins[pairs[:, 0]] < margins[pairs[:, 1]], pairs[:, 0], pairs[:, 1])
+        keep[worse] = False
+    return merged[keep]
+
+
+class PSFCache( object ):
+    #
+    # PSF models (DAOPhot .psf files) of earlier frames, to be used again
+    # for frames from the same detector (and extension) and filter, with
+    # the same size and PSF options, taken in the same night with a FWHM
+    # within fwhm_tolerance (relative). The models and an index live in
+    # cache_dir, so several processes can share a cache; every change of
+    # the index, and every copy out of the cache, happens while holding a
+    # lock on cache_dir/index.lock. Beyond max_entries, the least recently
+    # used models are removed.
+    #
+    # When no PSF can be derived for a frame, recent() offers the latest
+    # model for the same key (apart from the night) that is no older than
+    # max_fallback_age hours (0 disables this).
+    #
+    # Nights start at day_change_ut (UT hours, about local noon at the
+    # telescope).
+    #
+    # The detector is DETECTOR (or INSTRUME), followed by the values of
+    # those detector_keys in the header, e.g. the SDSS camera column or
+    # the CCD of a mosaic camera.
+    #
+
+    def __init__(self, cache_dir, max_entries=100, fwhm_tolerance=0.1,
+                 max_fallback_age=24., day_change_ut=12.,
+                 detector_keys=['EXTNAME', 'CAMCOL', 'CCDNUM']):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.fwhm_tolerance = fwhm_tolerance
+        self.max_fallback_age = max_fallback_age
+        self.day_change_ut = day_change_ut
+        self.detector_keys = list(detector_keys)
+
+        self.index_fn = os.path.join(self.cache_dir, "index.json")
+        self.lock_fn = os.path.join(self.cache_dir, "index.lock")
+        if (not os.path.isdir(self.cache_dir)):
+            os.makedirs(self.cache_dir)
+
+    def key(self, header, psf_width, fitting_radius):
+        #
+        # detector, filter, image size and night of a frame from its
+        # header, and the DAOPhot options the PSF depends on
+        #
+        detector = str(header.get('DETECTOR', header.get('INSTRUME', "unknown")))
+        for key in self.detector_keys:
+            if (key in header):
+                detector += "/%s" % (header[key])
+
+        night = "unknown"
+        date_obs = str(header.get('DATE-OBS', ""))
+        for date_format in ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"]:
+            try:
+                obs_time = datetime.datetime.strptime(date_obs[:19], date_format)
+            except ValueError:
                 continue
+            night = (obs_time - datetime.timedelta(hours=self.day_change_ut)).date().isoformat()
+            break
+
+        return {
+            'detector': detector,
+            'filter': str(header.get('FILTER', "unknown")),
+            'naxis1': int(header.get('NAXIS1', 0)),
+            'naxis2': int(header.get('NAXIS2', 0)),
+            'psf_width': float(psf_width),
+            'fitting_radius': float(fitting_radius),
+            'night': night,
+        }
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(self.lock_fn, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_index(self):
+        try:
+            with open(self.index_fn, "r") as index_file:
+                entries = json.load(index_file)
+        except (IOError, ValueError):
+            return []
+        return [e for e in entries
+                if os.path.isfile(os.path.join(self.cache_dir, e['file']))]
+
+    def _save_index(self, entries):
+        # write to a temporary file first so readers never see half an index
+        tmp_fn = self.index_fn + ".tmp%d" % (os.getpid())
+        with open(tmp_fn, "w") as index_file:
+            json.dump(entries, index_file, indent=2)
+        os.rename(tmp_fn, self.index_fn)
+
+    def lookup(self, key, fwhm, psf_fn):
+        #
+        # Copy the cached model for this key closest in FWHM to psf_fn;
+        # returns the name of the cached model, or None if there is none
+        # within the tolerance
+        #
+        if (not numpy.isfinite(fwhm)):
+            return None
+        with self._locked():
+            entries = self._load_index()
+            matches = [e for e in entries
+                       if (all([e.get(k) == key[k] for k in key]) and
+                           abs(e['fwhm'] - fwhm) <= self.fwhm_tolerance * fwhm)]
+            if (not matches):
+                return None
+
+            best = min(matches, key=lambda e: abs(e['fwhm'] - fwhm))
+            cache_fn = os.path.join(self.cache_dir, best['file'])
+            shutil.copyfile(cache_fn, psf_fn)
+            best['last_used'] = time.time()
+            self._save_index(entries)
+        return cache_fn
+
+    def recent(self, key, psf_fn):
+        #
+        # Copy the latest model for the same key, from any night, to
+        # psf_fn; returns its name, or None
+        #
+        now = time.time()
+        with self._locked():
+            matches = [e for e in self._load_index()
+                       if (all([e.get(k) == key[k] for k in key if k != 'night']) and
+                           now - e['created'] <= self.max_fallback_age * 3600.)]
+            if (not matches):
+                return None
+            cache_fn = os.path.join(self.cache_dir, max(matches, key=lambda e: e['created'])['file'])
+            shutil.copyfile(cache_fn, psf_fn)
+        return cache_fn
+
+    def store(self, key, fwhm, psf_fn):
+        if (not numpy.isfinite(fwhm)):
+            return
 
-            for iter in range(3):
-                noise_stats = numpy.nanpercentile(good_s2n, [16, 84, 50])
-                _median = noise_stats[2]
-                _sigma = (noise_stats[1] - noise_stats[0]) / 2.
-                _outlier = (good_s2n < (_median - 3*_sigma)) | (good_s2n > (_median+3*_sigma))
-                good_s2n[_outlier] = numpy.NaN
-
-            # now count how many outliers we have that lie outside the 3-sigma noise range
-            over_subtracted = s2n < (_median - 3*_sigma)
-            under_subtracted = s2n > (_median +3*_sigma)
-            excess = numpy.sum(over_subtracted) - numpy.sum(under_subtracted)
-            if (excess > n_max_bad_pixels):
-                is_star[isrc] = False
-
-            # if (numpy.sum(bad_pixels) > n_max_bad_pixels):
-            #     is_star[isrc] = False
-
-            # src_id = src[0]
-            # dummy = numpy.empty((box.shape[0], box.shape[1], 5))
-            # dummy[:,:,0] = box[:,:]
-            # dummy[:,:,1] = noise_box[:,:]
-            # dummy[:,:,2] = (box-local_sky)[:,:]
-            # dummy[:,:,3] = s2n[:,:]
-            # dummy[:,:,4] = (s2n > (_median+3*_sigma)) | (s2n < (_median-3*_sigma))
-            # numpy.savetxt("residuals.%04d" % (src_id), dummy.reshape((-1,5)),
-            #               header="NOISE: %f %f %f %f %d %d" % (
-            #                   _median, _sigma, noise_stats[0], noise_stats[1],
-            #               numpy.sum(under_subtracted), numpy.sum(over_subtracted)))
+        with self._locked():
+            fd, cache_fn = tempfile.mkstemp(prefix="psf_", suffix=".psf", dir=self.cache_dir)
+            os.close(fd)
+            shutil.copyfile(psf_fn, cache_fn)
+
+            entries = self._load_index()
+            entry = dict(key)
+            entry.update({
+                'file': os.path.basename(cache_fn),
+                'fwhm': float(fwhm),
+                'created': time.time(),
+                'last_used': time.time(),
+            })
+            entries.append(entry)
+
+            # evict the least recently used models
+            entries.sort(key=lambda e: e['last_used'])
+            while (len(entries) > self.max_entries):
+                evicted = entries.pop(0)
+                remove_file(os.path.join(self.cache_dir, evicted['file']))
+
+            # ... and models no index entry refers to (e.g. after a crash)
+            indexed = set([e['file'] for e in entries])
+            for fn in os.listdir(self.cache_dir):
+                if (fn.startswith("psf_") and fn.endswith(".psf") and fn not in indexed):
+                    remove_file(os.path.join(self.cache_dir, fn))
+            self._save_index(entries)
+
+
+class Checkpoint( object ):
+    #
+    # Manifest of the finished stages of a Daophot run, saved as JSON after
+    # every stage: the parameters of each stage, the MD5 of its input
+    # files, and its output files with their MD5. A new run in the same
+    # workspace re-uses the outputs of all stages up to the first one whose
+    # parameters or inputs changed (or whose outputs are gone); everything
+    # from there on runs again.
+    #
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.resuming = True
+        self.md5s = {}
+        self.stages = {}
+        if (os.path.isfile(self.filename)):
+            try:
+                with open(self.filename, "r") as cf:
+                    self.stages = json.load(cf)
+            except ValueError:
+                logger.warning("unreadable checkpoint %s, starting over" % (self.filename))
+
+    def md5(self, filename):
+        # computed once for every version of a file
+        st = os.stat(filename)
+        key = (filename, st.st_size, st.st_mtime)
+        if (key not in self.md5s):
+            self.md5s[key] = file_md5(filename)
+        return self.md5s[key]
+
+    def fingerprint(self, files):
+        return dict([(name, self.md5(fn)) for name, fn in files.items() if fn is not None])
+
+    def reuse(self, stage, params, inputs):
+        #
+        # Output files (by name) of this stage from an earlier run, or None
+        # if the stage has to run
+        #
+        record = self.stages.get(stage)
+        if (self.resuming and record is not None and
+                record['params'] == json.loads(json.dumps(params)) and
+                record['inputs'] == self.fingerprint(inputs) and
+                all([os.path.isfile(o['file']) and self.md5(o['file']) == o['md5']
+                     for o in record['outputs'].values()])):
+            return dict([(str(name), str(o['file'])) for name, o in record['outputs'].items()])
+        self.resuming = False
+        return None
 
+    def done(self, stage, params, inputs, outputs):
+        self.stages[stage] = {
+            'params': json.loads(json.dumps(params)),
+            'inputs': self.fingerprint(inputs),
+            'outputs': dict([(name, {'file': fn, 'md5': self.md5(fn)})
+                             for name, fn in outputs.items()]),
+        }
 
-        bad_stars = data[~is_star]
-        numpy.savetxt("bad_stars", bad_stars)
+        # write to a temporary file first so readers never see half a manifest
+        tmp_fn = self.filename + ".tmp%d" % (os.getpid())
+        with open(tmp_fn, "w") as cf:
+            json.dump(self.stages, cf, indent=2)
+        os.rename(tmp_fn, self.filename)
 
-        bad_star_ids = data[~is_star][:,0]
-        return bad_star_ids
 
-    def cleanup(self):
-        for x in self.files:
-            fn = self.files[x]
-            if (os.path.isfile(fn)):
-                os.remove(fn)
+class StageProfile( object ):
+    #
+    # Wall time, CPU time of the DAOPhot/ALLSTAR/SExtractor child processes,
+    # and number of stars for every stage of a Daophot run.
+    #
+    # Child CPU time combines os.times() (processes we already waited for,
+    # e.g. SExtractor and ALLSTAR) with /proc readings for the watched,
+    # long running DAOPhot session. A watched process has to be unwatched
+    # before it is waited for, or os.times() counts it a second time. When
+    # frames run in a SessionLoop, the wall time of a stage includes
+    # waiting for the other sessions.
+    #
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.stages = []
+        self.watched = {}
+        self.unwatched_cpu = 0.
+        # the part of the CPU time read from /proc, which os.times() of a
+        # parent profile in the same process does not see
+        self.watched_total = 0.
+
+    def watch(self, proc, started=False):
+        #
+        # A process started during this stage is charged from its start; one
+        # that was already running (e.g. a session from a DAOPhotPool) only
+        # from now on
+        #
+        if (proc.pid not in self.watched):
+            now = None if started else process_cpu_time(proc.pid)
+            self.watched[proc.pid] = 0. if now is None else now
+
+    def unwatch(self, proc):
+        # charge what the process used since the last reading to this stage
+        last = self.watched.pop(proc.pid, None)
+        if (last is not None):
+            now = process_cpu_time(proc.pid)
+            if (now is not None):
+                self.unwatched_cpu += now - last
+
+    def _watched_cpu(self):
+        cpu, self.unwatched_cpu = self.unwatched_cpu, 0.
+        for pid, last in self.watched.items():
+            now = process_cpu_time(pid)
+            if (now is not None):
+                cpu += now - last
+                self.watched[pid] = now
+        return cpu
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = {'name': name, 'wall': 0., 'cpu': 0., 'stars': None}
+        self.stages.append(record)
+
+        self._watched_cpu()
+        start_times = os.times()
+        start_wall = time.time()
+        try:
+            yield record
+        finally:
+            end_times = os.times()
+            record['wall'] = time.time() - start_wall
+            watched_cpu = self._watched_cpu()
+            self.watched_total += watched_cpu
+            record['cpu'] = (end_times[2] - start_times[2]) + \
+                            (end_times[3] - start_times[3]) + \
+                            watched_cpu
+
+    def count(self, n_stars):
+        # number of stars at the end of the most recent stage
+        if (self.stages):
+            self.stages[-1]['stars'] = int(n_stars)
+
+    def total(self, key):
+        return sum([s[key] for s in self.stages])
+
+    def to_header(self, header):
+        for s in self.stages:
+            key = "HIERARCH DAO %s" % (s['name'].upper())
+            header["%s WALL" % (key)] = (round(s['wall'], 3), "wall time [s]")
+            header["%s CPU" % (key)] = (round(s['cpu'], 3), "child process CPU time [s]")
+            if (s['stars'] is not None):
+                header["%s NSTARS" % (key)] = (s['stars'], "number of stars")
+        header["HIERARCH DAO TOTAL WALL"] = (round(self.total('wall'), 3), "wall time [s]")
+        header["HIERARCH DAO TOTAL CPU"] = (round(self.total('cpu'), 3), "child process CPU time [s]")
+
+    def write_json(self, filename):
+        with open(filename, "w") as jf:
+            json.dump({
+                'filename': self.filename,
+                'stages': self.stages,
+                'total_wall': self.total('wall'),
+                'total_cpu': self.total('cpu'),
+            }, jf, indent=2)
+
 
 class Daophot( object ):
 
@@ -1203,8 +2876,93 @@ class Daophot( object ):
 
         self.dao = None
         self.allstar = None
+        self.dao_pool = None
         self.dao_dir = sitesetup.dao_dir
 
+        # send all answers of a stage at once instead of prompt by prompt
+        self.scripted = False
+
+        # memory-map the images when checking the ALLSTAR residuals, and
+        # use this many processes for it
+        self.verify_memmap = False
+        self.verify_workers = 1
+
+        # keep parsed catalogs in binary sidecars (see cached_read)
+        self.catalog_cache = False
+
+        # PSF star candidates from "sextractor" or "internal" (no SExtractor)
+        self.psf_candidates = "sextractor"
+
+        #
+        # verbose echoes the DAOPhot/ALLSTAR dialogue to stdout; with a
+        # transcript_dir the full dialogue of each frame is saved there,
+        # otherwise only its tail is kept in memory (see Transcript)
+        #
+        self.verbose = False
+        self.transcript_dir = None
+        self.transcript = None
+
+        # per-stage timing, also saved as <output>.timing.json
+        self.profile = None
+        self.write_timing = True
+
+        #
+        # All intermediate files of a run go to a workspace of their own,
+        # on fast_scratch_dir if it has room and in scratch_dir otherwise;
+        # with keep_failed, runs that fail leave their workspace behind
+        #
+        self.scratch_dir = sitesetup.scratch_dir
+        self.fast_scratch_dir = "/dev/shm"
+        self.keep_failed = True
+        self.workspace = None
+
+        #
+        # With tile_size, the frame is processed in tiles of at most that
+        # many pixels, overlapping by tile_overlap pixels (at least the PSF
+        # radius), up to tile_workers of them at a time (see auto_tiled).
+        # tile_psf="global" derives one PSF on the central tile and uses it
+        # for all others.
+        #
+        self.tile_size = None
+        self.tile_overlap = 50
+        self.tile_workers = 4
+        self.tile_psf = "tile"
+        # the part of the frame this instance works on, if it is a tile
+        self.tile = None
+
+        #
+        # Image extension to work on (number or EXTNAME). Without one, all
+        # image extensions of a mosaic are processed, up to
+        # extension_workers of them at a time, each with the gain and
+        # readnoise from its own header (see auto_mef)
+        #
+        self.extension = None
+        self.extension_workers = 4
+        self.extension_daophots = []
+
+        # use this PSF instead of picking PSF stars and deriving one, and
+        # keep a copy of the PSF in save_psf
+        self.psf_file = None
+        self.save_psf = None
+
+        # PSFCache to re-use PSF models of earlier, similar frames
+        self.psf_cache = None
+
+        #
+        # With a checkpoint_dir, every frame gets the same workspace there
+        # each time, with a manifest of the stages done so far (see
+        # Checkpoint), so a new run resumes where the last one stopped. The
+        # workspace is kept after failures, and after successful runs with
+        # keep_checkpoints.
+        #
+        self.checkpoint_dir = None
+        self.keep_checkpoints = False
+        self.checkpoint = None
+
+        # set once one of our tiles or extensions failed; their workspaces
+        # are inside ours, which then has to stay as well
+        self.child_failed = False
+
         self.output_filename = None
 
         self.extra_cleanup_files = []
@@ -1228,45 +2986,76 @@ class Daophot( object ):
         #     self.readnoise = hdulist[0].header['RDNOISE']
         self.readnoise = readnoise
 
-    def load(self, filename=None):
+    def load(self, filename=None, extension=None):
 
         if (filename is not None):
             self.filename = filename
+        if (extension is not None):
+            self.extension = extension
 
         if (self.output_filename is None):
             self.output_filename = self.filename[:-5]+".daophot_output.fits"
 
-        hdulist = pyfits.open(self.filename)
+        self.profile = StageProfile(self.filename)
+        with self.profile.stage("load"):
+            self._load()
 
+    def _load(self):
 
         #
-        # If available, open the weight file, and set all undefined pixels
-        # to NaN to properly mask them out.
+        # If available, use the weight file to mask out all undefined
+        # pixels. Then apply pre-scaling and re-add the background to allow
+        # proper noise estimation that we will need for source detection
+        # and to yield proper photometric errors.
         #
         weightfile = self.filename[:-5] + ".weight.fits"
-        if (os.path.isfile(weightfile)):
-            weights_hdu = pyfits.open(weightfile)
-            weights = weights_hdu[0].data
+        if (not os.path.isfile(weightfile)):
+            weightfile = None
 
-            hdulist[0].data[weights <= 0] = numpy.NaN
-
-        #
-        # Apply pre-scaling and re-add the background to allow proper
-        # noise estimation that we will need for source detection and to
-        # yield proper photometric errors.
-        #
-        hdulist[0].data = (hdulist[0].data * self.prescale) + self.add_sky
+        if (self.extension is not None):
+            extensions = [self.extension]
+        else:
+            extensions = image_extensions(self.filename)
+        if (not extensions):
+            raise ValueError("%s does not contain an image" % (self.filename))
+
+        #
+        # write the result into the workspace; short names keep DAOPhot's
+        # filenames within its length limits. Leave room for the image, the
+        # star-subtracted images and all catalogs.
+        #
+        if (self.workspace is None and self.checkpoint_dir is not None):
+            key = "%s[%s]" % (os.path.abspath(self.filename), self.extension)
+            self.workspace = Workspace(self.checkpoint_dir, name="%s_%s" % (
+                os.path.basename(self.filename)[:-5], hashlib.md5(key).hexdigest()[:8]))
+        elif (self.workspace is None):
+            needed = 0
+            for ext in extensions:
+                header = pyfits.getheader(self.filename, ext)
+                needed += 8 * 4 * header.get('NAXIS1', 0) * header.get('NAXIS2', 0)
+            self.workspace = Workspace(self.scratch_dir, self.fast_scratch_dir, needed)
+        if (self.checkpoint_dir is not None and self.checkpoint is None):
+            self.checkpoint = Checkpoint(self.workspace.file("checkpoint.json"))
+
+        if (len(extensions) > 1):
+            # a mosaic; every extension gets a Daophot of its own
+            logger.info("%s has %d image extensions" % (self.filename, len(extensions)))
+            self.tmpfile = None
+            self.extension_daophots = [self._extension_daophot(i, ext)
+                                       for i, ext in enumerate(extensions)]
+            return
 
-        #
-        # write the hdulist as a temp-file
-        #
-        _, self.tmpfile = tempfile.mkstemp(suffix=".fits", dir=sitesetup.scratch_dir)
-        hdulist.writeto(self.tmpfile, clobber=True)
-        print "tmp-file:", self.tmpfile
+        self.tmpfile = self.workspace.file("img.fits")
+        params = {'prescale': self.prescale, 'add_sky': self.add_sky, 'extension': extensions[0]}
+        inputs = {'frame': self.filename, 'weights': weightfile}
+        if (self.resume("load", params, inputs) is None):
+            prepare_image(self.filename, self.tmpfile,
+                          prescale=self.prescale, add_sky=self.add_sky,
+                          weightfile=weightfile, extension=extensions[0])
+            self.record("load", params, inputs, {'image': self.tmpfile})
+        logger.debug("tmp-file: %s" % (self.tmpfile))
         self.extra_cleanup_files.append(self.tmpfile)
 
-        pass
-
     def set_output(self, output_fn):
         self.output_filename = output_fn
 
@@ -1291,26 +3080,31 @@ class Daophot( object ):
 
         # Read the COO file
         coo_filename = self.dao.files['coo']
-        coo = COOfile(coo_filename)
+        coo = COOfile(coo_filename, cache=self.catalog_cache)
         coo_tbhdu = coo.to_FITS_table(name="COO")
         out_hdulist.append(coo_tbhdu)
 
         # Read the AP file
         ap_filename = self.allstar.files['ap']
-        ap = APfile(ap_filename)
+        ap = APfile(ap_filename, cache=self.catalog_cache)
         ap_tbhdu = ap.to_FITS_table(name="AP")
         out_hdulist.append(ap_tbhdu)
 
         # Read the ALS file
         als_filename = self.allstar.files['als']
-        als = ALSfile(als_filename)
+        als = ALSfile(als_filename, cache=self.catalog_cache)
         als_tbhdu = als.to_FITS_table(name="ALS")
         out_hdulist.append(als_tbhdu)
 
-        if (self.dao is not None):
+        # (there is no catalog of PSF star candidates with a given PSF)
+        if (self.dao is not None and self.dao.sextractor_catalog is not None):
             sex_tbhdu = self.dao.sextractor_catalog_to_FITS_table(name="SEXTRACTOR")
             out_hdulist.append(sex_tbhdu)
 
+        # add timing information for all stages so far
+        if (self.profile is not None):
+            self.profile.to_header(out_hdulist[0].header)
+
         # write output file
         out_hdulist = pyfits.HDUList(out_hdulist)
         if (out_fn is None):
@@ -1320,145 +3114,702 @@ class Daophot( object ):
         out_hdulist.writeto(out_fn, clobber=True)
         return True
 
+    def auto_tiled(self, remove_nonstars=True):
+        #
+        # Run the full chain on overlapping tiles of the frame, driven from
+        # a SessionLoop, and merge the results into the same output as
+        # write_final_results. With tile_psf="global" the central tile goes
+        # first, and its PSF is used for all the others.
+        #
+        if (self.profile is None):
+            self.profile = StageProfile(self.filename)
+
+        with self.profile.stage("tiles"):
+            hdulist = pyfits.open(self.tmpfile, memmap=True)
+            ny, nx = hdulist[0].data.shape
+            regions = tile_regions(nx, ny, self.tile_size, self.tile_overlap)
+            tiles = [self._tile_daophot(i, region, hdulist)
+                     for i, region in enumerate(regions)]
+            hdulist.close()
+        logger.info("Processing %s in %d tiles" % (self.filename, len(tiles)))
+
+        psf_file = self.psf_file
+        pending = tiles
+        if (psf_file is None and self.tile_psf == "global"):
+            central = [t for t in tiles
+                       if (t.tile['core'][0] <= nx / 2 < t.tile['core'][1] and
+                           t.tile['core'][2] <= ny / 2 < t.tile['core'][3])][0]
+            central.save_psf = self.workspace.file("global.psf")
+            with self.profile.stage("tile_psf"):
+                sessions = auto_concurrent([central], remove_nonstars=remove_nonstars)
+            self.profile.stages[-1]['cpu'] += central.profile.watched_total
+            self._check_children([central], sessions, "tiles")
+            psf_file = central.save_psf
+            pending = [t for t in tiles if t is not central]
+
+        for tile in pending:
+            tile.psf_file = psf_file
+        with self.profile.stage("tile_runs"):
+            sessions = auto_concurrent(pending, max_active=self.tile_workers,
+                                       remove_nonstars=remove_nonstars)
+        self.profile.stages[-1]['cpu'] += sum([t.profile.watched_total for t in pending])
+        self._check_children(pending, sessions, "tiles")
+
+        with self.profile.stage("write_final_results"):
+            self.write_tiled_results(tiles)
+
+        if (self.write_timing and self.output_filename is not None):
+            self.profile.write_json(self.output_filename[:-5] + ".timing.json")
 
-    def auto(self, remove_nonstars=True, dao_intermediate_fn=None):
+        self.cleanup()
 
-        # open file and read some parameters
-        # self.load()
+    def _check_children(self, children, sessions, what):
+        #
+        # Every tile (or extension) has to deliver its results, or ours would
+        # have a hole; give up on the whole frame if any of them failed or
+        # wrote no output (e.g. for lack of a PSF)
+        #
+        failed = [child.filename for child, session in zip(children, sessions)
+                  if (session['error'] is not None or
+                      not os.path.isfile(child.output_filename))]
+        if (failed):
+            self.child_failed = True
+            self.cleanup(failed=True)
+            raise RuntimeError("%d of %d %s of %s failed: %s" % (
+                len(failed), len(children), what, self.filename, ", ".join(failed)))
+
+    def use_psf(self, psf_fn):
+        # ALLSTAR expects the PSF next to the image
+        self.dao.files['psf'] = self.dao.get_file('psf')
+        shutil.copyfile(psf_fn, self.dao.files['psf'])
+
+    def _child_daophot(self):
+        #
+        # Daophot for a part of our frame (a tile or an extension), with all
+        # our settings; its results go to a file in our workspace
+        #
+        child = Daophot()
+        for key in ['threshold', 'psf_width', 'fitting_radius', 'extra', 'watch',
+                    'gain', 'readnoise', 'dao_dir', 'dao_pool', 'scripted',
+                    'verify_memmap', 'verify_workers', 'catalog_cache',
+                    'psf_candidates', 'psf_cache', 'verbose', 'keep_failed',
+                    'keep_checkpoints']:
+            setattr(child, key, getattr(self, key))
+        child.phot_params = dict(self.phot_params)
+        child.pick_params = dict(self.pick_params)
+        child.write_timing = False
+        return child
+
+    def _tile_daophot(self, index, region, hdulist):
+        #
+        # Daophot for one tile, with its part of our (already prepared)
+        # image in a workspace inside ours
+        #
+        tile = self._child_daophot()
+        tile.filename = "%s[%d]" % (self.filename, index)
+        tile.tile = region
+        # PSFs of tiles are neither taken from nor added to the cache
+        tile.psf_cache = None
+        tile.profile = StageProfile(tile.filename)
+        tile.workspace = Workspace(self.workspace.path, name="tile%03d" % (index))
+        if (self.checkpoint is not None):
+            # kept until we are done, so all tiles can resume after a failure
+            tile.checkpoint = Checkpoint(tile.workspace.file("checkpoint.json"))
+            tile.keep_checkpoints = True
+        tile.tmpfile = tile.workspace.file("img.fits")
+        tile.output_filename = self.workspace.file("tile%03d.dao.fits" % (index))
+
+        x0, x1, y0, y1 = region['box']
+        header = hdulist[0].header.copy()
+        for key, offset in [('CRPIX1', x0), ('CRPIX2', y0)]:
+            if (key in header):
+                header[key] -= offset
+        pyfits.PrimaryHDU(data=numpy.array(hdulist[0].data[y0:y1, x0:x1]),
+                          header=header).writeto(tile.tmpfile, clobber=True)
+        return tile
+
+    def _extension_daophot(self, index, extension):
+        #
+        # Daophot for one extension of a mosaic, loaded into a workspace
+        # inside ours; extensions may be split into tiles in turn
+        #
+        dao = self._child_daophot()
+        for key in ['prescale', 'add_sky', 'transcript_dir', 'tile_size',
+                    'tile_overlap', 'tile_workers', 'tile_psf', 'psf_file']:
+            setattr(dao, key, getattr(self, key))
+        dao.scratch_dir = self.workspace.path
+        dao.fast_scratch_dir = None
+        if (self.checkpoint_dir is not None):
+            # kept until we are done, so all extensions can resume after a failure
+            dao.checkpoint_dir = self.workspace.path
+            dao.keep_checkpoints = True
+        dao.output_filename = self.workspace.file("ext%03d.dao.fits" % (index))
+        dao.load(self.filename, extension=extension)
+        return dao
+
+    def auto_mef(self, remove_nonstars=True):
+        #
+        # Run all extensions of a mosaic side by side in one SessionLoop and
+        # collect their results in one output file (see write_mef_results)
+        #
+        if (self.profile is None):
+            self.profile = StageProfile(self.filename)
+
+        with self.profile.stage("extensions"):
+            sessions = auto_concurrent(self.extension_daophots,
+                                       max_active=self.extension_workers,
+                                       remove_nonstars=remove_nonstars)
+        self.profile.stages[-1]['cpu'] += sum([dao.profile.watched_total
+                                               for dao in self.extension_daophots])
+        self._check_children(self.extension_daophots, sessions, "extensions")
+
+        with self.profile.stage("write_final_results"):
+            self.write_mef_results()
+
+        if (self.write_timing and self.output_filename is not None):
+            self.profile.write_json(self.output_filename[:-5] + ".timing.json")
 
-        # time.sleep(2)
+        self.cleanup()
 
+    def write_mef_results(self, out_fn=None):
         #
-        # Start daophot and read the FITS file.
+        # One output for all extensions: the HDUs written by every extension
+        # (star-subtracted image, COO, AP, ALS, SEXTRACTOR) one after the
+        # other. All HDUs of an extension have its EXTNAME in SRCEXT and
+        # its position in EXTVER (e.g. hdulist['ALS', 2]); the image HDUs
+        # are named like the extension they come from. Only called once
+        # every extension has its results (see _check_children).
         #
-        self.dao = DAOPHOT(
-            options=None, #options,
-            fitsfile=self.tmpfile,
-            threshold=self.threshold,
-            dao_dir=self.dao_dir,
-        )
+        out_hdulist = [pyfits.PrimaryHDU()]
+        ext_hdulists = []
+        for extver, dao in enumerate(self.extension_daophots):
+            ext_name = str(pyfits.getheader(self.filename, dao.extension).get(
+                'EXTNAME', dao.extension))
+            ext_hdulist = pyfits.open(dao.output_filename, memmap=False)
+            ext_hdulists.append(ext_hdulist)
+            for hdu in ext_hdulist[1:]:
+                if (isinstance(hdu, pyfits.ImageHDU)):
+                    hdu.name = ext_name
+                hdu.header['EXTVER'] = extver + 1
+                hdu.header['SRCEXT'] = (ext_name, "image extension of the input")
+                out_hdulist.append(hdu)
+
+        if (not ext_hdulists):
+            return False
+
+        # add timing information for all stages so far
+        if (self.profile is not None):
+            self.profile.to_header(out_hdulist[0].header)
 
-        self.dao.attach(self.tmpfile)
+        # write output file
+        out_hdulist = pyfits.HDUList(out_hdulist)
+        if (out_fn is None):
+            out_fn = self.output_filename
+        if (os.path.isfile(out_fn)):
+            os.remove(out_fn)
+        out_hdulist.writeto(out_fn, clobber=True)
+        for ext_hdulist in ext_hdulists:
+            ext_hdulist.close()
+        return True
 
+    def write_tiled_results(self, tiles, out_fn=None):
         #
-        # set DAOPhot internal parameters
+        # Same output as write_final_results, assembled from the outputs of
+        # all tiles: the star-subtracted image from the tile cores, and the
+        # catalogs merged with merge_tile_catalogs. Star IDs are offset
+        # per tile, so they stay unique and match between COO, AP and ALS;
+        # AP and ALS keep the stars kept in COO.
         #
-        #psf_width = 25.0
-        #fitting_radius = 10.  # 10*psf_width
-        self.dao.options(thresh=self.threshold,
-                    psf=self.psf_width,
-                    fitting=self.fitting_radius,
-                    extra=5,
-                    watch=0)
-
-        # estimate sky background
-        self.dao.sky()
+        tiles = [t for t in tiles if os.path.isfile(t.output_filename)]
+        if (not tiles):
+            return False
 
-        # find sources; make sure to set the right number of sum/avg samples
-        self.dao.find(avg=1)
+        hdulist = pyfits.open(self.tmpfile, memmap=True)
+        ny, nx = hdulist[0].data.shape
+        starsub = numpy.array(hdulist[0].data)
+        header = hdulist[0].header.copy()
+        hdulist.close()
+
+        tables = dict([(name, ([], [], [])) for name in ['COO', 'AP', 'ALS', 'SEXTRACTOR']])
+        id_offset = 0
+        number_offset = 0
+        for tile in tiles:
+            tile_hdulist = pyfits.open(tile.output_filename)
+            x0, x1, y0, y1 = tile.tile['box']
+            cx0, cx1, cy0, cy1 = tile.tile['core']
+            starsub[cy0:cy1, cx0:cx1] = tile_hdulist[1].data[cy0-y0:cy1-y0, cx0-x0:cx1-x0]
+
+            for hdu in tile_hdulist[2:]:
+                data = numpy.array(hdu.data)
+                if (hdu.name == "SEXTRACTOR"):
+                    data['NUMBER'] += number_offset
+                else:
+                    data['STAR_ID'] += id_offset
+                datas, regions, headers = tables[hdu.name]
+                datas.append(data)
+                regions.append(tile.tile)
+                headers.append(hdu.header)
+
+            coo = tile_hdulist['COO'].data
+            if (coo.shape[0] > 0):
+                id_offset += int(numpy.max(coo['STAR_ID']))
+            if ("SEXTRACTOR" in [hdu.name for hdu in tile_hdulist]):
+                sexcat = tile_hdulist['SEXTRACTOR'].data
+                if (sexcat.shape[0] > 0):
+                    number_offset += int(numpy.max(sexcat['NUMBER']))
+            tile_hdulist.close()
+
+        # un-do the scaling we did before the DAOPhot & ALLSTAR runs
+        img_corr = (starsub - self.add_sky) / self.prescale
 
-        # run aperture photometry
-        self.dao.phot(
-            **self.phot_params
+        out_hdulist = [pyfits.PrimaryHDU()]
+        out_hdulist.append(
+            pyfits.ImageHDU(data=img_corr, header=header)
         )
-        #    IS=10, OS=20, A1=4.5, A2=5)
 
-        # select appropriate PSF stars
-        self.dao.pick_midrange()
-        self.dao.pick(**self.pick_params)
+        # which tile a star belongs to is decided once, on the COO catalogs
+        star_ids = None
+        for name in ['COO', 'AP', 'ALS']:
+            datas, regions, headers = tables[name]
+            merged = merge_tile_catalogs(datas, regions, ids=star_ids)
+            if (name == "COO"):
+                star_ids = merged['STAR_ID']
+                columns = COO_COLUMNS
+            elif (name == "AP"):
+                columns = ap_columns((len(merged.dtype.names) - 6) / 2)
+            else:
+                columns = ALS_COLUMNS
+                if (self.profile is not None):
+                    self.profile.count(merged.shape[0])
+            out_hdulist.append(catalog_table_hdu(
+                MergedCatalog(merged, headers[0], nx, ny), columns, name=name))
 
-            #nstars=25, maglimit=18)
+        datas, regions, headers = tables['SEXTRACTOR']
+        if (datas):
+            merged = merge_tile_catalogs(datas, regions, x_field='XWIN_IMAGE', y_field='YWIN_IMAGE')
+            out_hdulist.append(pyfits.BinTableHDU(data=merged, name="SEXTRACTOR"))
 
-        # estimate PSF
-        good_psf = self.dao.psf(interactive=False)
+        # add timing information for all stages so far
+        if (self.profile is not None):
+            self.profile.to_header(out_hdulist[0].header)
+
+        # write output file
+        out_hdulist = pyfits.HDUList(out_hdulist)
+        if (out_fn is None):
+            out_fn = self.output_filename
+        if (os.path.isfile(out_fn)):
+            os.remove(out_fn)
+        out_hdulist.writeto(out_fn, clobber=True)
+        return True
+
+
+    def auto(self, remove_nonstars=True, dao_intermediate_fn=None):
+        try:
+            run_steps(self.auto_steps(remove_nonstars=remove_nonstars,
+                                      dao_intermediate_fn=dao_intermediate_fn))
+        except:
+            self.cleanup(failed=True)
+            raise
+
+    def auto_steps(self, remove_nonstars=True, dao_intermediate_fn=None):
+
+        # open file and read some parameters
+        # self.load()
 
-        self.dao.exit()
+        # time.sleep(2)
 
-        outdir = os.getcwd()
-        #self.dao.save_files(outdir)
+        #
+        # The extensions of a mosaic, or the tiles of a large frame, run in a
+        # SessionLoop of their own; there are no intermediate results for
+        # the frame as a whole
+        #
+        if (self.extension_daophots):
+            self.auto_mef(remove_nonstars=remove_nonstars)
+            return
 
+        if (self.tile_size is not None):
+            self.auto_tiled(remove_nonstars=remove_nonstars)
+            return
 
         #
-        # if we have a well-defined PSF, go on to fit all stars in the frame
-        # using ALLSTAR
+        # Start daophot and read the FITS file.
         #
-        if (good_psf):
-            # allstar = ALLSTAR(options, tmpfile, FIT=fitting_radius, IS=0, OS=4)
-            self.allstar = ALLSTAR(
-                None,
-                self.tmpfile,
-                FIT=self.fitting_radius,
-                IS=20,
-                OS=40,
-                dao_dir=self.dao_dir
-            )
-            # self.allstar.save_files(outdir)
+        transcript_fn = None
+        if (self.transcript_dir is not None):
+            name = os.path.basename(self.filename)[:-5]
+            if (self.extension is not None):
+                name += ".%s" % (self.extension)
+            transcript_fn = os.path.join(self.transcript_dir, name + ".transcript.txt")
+        self.transcript = Transcript(filename=transcript_fn)
+
+        try:
+            if (self.dao_pool is not None):
+                self.dao = self.dao_pool.checkout(self.tmpfile, threshold=self.threshold)
+                self.dao.verbose = self.verbose
+                self.dao.transcript = self.transcript
+                if (self.dao.running):
+                    self.dao.daophot.verbose = self.verbose
+                    self.dao.daophot.transcript = self.transcript
+            else:
+                self.dao = DAOPHOT(
+                    options=None, #options,
+                    fitsfile=self.tmpfile,
+                    threshold=self.threshold,
+                    dao_dir=self.dao_dir,
+                    start=False,
+                    verbose=self.verbose,
+                    transcript=self.transcript,
+                )
+            if (self.profile is None):
+                self.profile = StageProfile(self.filename)
 
-            if (remove_nonstars):
-                if (dao_intermediate_fn is not None):
-                    self.write_final_results(out_fn=dao_intermediate_fn)
+            #
+            # Time every stage; DAOPhot stages only end once the command is done
+            # (and, in scripted mode, all its answers were checked), so their
+            # times and star counts are complete
+            #
+            with self.profile.stage("setup"):
+                started = not self.dao.running
+                yield self.dao.setup_steps()
+                self.profile.watch(self.dao.daophot.proc, started=started)
+                self.dao.psf_candidates = self.psf_candidates
+                self.dao.daophot.scripted = self.scripted
+
+                yield self.dao.attach_steps(self.tmpfile)
+
+                #
+                # set DAOPhot internal parameters
+                #
+                #psf_width = 25.0
+                #fitting_radius = 10.  # 10*psf_width
+                yield self.dao.options_steps(thresh=self.threshold,
+                            psf=self.psf_width,
+                            fitting=self.fitting_radius,
+                            extra=5,
+                            watch=0)
 
-                bad_stars = self.allstar.verify_real_star()  # self.allstar.files['starsub'])
-                print("Removing %d bad stars from ALLSTAR input list" %(bad_stars.shape[0]))
+            #
+            # With a checkpoint, every stage whose inputs and parameters are
+            # still the same as in the last run just picks up its outputs
+            #
+            dao_params = {
+                'threshold': self.threshold,
+                'psf_width': self.psf_width,
+                'fitting_radius': self.fitting_radius,
+            }
+
+            inputs = {'image': self.tmpfile}
+            outputs = self.resume("find", dao_params, inputs)
+            if (outputs is not None):
+                self.dao.files['coo'] = outputs['coo']
+            else:
+                # estimate sky background
+                with self.profile.stage("sky"):
+                    yield self.dao.sky_steps()
+
+                # find sources; make sure to set the right number of sum/avg samples
+                with self.profile.stage("find"):
+                    yield self.dao.find_steps(avg=1)
+                self.profile.count(count_catalog_stars(self.dao.files['coo']))
+                self.record("find", dao_params, inputs, {'coo': self.dao.files['coo']})
+
+            params = dict(dao_params, **self.phot_params)
+            inputs = {'image': self.tmpfile, 'coo': self.dao.files['coo']}
+            outputs = self.resume("phot", params, inputs)
+            if (outputs is not None):
+                self.dao.files['ap'] = outputs['ap']
+            else:
+                # run aperture photometry
+                with self.profile.stage("phot"):
+                    yield self.dao.phot_steps(
+                        **self.phot_params
+                    )
+                    #    IS=10, OS=20, A1=4.5, A2=5)
+                self.profile.count(count_catalog_stars(self.dao.files['ap'], lines_per_star=2))
+                self.record("phot", params, inputs, {'ap': self.dao.files['ap']})
+
+            params = dict(dao_params, pick_params=self.pick_params,
+                          psf_candidates=self.psf_candidates)
+            inputs = {'image': self.tmpfile, 'ap': self.dao.files['ap'], 'psf_file': self.psf_file}
+            outputs = self.resume("psf", params, inputs)
+            if (outputs is not None):
+                self.dao.files['psf'] = outputs['psf']
+                if ('candidates' in outputs):
+                    cat_hdulist = pyfits.open(outputs['candidates'], memmap=False)
+                    self.dao.sextractor_catalog = cat_hdulist[1].data
+                    cat_hdulist.close()
+                good_psf = True
+            else:
+                good_psf = yield self.derive_psf_steps()
+                if (good_psf and self.checkpoint is not None):
+                    outputs = {'psf': self.dao.files['psf']}
+                    if (self.dao.sextractor_catalog is not None):
+                        # the candidates go into the output file
+                        outputs['candidates'] = self.workspace.file("candidates.fits")
+                        pyfits.BinTableHDU(data=self.dao.sextractor_catalog).writeto(
+                            outputs['candidates'], clobber=True)
+                    self.record("psf", params, inputs, outputs)
 
-                # make sure to remember the files we are going to replace
-                # DAOPhot only cleans up the files it knows about at the end
-                self.extra_cleanup_files.append(self.dao.files['ap'])
-                self.extra_cleanup_files.append(self.allstar.files['als'])
-                self.extra_cleanup_files.append(self.allstar.files['starsub'])
+            # DAOPhot is done once all scripted answers went out and were checked
+            if (self.dao.daophot.pending or self.dao.daophot.script):
+                yield self.dao.daophot.script_steps()
 
-                # print("removing bad stars from AP file")
-                ap = APfile(self.dao.files['ap'])
-                ap.remove_stars(bad_stars)
-                new_ap_fn = self.tmpfile[:-5]+".cleanap"
-                print("writing new cleaned input catalog for ALLSTAR to %s" % (new_ap_fn))
-                ap.write(new_ap_fn)
+            # pooled sessions stay alive until we are done with their files
+            self.profile.unwatch(self.dao.daophot.proc)
+            if (self.dao_pool is None):
+                yield self.dao.exit_steps()
 
-                new_als_file = self.tmpfile[:-5]+".cleanals"
-                new_starsub_file = self.tmpfile[:-5]+"_cleanstarsub.fits"
+            if (good_psf and self.save_psf is not None):
+                shutil.copyfile(self.dao.files['psf'], self.save_psf)
 
-                print("Re-running ALLSTAR with the cleaned input source catalog")
+            outdir = os.getcwd()
+            #self.dao.save_files(outdir)
+
+
+            #
+            # if we have a well-defined PSF, go on to fit all stars in the frame
+            # using ALLSTAR
+            #
+            if (good_psf):
+                # allstar = ALLSTAR(options, tmpfile, FIT=fitting_radius, IS=0, OS=4)
                 self.allstar = ALLSTAR(
                     None,
                     self.tmpfile,
                     FIT=self.fitting_radius,
-                    IS=4,
+                    IS=20,
                     OS=40,
                     dao_dir=self.dao_dir,
-                    ap_file=new_ap_fn,
-                    als_file=new_als_file,
-                    starsub_file=new_starsub_file,
+                    start=False,
+                    scripted=self.scripted,
+                    verbose=self.verbose,
+                    transcript=self.transcript,
                 )
+                inputs = {'image': self.tmpfile, 'psf': self.allstar.files['psf'],
+                          'ap': self.allstar.files['ap']}
+                if (self.resume("allstar", self.allstar.allstar_options, inputs) is None):
+                    with self.profile.stage("allstar"):
+                        yield self.allstar.start_steps()
+                    self.profile.count(count_catalog_stars(self.allstar.files['als']))
+                    self.record("allstar", self.allstar.allstar_options, inputs,
+                                {'als': self.allstar.files['als'],
+                                 'starsub': self.allstar.files['starsub']})
+                # self.allstar.save_files(outdir)
+
+                if (remove_nonstars):
+                    if (dao_intermediate_fn is not None):
+                        with self.profile.stage("write_intermediate"):
+                            self.write_final_results(out_fn=dao_intermediate_fn)
+
+                    # make sure to remember the files we are going to replace
+                    # DAOPhot only cleans up the files it knows about at the end
+                    self.extra_cleanup_files.append(self.dao.files['ap'])
+                    self.extra_cleanup_files.append(self.allstar.files['als'])
+                    self.extra_cleanup_files.append(self.allstar.files['starsub'])
+
+                    new_ap_fn = self.tmpfile[:-5]+".cleanap"
+                    inputs = {'image': self.tmpfile, 'ap': self.dao.files['ap'],
+                              'als': self.allstar.files['als'],
+                              'starsub': self.allstar.files['starsub']}
+                    if (self.resume("clean_ap", {}, inputs) is None):
+                        with self.profile.stage("verify_real_star"):
+                            bad_stars = self.allstar.verify_real_star(
+                                memmap=self.verify_memmap, workers=self.verify_workers,
+                                cache=self.catalog_cache)
+                        self.profile.count(bad_stars.shape[0])
+                        logger.info("Removing %d bad stars from ALLSTAR input list" %(bad_stars.shape[0]))
+
+                        with self.profile.stage("clean_ap"):
+                            # print("removing bad stars from AP file")
+                            ap = APfile(self.dao.files['ap'], cache=self.catalog_cache)
+                            ap.remove_stars(bad_stars)
+                            logger.debug("writing new cleaned input catalog for ALLSTAR to %s" % (new_ap_fn))
+                            ap.write(new_ap_fn)
+                        self.record("clean_ap", {}, inputs, {'cleanap': new_ap_fn})
+
+                    new_als_file = self.tmpfile[:-5]+".cleanals"
+                    new_starsub_file = self.tmpfile[:-5]+"_cleanstarsub.fits"
+
+                    self.allstar = ALLSTAR(
+                        None,
+                        self.tmpfile,
+                        FIT=self.fitting_radius,
+                        IS=4,
+                        OS=40,
+                        dao_dir=self.dao_dir,
+                        ap_file=new_ap_fn,
+                        als_file=new_als_file,
+                        starsub_file=new_starsub_file,
+                        start=False,
+                        scripted=self.scripted,
+                        verbose=self.verbose,
+                        transcript=self.transcript,
+                    )
+                    inputs = {'image': self.tmpfile, 'psf': self.allstar.files['psf'],
+                              'ap': new_ap_fn}
+                    if (self.resume("allstar_rerun", self.allstar.allstar_options, inputs) is None):
+                        logger.info("Re-running ALLSTAR with the cleaned input source catalog")
+                        with self.profile.stage("allstar_rerun"):
+                            yield self.allstar.start_steps()
+                        self.profile.count(count_catalog_stars(self.allstar.files['als']))
+                        self.record("allstar_rerun", self.allstar.allstar_options, inputs,
+                                    {'als': self.allstar.files['als'],
+                                     'starsub': self.allstar.files['starsub']})
+
+                # self.allstar.save_files(outdir)
+                with self.profile.stage("write_final_results"):
+                    self.write_final_results()
+            else:
+                logger.warning("Can't run ALLSTAR since we did not derive a converged PSF fit")
 
-            # self.allstar.save_files(outdir)
-            self.write_final_results()
-        else:
-            print "Can't run ALLSTAR since we did not derive a converged PSF fit"
+            if (self.write_timing and self.output_filename is not None):
+                self.profile.write_json(self.output_filename[:-5] + ".timing.json")
 
-        self.cleanup()
+            self.cleanup()
+        except:
+            # don't leave DAOPhot/ALLSTAR running (or a pooled session
+            # checked out) behind when the run fails or is abandoned
+            self.kill_processes()
+            raise
 
-    def cleanup(self):
-        #
-        #  clean up all DAOPhot files
-        #
-        if (self.dao is not None):
-            self.dao.cleanup()
-        #
-        #  ... and all ALLSTAR files ...
-        #
+        if (self.dao_pool is not None):
+            self.dao_pool.checkin(self.dao)
+
+    def kill_processes(self):
+        # end whatever DAOPhot/ALLSTAR processes a failed run still has
         if (self.allstar is not None):
-            self.allstar.cleanup()
-        #
-        # ... and any extra files we created in between
-        #
-        for fn in self.extra_cleanup_files:
-            if (os.path.isfile(fn)):
-                os.remove(fn)
+            self.allstar.kill()
+        if (self.dao is not None):
+            self.dao.kill()
+            if (self.dao_pool is not None):
+                # dead sessions are retired, not handed out again
+                self.dao_pool.checkin(self.dao)
+            self.dao = None
+
+    def derive_psf_steps(self):
+        #
+        # Get the PSF for ALLSTAR: the given psf_file, or one derived from
+        # the PSF stars we pick (or a matching one from the psf_cache);
+        # hands back whether we have one
+        #
+        if (self.psf_file is not None):
+            # with a given PSF there are no PSF stars to pick
+            with self.profile.stage("psf"):
+                self.use_psf(self.psf_file)
+                good_psf = True
+        else:
+            # select appropriate PSF stars
+            with self.profile.stage("pick_midrange"):
+                yield self.dao.pick_midrange_steps()
+            self.profile.count(self.dao.sextractor_catalog.shape[0])
+
+            #
+            # a PSF from an earlier frame of the same detector, filter, size
+            # and night, made with the same PSF options and with about the
+            # same FWHM saves us PICK and PSF
+            #
+            cached_psf = None
+            if (self.psf_cache is not None):
+                psf_key = self.psf_cache.key(pyfits.getheader(self.tmpfile),
+                                             self.psf_width, self.fitting_radius)
+                cached_psf = self.psf_cache.lookup(psf_key, self.dao.candidate_fwhm,
+                                                   self.dao.get_file('psf'))
+
+            if (cached_psf is not None):
+                logger.info("Using cached PSF %s (FWHM %.2f)" % (cached_psf, self.dao.candidate_fwhm))
+                self.dao.files['psf'] = self.dao.get_file('psf')
+                good_psf = True
+            else:
+                with self.profile.stage("pick"):
+                    yield self.dao.pick_steps(**self.pick_params)
+                self.profile.count(count_catalog_stars(self.dao.files['lst']))
+
+                # estimate PSF
+                with self.profile.stage("psf"):
+                    yield self.dao.psf_steps(interactive=False)
+                    good_psf = self.dao.valid_psf_model
+
+                if (self.psf_cache is not None):
+                    if (good_psf):
+                        self.psf_cache.store(psf_key, self.dao.candidate_fwhm, self.dao.files['psf'])
+                    else:
+                        cached_psf = self.psf_cache.recent(psf_key, self.dao.get_file('psf'))
+                        if (cached_psf is not None):
+                            logger.warning("PSF fit failed, falling back to cached PSF %s" % (cached_psf))
+                            self.dao.files['psf'] = self.dao.get_file('psf')
+                            good_psf = True
+
+        raise StepResult(good_psf)
+
+    def resume(self, stage, params, inputs):
+        # outputs of the stage from the last run, if they are still good
+        if (self.checkpoint is None):
+            return None
+        outputs = self.checkpoint.reuse(stage, params, inputs)
+        if (outputs is not None):
+            logger.info("%s: re-using the results of stage %s" % (self.filename, stage))
+        return outputs
+
+    def record(self, stage, params, inputs, outputs):
+        if (self.checkpoint is not None):
+            self.checkpoint.done(stage, params, inputs, outputs)
+
+    def cleanup(self, failed=False):
+        failed = (failed or self.child_failed)
+        if (self.workspace is not None):
+            #
+            # all our files are in the workspace
+            #
+            if (self.checkpoint is not None):
+                keep = (failed or self.keep_checkpoints)
+            else:
+                keep = (failed and self.keep_failed)
+            self.workspace.cleanup(keep=keep)
+            if (not keep):
+                self.workspace = None
+                self.checkpoint = None
+        else:
+            #
+            #  clean up all DAOPhot files
+            #
+            if (self.dao is not None):
+                self.dao.cleanup()
+            #
+            #  ... and all ALLSTAR files ...
+            #
+            if (self.allstar is not None):
+                self.allstar.cleanup()
+            #
+            # ... and any extra files we created in between
+            #
+            for fn in self.extra_cleanup_files:
+                remove_file(fn)
+
+        if (self.transcript is not None):
+            self.transcript.close()
 
         return
 
     pass
 
+
+def auto_concurrent(daophots, max_active=None, **kwargs):
+    #
+    # Run Daophot.auto() for a list of already loaded Daophot instances at
+    # the same time (at most max_active of them), all driven from a single
+    # SessionLoop
+    #
+    loop = SessionLoop(max_active=max_active)
+    for dao in daophots:
+        loop.add(dao.auto_steps(**kwargs), name=dao.filename)
+    sessions = loop.run()
+
+    for dao, session in zip(daophots, sessions):
+        if (session['error'] is not None):
+            logger.error("Processing %s failed: %s" % (session['name'], str(session['error'])))
+            dao.cleanup(failed=True)
+    return sessions
+
+
 def run_all_steps(options,
                   filename,
                   prescale=1.0, 
@@ -1469,40 +3820,28 @@ def run_all_steps(options,
 
     if (options.allstar == ""):
         #filename = cmdline_args[0]
-        print("Running DAOPhot on %s" % (filename))
+        logger.info("Running DAOPhot on %s" % (filename))
 
         # open file and read some parameters
-        hdulist = pyfits.open(filename)
+        header = pyfits.getheader(filename)
 
         if (type(gain) == str):
-            gain = hdulist[0].header['GAIN']
+            gain = header['GAIN']
         if (type(readnoise) == str):
-            readnoise = hdulist[0].header['RDNOISE']
+            readnoise = header['RDNOISE']
 
         #
-        # If available, open the weight file, and set all undefined pixels
-        # to NaN to properly mask them out.
+        # Mask undefined pixels using the weight file (if available),
+        # pre-scale and re-add the background (see prepare_image), and
+        # write the result as a temp-file
         #
         weightfile = filename[:-5]+".weight.fits"
-        if (os.path.isfile(weightfile)):
-            weights_hdu = pyfits.open(weightfile)
-            weights = weights_hdu[0].data
-
-            hdulist[0].data[weights <= 0] = numpy.NaN
-
-        #
-        # Apply pre-scaling and re-add the background to allow proper 
-        # noise estimation that we will need for source detection and to
-        # yield proper photometric errors.
-        #
-        hdulist[0].data = (hdulist[0].data * prescale) + add_sky
-        
-        #
-        # write the hdulist as a temp-file
-        #
+        if (not os.path.isfile(weightfile)):
+            weightfile = None
         tmpfile = "/tmp/pid%d.fits" % (os.getpid())
-        hdulist.writeto(tmpfile, clobber=True)   
-        print "tmp-file:", tmpfile
+        prepare_image(filename, tmpfile, prescale=prescale, add_sky=add_sky,
+                      weightfile=weightfile)
+        logger.debug("tmp-file: %s" % (tmpfile))
 
         #time.sleep(2)
 
@@ -1557,7 +3896,7 @@ def run_all_steps(options,
         allstar = ALLSTAR(options, tmpfile, FIT=fitting_radius, IS=4, OS=40)
         allstar.save_files(options.outdir)
     else:
-        print "Can't run ALLSTAR since we did not derive a converged PSF fit"
+        logger.warning("Can't run ALLSTAR since we did not derive a converged PSF fit")
 
 
 if __name__ == "__main__":
@@ -1580,8 +3919,8 @@ if __name__ == "__main__":
                       type=str)
     (options, cmdline_args) = parser.parse_args()
 
-    print options
-    print type(options.threshold)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    logger.debug(str(options))
     # sys.exit(0)
 
     daophot_exe = "%s/daophot" % (options.dao_dir)
@@ -0,0 +1,112 @@
+#!/usr/bin/env  python
+
+#
+# Round trips of the catalog files: read a reference AP file, write it
+# back with APfile.write, and compare the two byte by byte. The reference
+# files are what the former per-star numpy.savetxt writer produced.
+#
+# ALSfile has no writer (ALSfile.write does nothing), so ALS files are
+# not covered here.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+import daophot_wrapper
+
+
+AP_HEADER = " NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD\n"
+AP_STATS = "  1  2048  4096   -52.3 60000.0  35.221   4.000   1.500   5.200   3.000\n"
+
+REFERENCE_AP = AP_HEADER + AP_STATS + "\n" + \
+    "\n" + \
+    "      1   10.500   20.250   15.123   14.987   14.901\n" + \
+    "      1003.127 12.34  0.56  0.0123   0.0118   0.0115\n" + \
+    "\n" + \
+    "      2 1873.002 4012.998   99.999   99.999   20.500\n" + \
+    "       998.502 11.90 -0.12  9.9999   9.9999   0.2031\n"
+
+
+def write_reference_ap(filename, n_stars, n_apertures, seed=1):
+    #
+    # AP file with random stars, written the way APfile.write used to:
+    # numpy.savetxt, one star at a time
+    #
+    rng = numpy.random.RandomState(seed)
+    values1 = numpy.empty((n_stars, 3 + n_apertures))
+    values1[:, 0] = numpy.arange(1, n_stars+1)
+    values1[:, 1:3] = numpy.round(rng.uniform(1., 4096., (n_stars, 2)), 3)
+    values1[:, 3:] = numpy.round(rng.uniform(10., 25., (n_stars, n_apertures)), 3)
+    values2 = numpy.empty((n_stars, 3 + n_apertures))
+    values2[:, 0] = numpy.round(rng.uniform(100., 60000., n_stars), 3)
+    values2[:, 1] = numpy.round(rng.uniform(1., 99., n_stars), 2)
+    values2[:, 2] = numpy.round(rng.uniform(-9., 9., n_stars), 2)
+    values2[:, 3:] = numpy.round(rng.uniform(0., 9.9, (n_stars, n_apertures)), 4)
+
+    with open(filename, "w") as ap:
+        ap.write(AP_HEADER)
+        ap.write(AP_STATS)
+        ap.write("\n")
+        for src in range(n_stars):
+            print >>ap
+            numpy.savetxt(ap, values1[src:src+1],
+                          fmt="%7d %8.3f %8.3f"+" %8.3f"*n_apertures)
+            numpy.savetxt(ap, values2[src:src+1],
+                          fmt="%14.3f %5.2f %5.2f %7.4f"+" %8.4f"*(n_apertures-1))
+
+
+class APRoundTripTest( unittest.TestCase ):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_catalogs_")
+        self.reference_fn = os.path.join(self.tmpdir, "reference.ap")
+        self.output_fn = os.path.join(self.tmpdir, "output.ap")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def read_bytes(self, filename):
+        with open(filename, "rb") as f:
+            return f.read()
+
+    def assertRoundTrip(self, cache=False, chunk_size=50000):
+        ap = daophot_wrapper.APfile(self.reference_fn, cache=cache)
+        ap.write(self.output_fn, chunk_size=chunk_size)
+        self.assertEqual(self.read_bytes(self.output_fn),
+                         self.read_bytes(self.reference_fn))
+        return ap
+
+    def test_reference_file(self):
+        with open(self.reference_fn, "w") as f:
+            f.write(REFERENCE_AP)
+        ap = self.assertRoundTrip()
+        self.assertEqual(ap.n_apertures, 3)
+        self.assertEqual(list(ap.data['STAR_ID']), [1, 2])
+        self.assertEqual(ap.nx, 2048)
+        self.assertEqual(ap.ny, 4096)
+
+    def test_apertures(self):
+        for n_apertures in [1, 2, 5, 12]:
+            write_reference_ap(self.reference_fn, 200, n_apertures)
+            ap = self.assertRoundTrip()
+            self.assertEqual(ap.n_apertures, n_apertures)
+            self.assertEqual(ap.data.shape[0], 200)
+
+    def test_chunks(self):
+        # stars split over several chunks of the writer
+        write_reference_ap(self.reference_fn, 250, 3)
+        self.assertRoundTrip(chunk_size=64)
+
+    def test_cached(self):
+        # the second read comes from the binary sidecar of the catalog
+        write_reference_ap(self.reference_fn, 100, 3)
+        self.assertRoundTrip(cache=True)
+        self.assertRoundTrip(cache=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
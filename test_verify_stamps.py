@@ -0,0 +1,96 @@
+#!/usr/bin/env  python
+
+#
+# Compare verify_stamps with the per-source percentile clipping it
+# replaced, on a small synthetic stack of S/N stamps
+#
+
+import unittest
+
+import numpy
+
+import daophot_wrapper
+
+
+def verify_stamps_percentile(s2n, n_max_bad_pixels):
+    # the former implementation, with nanpercentile on the whole stack
+    is_star = numpy.zeros(s2n.shape[0], dtype=numpy.bool)
+    valid = numpy.any(numpy.isfinite(s2n), axis=1)
+    s2n = s2n[valid]
+    if (s2n.shape[0] <= 0):
+        return is_star
+
+    good_s2n = s2n.copy()
+    good_s2n[~numpy.isfinite(s2n)] = numpy.NaN
+    for iter in range(3):
+        noise_stats = numpy.nanpercentile(good_s2n, [16, 84, 50], axis=1)
+        _median = noise_stats[2].reshape((-1, 1))
+        _sigma = ((noise_stats[1] - noise_stats[0]) / 2.).reshape((-1, 1))
+        _outlier = (good_s2n < (_median - 3*_sigma)) | (good_s2n > (_median + 3*_sigma))
+        good_s2n[_outlier] = numpy.NaN
+
+    over_subtracted = numpy.sum(s2n < (_median - 3*_sigma), axis=1)
+    under_subtracted = numpy.sum(s2n > (_median + 3*_sigma), axis=1)
+    excess = over_subtracted - under_subtracted
+    is_star[valid] = (excess <= n_max_bad_pixels)
+    return is_star
+
+
+def make_stamps(n_sources=60, size=11, seed=1):
+    #
+    # Gaussian noise around a slowly varying offset per source; some
+    # sources get over-subtracted cores (strongly negative S/N), some
+    # under-subtracted ones, some undefined and infinite pixels, and
+    # one has no valid pixel at all
+    #
+    rng = numpy.random.RandomState(seed)
+    n_pixels = size * size
+    s2n = rng.normal(0., 1., (n_sources, n_pixels))
+    s2n += rng.normal(0., 0.3, (n_sources, 1))
+
+    core = (numpy.arange(n_pixels) // size - size // 2)**2 + \
+           (numpy.arange(n_pixels) % size - size // 2)**2 <= 2
+    for i in range(0, n_sources, 4):
+        s2n[i, core] -= rng.uniform(2., 20.)
+    for i in range(1, n_sources, 6):
+        s2n[i, core] += rng.uniform(2., 20.)
+    for i in range(2, n_sources, 5):
+        s2n[i, rng.randint(0, n_pixels, 15)] = numpy.NaN
+    s2n[3, :5] = numpy.inf
+    s2n[5, :5] = -numpy.inf
+    s2n[7] = numpy.NaN
+    return s2n
+
+
+class VerifyStampsTest( unittest.TestCase ):
+
+    def test_matches_percentile_clipping(self):
+        s2n = make_stamps()
+        for n_max_bad_pixels in range(-3, 10):
+            expected = verify_stamps_percentile(s2n, n_max_bad_pixels)
+            result = daophot_wrapper.verify_stamps(s2n, n_max_bad_pixels)
+            self.assertEqual(list(result), list(expected),
+                             "n_max_bad_pixels=%d" % (n_max_bad_pixels))
+
+    def test_both_outcomes(self):
+        # make sure the stack tells real stars and non-stars apart at all
+        is_star = daophot_wrapper.verify_stamps(make_stamps(), 3)
+        self.assertTrue(numpy.any(is_star))
+        self.assertTrue(numpy.any(~is_star))
+
+    def test_no_valid_pixels(self):
+        s2n = numpy.empty((3, 25))
+        s2n[:] = numpy.NaN
+        self.assertEqual(list(daophot_wrapper.verify_stamps(s2n, 3)),
+                         [False, False, False])
+
+    def test_input_unchanged(self):
+        s2n = make_stamps()
+        before = s2n.copy()
+        daophot_wrapper.verify_stamps(s2n, 3)
+        same = (s2n == before) | (numpy.isnan(s2n) & numpy.isnan(before))
+        self.assertTrue(numpy.all(same))
+
+
+if __name__ == "__main__":
+    unittest.main()